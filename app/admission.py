@@ -0,0 +1,219 @@
+"""
+Controllo di ammissione davanti alle route costose (middleware ASGI, prima del routing):
+
+1. token bucket per chiave API (X-API-Key valida; senza chiave, per IP del client):
+   oltre il budget -> 429 con Retry-After pari all'attesa del prossimo token;
+2. limite di concorrenza per budget con coda d'attesa limitata (FIFO): coda piena o
+   attesa oltre ADMISSION_QUEUE_TIMEOUT_MS -> 503 con Retry-After.
+
+Budget separati: "products" (/products*, letture economiche) e "checkout" (/checkout/*,
+scritture DB + Stripe). Le richieste ammesse non aspettano oltre il timeout di coda, quindi
+la latenza di coda resta limitata anche in sovraccarico: l'eccesso viene rifiutato subito.
+
+Configurazione per budget (prefisso PRODUCTS_ / CHECKOUT_):
+    *_RATE_PER_KEY   token/s per chiave (0 = nessun limite per chiave)
+    *_BURST          capienza del bucket (default: 2 × rate)
+    *_CONCURRENCY    richieste in esecuzione (0 = nessun limite)
+    *_QUEUE          richieste in attesa oltre le quali si risponde 503
+Valori per processo: con app.serve ogni worker ha i propri bucket e limiti.
+
+Dietro un proxy (Render) l'IP del client nello scope ASGI è quello del load balancer:
+con ADMISSION_PROXY_HOPS=N l'IP è l'N-esimo indirizzo da destra di X-Forwarded-For,
+cioè quello aggiunto dal proxy fidato (i valori più a sinistra li sceglie il client);
+con meno di N indirizzi l'header non è attendibile e vale l'IP della connessione.
+"""
+import asyncio, math, os, time
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+
+from starlette.responses import JSONResponse
+
+from . import metrics, security
+
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "2000"))
+ADMISSION_BUCKETS = int(os.getenv("ADMISSION_BUCKETS", "10000"))   # chiavi/IP tenuti in memoria (LRU)
+ADMISSION_PROXY_HOPS = int(os.getenv("ADMISSION_PROXY_HOPS", "0"))  # proxy fidati davanti all'app (Render: 1)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float) -> float:
+        """0 se il token è disponibile (e consumato), altrimenti i secondi al prossimo token."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class KeyedBuckets:
+    """Un TokenBucket per chiave, LRU: una chiave espulsa ritorna con il bucket pieno."""
+
+    def __init__(self, rate: float, burst: float, size: int = ADMISSION_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def take(self, key: str) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(now)
+
+
+class ConcurrencyLimiter:
+    """
+    Al più `limit` richieste in esecuzione e `queue` in attesa. Il posto di chi termina
+    passa direttamente al primo in coda (FIFO), senza che un nuovo arrivo lo scavalchi.
+    """
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> bool:
+        """False se la coda è piena o l'attesa supera timeout secondi."""
+        if self.limit <= 0:
+            return True
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue:
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()   # posto ricevuto mentre il client se ne andava
+            raise
+        finally:
+            if not fut.done() or fut.cancelled():
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)   # il posto passa al primo in coda: active invariato
+                return
+        self.active -= 1
+
+
+class Budget(NamedTuple):
+    name: str
+    buckets: KeyedBuckets
+    limiter: ConcurrencyLimiter
+
+
+def budget_from_env(name: str, rate: float, concurrency: int, queue: int) -> Budget:
+    prefix = name.upper()
+    rate = float(os.getenv(f"{prefix}_RATE_PER_KEY", str(rate)))
+    burst = float(os.getenv(f"{prefix}_BURST", str(max(1.0, 2 * rate))))
+    return Budget(name, KeyedBuckets(rate, burst),
+                  ConcurrencyLimiter(int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+                                     int(os.getenv(f"{prefix}_QUEUE", str(queue)))))
+
+
+# Limiti per chiave spenti di default (impostati in render.yaml), concorrenza sempre limitata
+budgets = {
+    "products": budget_from_env("products", rate=0, concurrency=16, queue=64),
+    "checkout": budget_from_env("checkout", rate=0, concurrency=8, queue=32),
+}
+
+
+def classify(path: str) -> Optional[Budget]:
+    if path == "/products" or path.startswith("/products/"):
+        return budgets["products"]
+    if path.startswith("/checkout/"):
+        return budgets["checkout"]
+    return None
+
+
+def client_ip(scope, proxy_hops: int = ADMISSION_PROXY_HOPS) -> str:
+    if proxy_hops > 0:
+        forwarded = [v.decode("latin-1") for k, v in scope["headers"] if k == b"x-forwarded-for"]
+        hops = [h.strip() for h in ",".join(forwarded).split(",") if h.strip()]
+        # con meno indirizzi dei proxy fidati la richiesta non è passata da tutti: header del client
+        if len(hops) >= proxy_hops:
+            return hops[-proxy_hops]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def client_key(scope) -> str:
+    """Chiave API se valida, altrimenti IP: chiavi inventate non aprono bucket nuovi."""
+    for name, value in scope["headers"]:
+        if name == b"x-api-key":
+            key = value.decode("latin-1")
+            if key in security.api_keys():
+                return f"key:{key}"
+            break
+    return f"ip:{client_ip(scope)}"
+
+
+def _retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class AdmissionMiddleware:
+    """Middleware ASGI: 429 (budget della chiave esaurito) o 503 (coda piena) prima del routing."""
+
+    def __init__(self, app, timeout_ms: float = ADMISSION_QUEUE_TIMEOUT_MS):
+        self.app = app
+        self.timeout = timeout_ms / 1000.0
+
+    async def __call__(self, scope, receive, send):
+        budget = classify(scope["path"]) if scope["type"] == "http" and scope["method"] != "OPTIONS" else None
+        if budget is None:
+            return await self.app(scope, receive, send)
+
+        wait = budget.buckets.take(client_key(scope))
+        if wait:
+            scope["acp.route_label"] = f"admission:{budget.name}"
+            metrics.ADMISSION_REJECTED.inc(budget.name, "rate_limited")
+            return await JSONResponse({"detail": "Rate limit exceeded"}, status_code=429,
+                                      headers={"Retry-After": _retry_after(wait)})(scope, receive, send)
+
+        t0 = time.perf_counter()
+        if not await budget.limiter.acquire(self.timeout):
+            scope["acp.route_label"] = f"admission:{budget.name}"
+            metrics.ADMISSION_REJECTED.inc(budget.name, "overloaded")
+            return await JSONResponse({"detail": "Server busy, retry later"}, status_code=503,
+                                      headers={"Retry-After": _retry_after(self.timeout)})(scope, receive, send)
+        metrics.ADMISSION_WAIT.observe(time.perf_counter() - t0, budget.name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.limiter.release()
@@ -0,0 +1,122 @@
+import asyncio, logging, os, time
+from typing import Optional
+
+from . import db
+
+logger = logging.getLogger("acp.analytics")
+
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "30"))
+# Le righe più recenti di così restano alla prossima passata: una transazione
+# ancora aperta può committare righe con created_at precedente al suo COMMIT
+ANALYTICS_LAG_SECONDS = int(os.getenv("ANALYTICS_LAG_SECONDS", "5"))
+
+EPOCH = "1970-01-01 00:00:00"
+
+# sorgente -> statement di rollup sulla finestra created_at in ($1, $2]
+ROLLUPS = {
+    "orders": [
+        """
+        INSERT INTO sales_daily (day, currency, orders, revenue_minor)
+        SELECT CAST(created_at AS DATE), coalesce(upper(currency), 'EUR'), count(*), coalesce(sum(amount_minor), 0)
+        FROM orders
+        WHERE created_at > $1 AND created_at <= $2
+        GROUP BY ALL
+        ON CONFLICT (day, currency) DO UPDATE SET
+            orders = sales_daily.orders + EXCLUDED.orders,
+            revenue_minor = sales_daily.revenue_minor + EXCLUDED.revenue_minor
+        """,
+        # ricavo per prodotto = prezzo unitario × quantità (lordo di sconti, tasse e spedizione)
+        """
+        INSERT INTO sales_product_daily (day, product_id, currency, orders, units, revenue_minor)
+        SELECT CAST(o.created_at AS DATE), oi.product_id, coalesce(upper(o.currency), 'EUR'),
+               count(DISTINCT o.id), sum(oi.quantity), coalesce(sum(oi.quantity * oi.unit_price_minor), 0)
+        FROM order_items oi JOIN orders o ON o.id = oi.order_id
+        -- order_items.created_at = created_at dell'ordine: entrambe le scansioni restano sulla finestra
+        WHERE oi.created_at > $1 AND oi.created_at <= $2 AND o.created_at > $1 AND o.created_at <= $2
+        GROUP BY ALL
+        ON CONFLICT (day, product_id, currency) DO UPDATE SET
+            orders = sales_product_daily.orders + EXCLUDED.orders,
+            units = sales_product_daily.units + EXCLUDED.units,
+            revenue_minor = sales_product_daily.revenue_minor + EXCLUDED.revenue_minor
+        """,
+    ],
+    "checkout_sessions": [
+        """
+        INSERT INTO sessions_daily (day, sessions)
+        SELECT CAST(created_at AS DATE), count(*)
+        FROM checkout_sessions
+        WHERE created_at > $1 AND created_at <= $2
+        GROUP BY ALL
+        ON CONFLICT (day) DO UPDATE SET sessions = sessions_daily.sessions + EXCLUDED.sessions
+        """,
+    ],
+}
+
+
+def refresh_rollups(cur, lag_seconds: int = ANALYTICS_LAG_SECONDS) -> dict:
+    """
+    Nel pool DB: aggrega solo le righe con created_at oltre l'high-water mark di
+    ciascuna sorgente e sposta il mark, tutto nella stessa transazione.
+    Restituisce le righe sorgente aggregate per tabella.
+    """
+    cur.execute("BEGIN TRANSACTION")
+    try:
+        upper = cur.execute("SELECT CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND", [lag_seconds]).fetchone()[0]
+        marks = dict(cur.execute("SELECT source, high_water FROM rollup_state").fetchall())
+        stats = {}
+        for source, statements in ROLLUPS.items():
+            lower = marks.get(source) or EPOCH
+            n = cur.execute(f"SELECT count(*) FROM {source} WHERE created_at > $1 AND created_at <= $2", [lower, upper]).fetchone()[0]
+            if n:
+                for sql in statements:
+                    cur.execute(sql, [lower, upper])
+            cur.execute(
+                "INSERT INTO rollup_state (source, high_water) VALUES (?, ?) "
+                "ON CONFLICT (source) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = now()",
+                [source, upper],
+            )
+            stats[source] = n
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return stats
+
+
+_lock: Optional[asyncio.Lock] = None
+_refresher: Optional[asyncio.Task] = None
+
+
+async def refresh() -> dict:
+    """Una passata incrementale; le passate concorrenti nello stesso processo sono serializzate."""
+    global _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        t0 = time.perf_counter()
+        stats = await db.run(refresh_rollups)
+        if any(stats.values()):
+            logger.info("rollups refreshed %s in %.1f ms", stats, (time.perf_counter() - t0) * 1000)
+        return stats
+
+
+async def _refresh_loop():
+    while True:
+        try:
+            await refresh()
+        except Exception:
+            logger.exception("rollup refresh failed")
+        await asyncio.sleep(ANALYTICS_REFRESH_SECONDS)
+
+
+def start_refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = asyncio.get_running_loop().create_task(_refresh_loop())
+
+
+async def stop_refresher():
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        _refresher = None
@@ -0,0 +1,122 @@
+import asyncio, os, time, logging
+from typing import Iterable, Optional
+
+from . import db
+
+logger = logging.getLogger("acp.catalog")
+
+# Ogni quanto (s) ricontrollare il watermark di versione su catalog_meta
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "5"))
+
+
+def price_to_cents(price) -> int:
+    return int(round(float(price) * 100))
+
+
+class CatalogSnapshot:
+    """
+    Snapshot in memoria del catalogo: indice id -> prezzo in centesimi.
+    Caricato una volta, ricaricato quando cambia catalog_meta.version
+    (controllata al massimo ogni CATALOG_REFRESH_SECONDS) o dopo invalidate().
+    Una versione cambiata da un altro processo (ingest, altro worker, MotherDuck)
+    invalida anche le altre cache in db.CATALOG_LISTENERS (schema, regole pricing).
+    """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self.updated_at = None
+        self.prices: dict[str, int] = {}
+        self._loaded_version: Optional[int] = None   # non azzerata da invalidate()
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version = None
+        self._checked_at = 0.0
+
+    async def refresh(self, force: bool = False):
+        if not force and self.version is not None and time.monotonic() - self._checked_at < CATALOG_REFRESH_SECONDS:
+            return
+        async with self._lock:
+            if not force and self.version is not None and time.monotonic() - self._checked_at < CATALOG_REFRESH_SECONDS:
+                return
+            await db.sync_catalog()
+            row = await db.fetchone("SELECT version, updated_at FROM catalog_meta WHERE key = 'products'",
+                                    name="catalog.version", catalog=True)
+            version, updated_at = row if row else (0, None)
+            if self._loaded_version is not None and version != self._loaded_version:
+                for listener in db.CATALOG_LISTENERS:
+                    listener()
+            if force or version != self.version:
+                rows = await db.fetchall("SELECT id, price FROM products WHERE price IS NOT NULL", name="catalog.prices", catalog=True)
+                self.prices = {str(pid): price_to_cents(price) for pid, price in rows}
+                logger.info("catalog snapshot loaded version=%s products=%d", version, len(self.prices))
+            self.version, self.updated_at, self._loaded_version = version, updated_at, version
+            self._checked_at = time.monotonic()
+
+    async def prices_cents(self, product_ids: Iterable[str]) -> dict[str, int]:
+        """Prezzi per gli id richiesti; i miss vanno in un'unica query WHERE id IN (...)."""
+        await self.refresh()
+        ids = set(product_ids)
+        found = {pid: self.prices[pid] for pid in ids if pid in self.prices}
+        missing = [pid for pid in ids if pid not in found]
+        if missing:
+            placeholders = ", ".join("?" for _ in missing)
+            rows = await db.fetchall(
+                f"SELECT id, price FROM products WHERE price IS NOT NULL AND id IN ({placeholders})", missing,
+                name="catalog.prices_missing", catalog=True,
+            )
+            for pid, price in rows:
+                found[str(pid)] = self.prices[str(pid)] = price_to_cents(price)
+        return found
+
+
+# Colonne opzionali lette da /products: se mancano vengono proiettate come NULL
+OPTIONAL_COLUMNS = ("brand", "category", "image_url", "size", "color", "return_policy", "available")
+
+
+class ProductSchema:
+    """
+    Colonne della tabella products, lette una volta all'avvio (dopo init_db)
+    e rilette alla prossima richiesta dopo una migrazione o ricarica catalogo.
+    """
+
+    def __init__(self):
+        self.columns: Optional[frozenset] = None
+
+    def load(self, conn):
+        rows = conn.execute("PRAGMA table_info('products')").fetchall()
+        self.columns = frozenset(r[1] for r in rows)
+
+    def invalidate(self):
+        self.columns = None
+
+    async def get(self) -> frozenset:
+        if self.columns is None:
+            await db.run(self.load, catalog=True)
+        return self.columns
+
+
+def product_source(columns: frozenset) -> str:
+    """
+    FROM per le query sul catalogo: la tabella così com'è, oppure una proiezione
+    che aggiunge come NULL le colonne opzionali assenti (image_url ripiega su image).
+    """
+    missing = [c for c in OPTIONAL_COLUMNS if c not in columns]
+    if not missing:
+        return "products"
+    extra = []
+    for c in missing:
+        if c == "image_url" and "image" in columns:
+            extra.append("image AS image_url")
+        elif c == "available":
+            extra.append("true AS available")
+        else:
+            extra.append(f"NULL::TEXT AS {c}")
+    return f"(SELECT *, {', '.join(extra)} FROM products) products"
+
+
+snapshot = CatalogSnapshot()
+schema = ProductSchema()
+db.CATALOG_LISTENERS.append(snapshot.invalidate)
+db.CATALOG_LISTENERS.append(schema.invalidate)
@@ -1,15 +1,53 @@
 
-import os, json, pathlib
+import os, pathlib, asyncio, threading, time
 import duckdb
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional, Sequence
+
+from . import metrics
 
 DB_CONN = None
 
+# Pool di thread limitato per le query: gli handler async non bloccano l'event loop
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# Modalità multi-worker (python -m app.serve): "writer" possiede il database,
+# "worker" legge il catalogo da uno snapshot in memoria e inoltra il resto al writer
+DB_ROLE = os.getenv("DB_ROLE", "single")
+DB_WRITER_SOCKET = os.getenv("DB_WRITER_SOCKET", "")
+DB_SNAPSHOT_DIR = os.getenv("DB_SNAPSHOT_DIR") or os.path.dirname(DB_WRITER_SOCKET)
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+_local = threading.local()
+
+PRODUCT_EXTRA_COLUMNS = ("brand", "category", "image_url", "size", "color", "return_policy")
+# Totali tipizzati di checkout_sessions (sostituiscono totals_json)
+TOTALS_COLUMNS = ("subtotal_minor", "discount_minor", "tax_minor", "shipping_minor", "grand_total_minor")
+
+# Righe d'ordine copiate dalla sessione con lo stesso PaymentIntent (route complete e webhook)
+ORDER_ITEMS_FROM_SESSION_SQL = """
+    INSERT INTO order_items (order_id, position, product_id, quantity, unit_price_minor, created_at)
+    SELECT o.id, si.position, si.product_id, si.quantity, si.unit_price_minor, o.created_at
+    FROM orders o
+    JOIN checkout_sessions s ON s.payment_intent_id = o.payment_intent_id
+    JOIN session_items si ON si.session_id = s.id
+    WHERE o.payment_intent_id = ?
+      AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id)
+"""
+
+# Callback invocate a ogni bump della versione catalogo (invalidazione cache in-process)
+CATALOG_LISTENERS: list[Callable[[], None]] = []
+
 def get_conn():
     global DB_CONN
     if DB_CONN is not None:
         return DB_CONN
 
+    if DB_ROLE == "worker":
+        # Solo lo snapshot del catalogo (products, catalog_meta), caricato da sync_catalog
+        DB_CONN = duckdb.connect(":memory:")
+        return DB_CONN
+
     token = os.getenv("MOTHERDUCK_TOKEN")
     dbname = os.getenv("MOTHERDUCK_DATABASE", "acp_demo")
 
@@ -18,10 +56,13 @@ def get_conn():
         os.environ["MOTHERDUCK_TOKEN"] = token
         conn = duckdb.connect("md:")
 
-        # 2) Crea il database se non esiste e selezionalo
+        # 2) Seleziona il database, creandolo solo se manca (un round trip in meno a ogni avvio)
         #    NB: usa le virgolette per supportare nomi con underscore o maiuscole
-        conn.execute(f'CREATE DATABASE IF NOT EXISTS "{dbname}";')
-        conn.execute(f'USE "{dbname}";')
+        try:
+            conn.execute(f'USE "{dbname}";')
+        except duckdb.Error:
+            conn.execute(f'CREATE DATABASE IF NOT EXISTS "{dbname}";')
+            conn.execute(f'USE "{dbname}";')
     else:
         # Fallback locale
         conn = duckdb.connect("local.duckdb")
@@ -29,8 +70,152 @@ def get_conn():
     DB_CONN = conn
     return DB_CONN
 
+def _get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="duckdb")
+    return _EXECUTOR
+
+def cursor():
+    """
+    Cursore DuckDB del thread corrente (conn.cursor() = connessione duplicata
+    sullo stesso database). Ogni worker del pool ne tiene uno proprio.
+    """
+    cur = getattr(_local, "cursor", None)
+    if cur is None:
+        cur = get_conn().cursor()
+        _local.cursor = cur
+    return cur
+
+async def _in_pool(call: Callable[[], Any], label: str) -> Any:
+    submitted = time.perf_counter()
+
+    def timed():
+        started = time.perf_counter()
+        metrics.DB_POOL_WAIT.observe(started - submitted)
+        try:
+            return call()
+        finally:
+            metrics.DB_QUERIES.observe(time.perf_counter() - started, label)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), timed)
+
+def _remote(fn: Callable[..., Any], args: tuple) -> Any:
+    """Nel worker: fn(cursor, *args) eseguita dal writer sulla connessione IPC del thread."""
+    from . import ipc
+    sock = getattr(_local, "writer", None)
+    if sock is None:
+        sock = _local.writer = ipc.connect(DB_WRITER_SOCKET)
+    try:
+        return ipc.call(sock, fn, args)
+    except (ConnectionError, OSError):
+        # niente retry automatico: la scrittura potrebbe essere già avvenuta
+        _local.writer = None
+        sock.close()
+        raise
+
+async def run(fn: Callable[..., Any], *args: Any, name: Optional[str] = None, catalog: bool = False) -> Any:
+    """
+    Esegue fn(cursor, *args) su un worker del pool (per più statement o transazioni).
+    Il tempo di esecuzione finisce in metrics.DB_QUERIES sotto `name` (default: nome di fn).
+    catalog=True: sola lettura di products/catalog_meta, servita dallo snapshot locale
+    in modalità worker; altrimenti fn deve essere una funzione di modulo (va al writer).
+    """
+    if DB_ROLE == "worker" and not catalog:
+        return await _in_pool(lambda: _remote(fn, args), name or fn.__name__)
+    return await _in_pool(lambda: fn(cursor(), *args), name or fn.__name__)
+
+def _sql(cur, mode: str, sql: str, params: Optional[Sequence[Any]]):
+    res = cur.execute(sql, params or [])
+    if mode == "one":
+        return res.fetchone()
+    if mode == "all":
+        return res.fetchall()
+    return None
+
+async def execute(sql: str, params: Optional[Sequence[Any]] = None, name: Optional[str] = None) -> None:
+    await run(_sql, "none", sql, params, name=name or metrics.query_name(sql))
+
+async def fetchone(sql: str, params: Optional[Sequence[Any]] = None, name: Optional[str] = None, catalog: bool = False):
+    return await run(_sql, "one", sql, params, name=name or metrics.query_name(sql), catalog=catalog)
+
+async def fetchall(sql: str, params: Optional[Sequence[Any]] = None, name: Optional[str] = None, catalog: bool = False):
+    return await run(_sql, "all", sql, params, name=name or metrics.query_name(sql), catalog=catalog)
+
+async def stream(sql: str, params: Optional[Sequence[Any]] = None, batch_rows: int = 1000, name: Optional[str] = None,
+                 catalog: bool = False) -> AsyncIterator[list]:
+    """
+    Righe di sql a blocchi di batch_rows su un cursore dedicato (DuckDB produce il
+    risultato man mano): memoria costante anche su tutto il catalogo. Ogni blocco è
+    un task del pool, che resta libero tra un blocco e l'altro. In modalità worker
+    solo catalog=True (snapshot locale): il risultato non passa dall'IPC.
+    """
+    if DB_ROLE == "worker" and not catalog:
+        raise RuntimeError("db.stream is only available for catalog queries in worker mode")
+    label = name or metrics.query_name(sql)
+    cur = get_conn().cursor()
+    lock = threading.Lock()   # close mai in parallelo a execute/fetch (può partire con un fetch in volo)
+
+    def start():
+        with lock:
+            cur.execute(sql, params or [])
+
+    def fetch():
+        with lock:
+            return cur.fetchmany(batch_rows)
+
+    def close_cursor():
+        with lock:
+            cur.close()
+
+    try:
+        await _in_pool(start, label)
+        while rows := await _in_pool(fetch, label):
+            yield rows
+    finally:
+        # senza await: chiusura anche da un generatore cancellato (client disconnesso)
+        _get_executor().submit(close_cursor)
+
+def close():
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=True)
+        _EXECUTOR = None
+
+# Da incrementare a ogni modifica di _create_schema (tabelle, colonne, seed, migrazioni):
+# con il marker in schema_meta già a questa versione init_db non esegue alcun DDL
+SCHEMA_VERSION = 2
+
+def schema_version(conn) -> Optional[int]:
+    try:
+        row = conn.execute("SELECT version FROM schema_meta WHERE key = 'schema'").fetchone()
+    except duckdb.CatalogException:
+        return None
+    return row[0] if row else None
+
 def init_db():
     conn = get_conn()
+    if schema_version(conn) == SCHEMA_VERSION:
+        return
+    _create_schema(conn)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_meta (
+            key TEXT PRIMARY KEY,
+            version BIGINT,
+            updated_at TIMESTAMP DEFAULT now()
+        );
+    """)
+    conn.execute("INSERT OR REPLACE INTO schema_meta (key, version) VALUES ('schema', ?)", [SCHEMA_VERSION])
+    if not os.getenv("MOTHERDUCK_TOKEN"):
+        # DDL nel file e non nel WAL: il replay di CREATE + ALTER della stessa tabella
+        # fallisce (DuckDB 1.x) se il processo termina prima di un checkpoint
+        conn.execute("CHECKPOINT")
+
+def _create_schema(conn):
+    """Tabelle, migrazioni idempotenti e seed del catalogo (solo se vuoto)."""
     conn.execute("""
         CREATE TABLE IF NOT EXISTS products (
             id TEXT PRIMARY KEY,
@@ -42,6 +227,11 @@ def init_db():
             available BOOLEAN
         );
     """)
+    # Colonne del feed ACP esteso, assenti nei DB creati con lo schema iniziale
+    for col in PRODUCT_EXTRA_COLUMNS:
+        conn.execute(f"ALTER TABLE products ADD COLUMN IF NOT EXISTS {col} TEXT")
+    if any(r[1] == "image" for r in conn.execute("PRAGMA table_info('products')").fetchall()):
+        conn.execute("UPDATE products SET image_url = image WHERE image_url IS NULL AND image IS NOT NULL")
     conn.execute("""
         CREATE TABLE IF NOT EXISTS checkout_sessions (
             id TEXT PRIMARY KEY,
@@ -67,6 +257,38 @@ def init_db():
             created_at TIMESTAMP DEFAULT now()
         );
     """)
+    # Carrelli normalizzati: niente JSON da decodificare riga per riga in route e report
+    for col in TOTALS_COLUMNS:
+        conn.execute(f"ALTER TABLE checkout_sessions ADD COLUMN IF NOT EXISTS {col} BIGINT")
+    # Incrementata a ogni scrittura: guard della cache delle sessioni (app.sessions)
+    conn.execute("ALTER TABLE checkout_sessions ADD COLUMN IF NOT EXISTS revision BIGINT DEFAULT 0")
+    # Paese dell'acquirente (buyer.address.country): aliquota IVA di app.pricing
+    conn.execute("ALTER TABLE checkout_sessions ADD COLUMN IF NOT EXISTS buyer_country TEXT")
+    # PaymentMethod agganciato in create e ultimo stato noto del PI (create, conferma, webhook):
+    # la conferma non deve rileggere il PI da Stripe. NULL = sessione creata prima delle colonne
+    conn.execute("ALTER TABLE checkout_sessions ADD COLUMN IF NOT EXISTS payment_method_id TEXT")
+    conn.execute("ALTER TABLE checkout_sessions ADD COLUMN IF NOT EXISTS pi_status TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS session_items (
+            session_id TEXT,
+            position INTEGER,
+            product_id TEXT,
+            quantity INTEGER,
+            unit_price_minor BIGINT,
+            created_at TIMESTAMP DEFAULT now()
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id TEXT,
+            position INTEGER,
+            product_id TEXT,
+            quantity INTEGER,
+            unit_price_minor BIGINT,
+            created_at TIMESTAMP DEFAULT now()
+        );
+    """)
+    backfill_line_items(conn)
     conn.execute("""
         CREATE TABLE IF NOT EXISTS idempotency (
             key TEXT PRIMARY KEY,
@@ -85,26 +307,188 @@ def init_db():
         );
     """)
 
-    # Seed products from JSON if empty
+    # Rollup vendite mantenute in modo incrementale da app.analytics (high-water mark su created_at)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day DATE,
+            currency TEXT,
+            orders BIGINT,
+            revenue_minor BIGINT,
+            PRIMARY KEY (day, currency)
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_product_daily (
+            day DATE,
+            product_id TEXT,
+            currency TEXT,
+            orders BIGINT,
+            units BIGINT,
+            revenue_minor BIGINT,
+            PRIMARY KEY (day, product_id, currency)
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_daily (
+            day DATE PRIMARY KEY,
+            sessions BIGINT
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            source TEXT PRIMARY KEY,
+            high_water TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT now()
+        );
+    """)
+
+    # Regole di prezzo di app.pricing (ricaricate dopo bump_catalog_version); seed = regole storiche
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pricing_promos (
+            code TEXT PRIMARY KEY,
+            percent_off DOUBLE,
+            min_subtotal_minor BIGINT DEFAULT 0,
+            active BOOLEAN DEFAULT true
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pricing_tax_rates (
+            country TEXT PRIMARY KEY,   -- ISO 3166-1 alpha-2, '*' = default
+            rate DOUBLE
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pricing_shipping (
+            currency TEXT,
+            below_minor BIGINT,         -- si applica se subtotal < below_minor (scaglione più basso)
+            fee_minor BIGINT,
+            PRIMARY KEY (currency, below_minor)
+        );
+    """)
+    for table, row in (("pricing_promos", "('WELCOME10', 0.10, 0, true)"),
+                       ("pricing_tax_rates", "('*', 0.22)"),
+                       ("pricing_shipping", "('EUR', 5000, 500)")):
+        conn.execute(f"INSERT INTO {table} SELECT * FROM (VALUES {row}) WHERE NOT EXISTS (SELECT 1 FROM {table})")
+
+    # Versione del catalogo: watermark per snapshot/cache lato applicazione
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            key TEXT PRIMARY KEY,
+            version BIGINT,
+            updated_at TIMESTAMP DEFAULT now()
+        );
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_meta (key, version) VALUES ('products', 1)")
+
+    # Seed products from JSON if empty (stesso percorso bulk di `python -m app.ingest`)
     count = conn.execute("SELECT count(*) FROM products").fetchone()[0]
     if count == 0:
-        path = pathlib.Path(__file__).parent / "data" / "product_feed.json"
-        with open(path, "r", encoding="utf-8") as f:
-            feed = json.load(f)
-        for p in feed.get("products", []):
-            conn.execute(
-                "INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?)",
-                [p["id"], p["title"], p.get("description",""), float(p["price"]), p.get("currency","eur"),
-                 p.get("image"), bool(p.get("available", True))]
-            )
-
-def get_idempotent_response(key: Optional[str], endpoint: str):
+        from .ingest import ingest_feed
+        ingest_feed(conn, str(pathlib.Path(__file__).parent / "data" / "product_feed.json"))
+
+_ITEMS_JSON_TYPE = '[{"product_id":"VARCHAR","quantity":"INTEGER"}]'
+
+def backfill_line_items(conn):
+    """
+    Migra i carrelli salvati come items_json/totals_json nelle tabelle normalizzate.
+    Idempotente: tocca solo le righe non ancora migrate. Il prezzo unitario delle
+    righe migrate resta NULL (il JSON non lo conteneva).
+    """
+    for table, key, items in (("checkout_sessions", "session_id", "session_items"), ("orders", "order_id", "order_items")):
+        conn.execute(f"""
+            INSERT INTO {items} ({key}, position, product_id, quantity, created_at)
+            SELECT t.id, u.pos - 1, u.item.product_id, u.item.quantity, t.created_at
+            FROM {table} t, LATERAL (
+                SELECT unnest(l) AS item, generate_subscripts(l, 1) AS pos
+                FROM (SELECT from_json(t.items_json, '{_ITEMS_JSON_TYPE}') AS l)
+            ) u
+            WHERE t.items_json IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM {items} x WHERE x.{key} = t.id)
+        """)
+    sets = ", ".join(f"{col} = CAST(totals_json->>'{col}' AS BIGINT)" for col in TOTALS_COLUMNS)
+    conn.execute(f"UPDATE checkout_sessions SET {sets} WHERE grand_total_minor IS NULL AND totals_json IS NOT NULL")
+
+def export_catalog(cur, directory: str) -> tuple[int, Any, str]:
+    """Nel writer: snapshot Parquet del catalogo per la versione corrente (riusato se già esportato)."""
+    cur.execute("BEGIN TRANSACTION")
+    try:
+        version, updated_at = cur.execute("SELECT version, updated_at FROM catalog_meta WHERE key = 'products'").fetchone()
+        path = os.path.join(directory, f"catalog-{version}.parquet")
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            cur.execute(f"COPY (SELECT * FROM products) TO '{tmp}' (FORMAT parquet)")
+            os.replace(tmp, path)
+            # i worker possono ancora leggere la versione precedente: si tengono le ultime due
+            for old in sorted(pathlib.Path(directory).glob("catalog-*.parquet"), key=lambda p: p.stat().st_mtime)[:-2]:
+                old.unlink(missing_ok=True)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return version, updated_at, path
+
+_catalog_version: Optional[int] = None
+
+def _sync_catalog(cur) -> bool:
+    """Nel worker: ricarica lo snapshot se la versione del writer è cambiata."""
+    global _catalog_version
+    version = _remote(_sql, ("one", "SELECT version FROM catalog_meta WHERE key = 'products'", []))[0]
+    if version == _catalog_version:
+        return False
+    version, updated_at, path = _remote(export_catalog, (DB_SNAPSHOT_DIR,))
+    cur.execute("BEGIN TRANSACTION")
+    cur.execute("CREATE OR REPLACE TABLE products AS SELECT * FROM read_parquet(?)", [path])
+    cur.execute("CREATE OR REPLACE TABLE catalog_meta (key TEXT PRIMARY KEY, version BIGINT, updated_at TIMESTAMP)")
+    cur.execute("INSERT INTO catalog_meta VALUES ('products', ?, ?)", [version, updated_at])
+    cur.execute("COMMIT")
+    _catalog_version = version
+    return True
+
+def init_worker():
+    """Avvio di un worker: primo snapshot del catalogo (al posto di init_db, che esegue il writer)."""
+    _sync_catalog(get_conn())
+
+async def sync_catalog():
+    """Nel worker, prima di rileggere catalog_meta: allinea lo snapshot e invalida le cache."""
+    if DB_ROLE != "worker":
+        return
+    if await run(_sync_catalog, name="catalog.sync", catalog=True):
+        for listener in CATALOG_LISTENERS:
+            listener()
+
+def bump_catalog_version(conn=None):
+    """Da chiamare dopo ogni ricarica/modifica del catalogo prodotti."""
+    conn = conn or get_conn()
+    conn.execute("UPDATE catalog_meta SET version = version + 1, updated_at = now() WHERE key = 'products'")
+    for listener in CATALOG_LISTENERS:
+        listener()
+
+async def get_idempotent_response(key: Optional[str], endpoint: str, ttl_seconds: Optional[int] = None):
     if not key:
         return None
-    conn = get_conn()
-    row = conn.execute("SELECT response_json FROM idempotency WHERE key = ? AND endpoint = ?", [key, endpoint]).fetchone()
+    sql = "SELECT response_json FROM idempotency WHERE key = ? AND endpoint = ?"
+    params: list = [key, endpoint]
+    if ttl_seconds is not None:
+        sql += " AND created_at >= CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND"
+        params.append(ttl_seconds)
+    row = await fetchone(sql, params, name="idempotency.get")
     return row[0] if row else None
 
-def save_idempotent_response(key: str, endpoint: str, response_json: str):
-    conn = get_conn()
-    conn.execute("INSERT OR REPLACE INTO idempotency (key, endpoint, response_json) VALUES (?, ?, ?)", [key, endpoint, response_json])
+async def save_idempotent_response(key: str, endpoint: str, response_json: str, ttl_seconds: int) -> str:
+    """Vince la prima risposta salvata: una riga ancora valida non viene sovrascritta, una scaduta
+    (non ancora eliminata dallo sweep) sì, con created_at nuovo. Restituisce la risposta che ha vinto."""
+    await execute(
+        "INSERT INTO idempotency (key, endpoint, response_json) VALUES (?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET endpoint = excluded.endpoint, response_json = excluded.response_json, "
+        "created_at = now() WHERE idempotency.created_at < CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND",
+        [key, endpoint, response_json, ttl_seconds], name="idempotency.save",
+    )
+    stored = await get_idempotent_response(key, endpoint)
+    return stored if stored is not None else response_json
+
+async def purge_idempotency(ttl_seconds: int) -> int:
+    row = await fetchone(
+        "DELETE FROM idempotency WHERE created_at < CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND", [ttl_seconds],
+        name="idempotency.purge",
+    )
+    return row[0] if row else 0
@@ -0,0 +1,164 @@
+import asyncio, json, logging, os
+from collections import OrderedDict
+from typing import Optional
+
+from . import db, sessions
+
+logger = logging.getLogger("acp.events")
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_BATCH_DELAY_MS = float(os.getenv("WEBHOOK_BATCH_DELAY_MS", "50"))
+
+# Transizioni di checkout_sessions.status per gli eventi PaymentIntent
+PI_EVENT_STATUS = {
+    "payment_intent.succeeded": "succeeded",
+    "payment_intent.payment_failed": "failed",
+    "payment_intent.canceled": "failed",
+    "payment_intent.requires_action": "requires_action",
+}
+
+
+class WebhookPipeline:
+    """
+    Coda in-process degli eventi Stripe: l'endpoint verifica la firma, accoda e
+    risponde subito; un worker deduplica per event id, salva in outbound_events
+    e applica le transizioni payment_intent.* in transazioni a blocchi.
+    """
+
+    def __init__(self, maxsize: int = WEBHOOK_QUEUE_SIZE, recent: int = 50_000):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._recent: OrderedDict[str, None] = OrderedDict()
+        self._recent_max = recent
+        self._worker: Optional[asyncio.Task] = None
+        self.processed = 0
+
+    def _remember(self, event_id: str):
+        self._recent[event_id] = None
+        while len(self._recent) > self._recent_max:
+            self._recent.popitem(last=False)
+
+    def enqueue(self, event: dict) -> bool:
+        """False se la coda è piena (il chiamante risponde 503 e Stripe ritenta)."""
+        event_id = event.get("id")
+        if event_id in self._recent:
+            return True
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            return False
+        self._remember(event_id)
+        return True
+
+    async def _next_batch(self) -> list[dict]:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + WEBHOOK_BATCH_DELAY_MS / 1000.0
+        while len(batch) < WEBHOOK_BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                applied = await db.run(apply_events, batch)
+                self.processed += applied
+                sessions.store.invalidate_payment_intents(payment_intent_ids(batch))
+            except Exception:
+                logger.exception("webhook batch failed (%d events)", len(batch))
+                for ev in batch:
+                    self._recent.pop(ev.get("id"), None)   # consenti il retry di Stripe
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("webhook queue not drained: %d events left", self.queue.qsize())
+        self._worker.cancel()
+        self._worker = None
+
+
+def payment_intent_ids(batch: list[dict]) -> set[str]:
+    return {((ev.get("data") or {}).get("object") or {}).get("id") for ev in batch
+            if ev.get("type", "").startswith("payment_intent.")} - {None}
+
+
+def _payment_method_id(obj: dict) -> str | None:
+    pm = obj.get("payment_method")
+    return pm.get("id") if isinstance(pm, dict) else pm
+
+
+def apply_events(cur, batch: list[dict]) -> int:
+    """Nel pool DB: una transazione per blocco. Restituisce gli eventi nuovi applicati."""
+    events: dict[str, dict] = {}
+    for ev in batch:
+        if ev.get("id"):
+            events.setdefault(ev["id"], ev)
+    if not events:
+        return 0
+
+    cur.execute("BEGIN TRANSACTION")
+    try:
+        ids = list(events)
+        placeholders = ", ".join("?" for _ in ids)
+        seen = {r[0] for r in cur.execute(f"SELECT id FROM outbound_events WHERE id IN ({placeholders})", ids).fetchall()}
+        fresh = [ev for eid, ev in events.items() if eid not in seen]
+        # Ordine di creazione Stripe: l'ultima transizione per PI vince
+        fresh.sort(key=lambda ev: ev.get("created") or 0)
+
+        for ev in fresh:
+            obj = (ev.get("data") or {}).get("object") or {}
+            pi_id = obj.get("id") if ev.get("type", "").startswith("payment_intent.") else None
+            cur.execute(
+                "INSERT INTO outbound_events (id, session_id, type, payload_json) "
+                "VALUES (?, (SELECT id FROM checkout_sessions WHERE payment_intent_id = ? LIMIT 1), ?, ?)",
+                [ev["id"], pi_id, ev.get("type"), json.dumps(ev)],
+            )
+            if not pi_id:
+                continue
+            status = PI_EVENT_STATUS.get(ev.get("type"))
+            # stato del PI (e PaymentMethod) aggiornati da ogni evento payment_intent.*: la conferma
+            # li legge dalla sessione. succeeded è terminale: eventi fuori ordine non lo sovrascrivono.
+            # Il marker 'confirming' (/complete async in corso) cede solo a un esito della conferma
+            cur.execute(
+                "UPDATE checkout_sessions SET status = coalesce(?, status), "
+                "pi_status = CASE WHEN pi_status = 'confirming' AND ? IS NULL THEN pi_status ELSE coalesce(?, pi_status) END, "
+                "payment_method_id = coalesce(?, payment_method_id), revision = revision + 1, updated_at = now() "
+                "WHERE payment_intent_id = ? AND status <> 'succeeded'",
+                [status, status, obj.get("status"), _payment_method_id(obj), pi_id],
+            )
+            if status == "succeeded":
+                cur.execute("""
+                    INSERT INTO orders (id, payment_intent_id, buyer_email, amount_minor, currency)
+                    SELECT uuid()::TEXT, s.payment_intent_id, s.buyer_email, ?, s.currency
+                    FROM checkout_sessions s
+                    WHERE s.payment_intent_id = ?
+                      AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.payment_intent_id = ?)
+                    LIMIT 1
+                """, [obj.get("amount_received") or obj.get("amount"), pi_id, pi_id])
+                cur.execute(db.ORDER_ITEMS_FROM_SESSION_SQL, [pi_id])
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    if fresh:
+        logger.info("webhook batch applied=%d duplicates=%d", len(fresh), len(events) - len(fresh))
+    return len(fresh)
+
+
+pipeline = WebhookPipeline()
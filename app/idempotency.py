@@ -0,0 +1,124 @@
+import asyncio, logging, os, time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Type, TypeVar
+
+from pydantic import BaseModel
+
+from . import db
+
+logger = logging.getLogger("acp.idempotency")
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_SWEEP_SECONDS = int(os.getenv("IDEMPOTENCY_SWEEP_SECONDS", "300"))
+
+M = TypeVar("M", bound=BaseModel)
+
+
+class IdempotencyStore:
+    """
+    Due livelli davanti alla tabella idempotency: LRU+TTL in memoria, poi DB.
+    Le richieste concorrenti con la stessa chiave attendono la prima (single-flight)
+    invece di ripetere l'operazione (es. creare un secondo PaymentIntent).
+    """
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL_SECONDS, size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._cache: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+    def _cache_get(self, k: tuple[str, str]) -> Optional[str]:
+        hit = self._cache.get(k)
+        if hit is None:
+            return None
+        expires_at, body = hit
+        if expires_at < time.monotonic():
+            del self._cache[k]
+            return None
+        self._cache.move_to_end(k)
+        return body
+
+    def _cache_put(self, k: tuple[str, str], body: str):
+        self._cache[k] = (time.monotonic() + self.ttl, body)
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    async def get(self, key: str, endpoint: str) -> Optional[str]:
+        k = (endpoint, key)
+        body = self._cache_get(k)
+        if body is None:
+            body = await db.get_idempotent_response(key, endpoint, self.ttl)
+            if body is not None:
+                self._cache_put(k, body)
+        return body
+
+    async def save(self, key: str, endpoint: str, body: str) -> str:
+        """Salva body se la chiave è libera; restituisce la risposta salvata per prima (es. da un altro worker)."""
+        body = await db.save_idempotent_response(key, endpoint, body, self.ttl)
+        self._cache_put((endpoint, key), body)
+        return body
+
+    async def run(self, key: str, endpoint: str, model: Type[M], fn: Callable[[], Awaitable[M]]) -> M:
+        """Risposta salvata per (key, endpoint), altrimenti esegue fn una sola volta."""
+        k = (endpoint, key)
+        cached = await self.get(key, endpoint)
+        if cached is None:
+            # Nessun await da qui alla registrazione: il controllo è atomico sull'event loop
+            fut = self._inflight.get(k)
+            if fut is not None:
+                return model.model_validate_json(await asyncio.shield(fut))
+            cached = self._cache_get(k)
+        if cached is not None:
+            return model.model_validate_json(cached)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[k] = fut
+        try:
+            result = await fn()
+            body = result.model_dump_json()
+            stored = await self.save(key, endpoint, body)
+            fut.set_result(stored)
+            return result if stored == body else model.model_validate_json(stored)
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # evita "exception was never retrieved" se nessuno attende
+            raise
+        finally:
+            self._inflight.pop(k, None)
+
+    async def sweep(self) -> int:
+        """Elimina le chiavi scadute (created_at) da tabella e cache."""
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in self._cache.items() if exp < now]:
+            del self._cache[k]
+        return await db.purge_idempotency(self.ttl)
+
+
+store = IdempotencyStore()
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_SWEEP_SECONDS)
+        try:
+            purged = await store.sweep()
+            if purged:
+                logger.info("idempotency sweep purged=%d", purged)
+        except Exception:
+            logger.exception("idempotency sweep failed")
+
+
+def start_sweeper():
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.get_running_loop().create_task(_sweep_loop())
+
+
+async def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        _sweeper = None
@@ -0,0 +1,156 @@
+"""
+Ingestione bulk del catalogo prodotti da feed JSON / NDJSON / CSV / Parquet.
+
+Il feed viene letto dai reader nativi di DuckDB (streaming, a blocchi) in una
+tabella di staging temporanea e applicato con un unico upsert diff-based:
+solo le righe nuove o cambiate vengono scritte; con un feed completo i SKU
+spariti vengono marcati non disponibili.
+
+    python -m app.ingest feed.ndjson [--format ndjson] [--partial]
+"""
+import argparse, logging, pathlib, time
+
+from . import db
+
+logger = logging.getLogger("acp.ingest")
+
+READERS = {
+    "json": "read_json_auto(?)",
+    "ndjson": "read_json_auto(?, format = 'newline_delimited')",
+    "csv": "read_csv_auto(?, header = true)",
+    "parquet": "read_parquet(?)",
+}
+
+# Colonne del catalogo ricavabili dal feed: nome -> espressione sul feed grezzo.
+# Le colonne che il feed non porta restano fuori, così l'upsert non le azzera.
+def _projection(cols: set[str]) -> dict[str, str]:
+    def c(name, cast="VARCHAR"):
+        return f"CAST({name} AS {cast})" if name in cols else None
+
+    image_url = [e for e in (c("image_url"), c("image")) if e]
+    proj = {
+        "id": c("id"),
+        "title": c("title"),
+        "description": c("description") and f"COALESCE({c('description')}, '')",
+        "price": c("price", "DOUBLE"),
+        "currency": c("currency") and f"COALESCE({c('currency')}, 'eur')",
+        "image": c("image") or c("image_url"),
+        "image_url": image_url and f"COALESCE({', '.join(image_url)})",
+        # un SKU presente nel feed è disponibile salvo indicazione contraria
+        "available": f"COALESCE({c('available', 'BOOLEAN') or 'NULL'}, true)",
+        "brand": c("brand"),
+        "category": c("category"),
+        "size": c("size"),
+        "color": c("color"),
+        "return_policy": c("return_policy"),
+    }
+    return {name: expr for name, expr in proj.items() if expr}
+
+
+def detect_format(path: str) -> str:
+    suffixes = [s.lower() for s in pathlib.Path(path).suffixes if s.lower() != ".gz"]
+    ext = suffixes[-1] if suffixes else ""
+    if ext in (".ndjson", ".jsonl"):
+        return "ndjson"
+    if ext == ".csv":
+        return "csv"
+    if ext in (".parquet", ".pq"):
+        return "parquet"
+    return "json"
+
+
+def _stage(conn, path: str, fmt: str) -> int:
+    conn.execute(f"CREATE OR REPLACE TEMP TABLE feed_raw AS SELECT * FROM {READERS[fmt]}", [path])
+    cols = {r[0] for r in conn.execute("DESCRIBE feed_raw").fetchall()}
+    if cols == {"products"}:
+        # Formato product_feed.json: {"products": [ {...}, ... ]}
+        conn.execute("CREATE OR REPLACE TEMP TABLE feed_rows AS SELECT unnest(products, recursive := true) FROM feed_raw")
+    else:
+        conn.execute("CREATE OR REPLACE TEMP TABLE feed_rows AS SELECT * FROM feed_raw")
+    conn.execute("DROP TABLE feed_raw")
+    cols = {r[0] for r in conn.execute("DESCRIBE feed_rows").fetchall()}
+
+    proj = _projection(cols)
+    if "id" not in proj or "price" not in proj:
+        raise ValueError(f"feed {path} must provide at least 'id' and 'price' (found: {sorted(cols)})")
+    targets = {r[1] for r in conn.execute("PRAGMA table_info('products')").fetchall()}
+    select = ",\n            ".join(f"{expr} AS {name}" for name, expr in proj.items() if name in targets)
+    conn.execute(f"""
+        CREATE OR REPLACE TEMP TABLE products_staging AS
+        SELECT
+            {select}
+        FROM feed_rows
+        WHERE {proj['id']} IS NOT NULL AND {proj['price']} IS NOT NULL
+        QUALIFY row_number() OVER (PARTITION BY {proj['id']}) = 1
+    """)
+    conn.execute("DROP TABLE feed_rows")
+    return conn.execute("SELECT count(*) FROM products_staging").fetchone()[0]
+
+
+def ingest_feed(conn, path: str, fmt: str | None = None, partial: bool = False) -> dict:
+    """
+    Carica il feed in products. partial=True: feed incrementale, i SKU assenti
+    non vengono toccati. Restituisce le statistiche dell'esecuzione.
+    """
+    fmt = fmt or detect_format(path)
+    t0 = time.perf_counter()
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        rows = _stage(conn, path, fmt)
+        cols = [r[0] for r in conn.execute("DESCRIBE products_staging").fetchall()]
+        data_cols = [c for c in cols if c != "id"]
+        changed = " OR ".join(f"products.{c} IS DISTINCT FROM EXCLUDED.{c}" for c in data_cols) or "false"
+
+        inserted = conn.execute(
+            "SELECT count(*) FROM products_staging s WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.id = s.id)"
+        ).fetchone()[0]
+        written = conn.execute(f"""
+            INSERT INTO products ({', '.join(cols)})
+            SELECT {', '.join(cols)} FROM products_staging
+            ON CONFLICT (id) DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in data_cols)}
+            WHERE {changed}
+        """).fetchone()[0]
+
+        unavailable = 0
+        if not partial:
+            unavailable = conn.execute("""
+                UPDATE products SET available = false
+                WHERE available IS DISTINCT FROM false
+                  AND id NOT IN (SELECT id FROM products_staging)
+            """).fetchone()[0]
+        conn.execute("DROP TABLE products_staging")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if written or unavailable:
+        db.bump_catalog_version(conn)
+    seconds = time.perf_counter() - t0
+    stats = {
+        "rows": rows,
+        "inserted": inserted,
+        "updated": written - inserted,
+        "unavailable": unavailable,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds) if seconds else rows,
+    }
+    logger.info("catalog ingest %s %s", path, stats)
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Bulk-load a product feed into the catalog.")
+    ap.add_argument("path", help="Feed file (JSON, NDJSON, CSV or Parquet; .gz supported for JSON/CSV)")
+    ap.add_argument("--format", choices=sorted(READERS), default=None)
+    ap.add_argument("--partial", action="store_true", help="Incremental feed: do not mark missing SKUs unavailable")
+    args = ap.parse_args()
+
+    db.init_db()
+    s = ingest_feed(db.get_conn(), args.path, args.format, args.partial)
+    print(f"rows={s['rows']} inserted={s['inserted']} updated={s['updated']} unavailable={s['unavailable']} "
+          f"in {s['seconds']}s ({s['rows_per_sec']} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+IPC tra i worker HTTP e il processo writer (modalità multi-worker, python -m app.serve).
+
+Un file DuckDB locale può essere aperto da un solo processo: il writer lo tiene
+aperto e serve su un socket Unix le chiamate db.run/execute/fetch* dei worker.
+Frame = lunghezza (4 byte) + pickle; il socket vive in una directory privata
+(0700) dello stesso utente, quindi il pickle non attraversa confini di fiducia.
+"""
+import logging, os, pickle, socket, socketserver, struct
+from typing import Any, Callable
+
+logger = logging.getLogger("acp.ipc")
+
+_HEADER = struct.Struct("!I")
+
+
+def send_msg(sock: socket.socket, obj: Any):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_msg(sock: socket.socket) -> Any:
+    return pickle.loads(_recv_frame(sock))
+
+
+def _recv_frame(sock: socket.socket) -> bytes:
+    (n,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return _recv_exact(sock, n)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("writer connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def connect(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def call(sock: socket.socket, fn: Callable, args: tuple) -> Any:
+    """Esegue fn(cursor, *args) nel writer; le eccezioni DuckDB vengono rilanciate qui."""
+    send_msg(sock, (fn, args))
+    ok, value = recv_msg(sock)
+    if not ok:
+        raise value
+    return value
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # Un thread per connessione: ogni thread del pool di un worker ha la sua
+    def handle(self):
+        execute = self.server.execute
+        while True:
+            try:
+                frame = _recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                # fn deve essere importabile anche nel writer (funzione di modulo)
+                fn, args = pickle.loads(frame)
+                reply = (True, execute(fn, args))
+            except Exception as e:
+                reply = (False, e)
+            try:
+                send_msg(self.request, reply)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                send_msg(self.request, (False, RuntimeError(f"unpicklable writer reply: {e!r}")))
+
+
+class WriterServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, execute: Callable[[Callable, tuple], Any]):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.execute = execute
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o600)
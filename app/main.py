@@ -1,21 +1,34 @@
 # app/main.py
-import os
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.openapi.utils import get_openapi
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
+from fastapi.responses import Response
 
 from .routes.products import router as products_router
-from .routes.checkout import router as checkout_router
+from .routes.checkout import router as checkout_router, drain_completions
 from .routes.webhooks import router as webhooks_router
-from .db import init_db
+from .routes.analytics import router as analytics_router
+from .db import init_db, get_conn, close as close_db
+from . import admission, analytics, catalog, db, idempotency, maintenance, metrics, openapi, writes
+from .events import pipeline as webhook_pipeline
+from .payments import stripe_client
 
 app = FastAPI(
     title="ACP-style Merchant API",
     version="0.3.0",
     description="ACP-like checkout API for GPT Actions demos. Public OpenAPI at /openapi.json",
+    # /openapi.json, /docs e /redoc montati sotto: lo schema è servito come byte pronti (app.openapi)
+    openapi_url=None, docs_url=None, redoc_url=None,
 )
 
-# CORS: per demo lasciamo tutto aperto (stringi in produzione)
+# Ultimo aggiunto = più esterno. Ordine dall'esterno: CORS, metriche, ammissione, app
+# 429/503 per chiave e per budget (/products, /checkout/*) prima del routing; interno alle metriche,
+# così anche i rifiuti finiscono negli istogrammi
+app.add_middleware(admission.AdmissionMiddleware)
+# Latenze per route/status (+ profiler delle richieste lente se PROFILE_SLOW_MS > 0)
+app.add_middleware(metrics.MetricsMiddleware)
+# CORS: per demo lasciamo tutto aperto (stringi in produzione). Più esterno di tutti:
+# anche i 429/503 dell'ammissione portano gli header CORS e il browser li vede
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -26,50 +39,71 @@ app.add_middleware(
 
 @app.on_event("startup")
 def startup():
-    init_db()
-
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
+    stripe_client.check_config()   # chiave Stripe mancante: meglio non partire che 500 al primo checkout
+    if db.DB_ROLE == "worker":
+        # schema e migrazioni le applica il writer (app.serve): qui solo lo snapshot del catalogo
+        db.init_worker()
+    else:
+        init_db()
+    catalog.schema.load(get_conn())
 
-    schema = get_openapi(
-        title=app.title,
-        version=app.version,
-        description=app.description,
-        routes=app.routes,
-    )
+@app.on_event("startup")
+async def start_background_tasks():
+    webhook_pipeline.start()
+    if metrics.profiler is not None:
+        metrics.profiler.start()
+    if db.DB_ROLE != "worker":
+        # in multi-worker li esegue una sola volta il processo writer
+        idempotency.start_sweeper()
+        analytics.start_refresher()
+        maintenance.start()
 
-    # ✅ 1) Inserisci il server dinamico da ENV (deve essere https)
-    base = os.getenv("PUBLIC_BASE_URL", "").strip()
-    if base and base.startswith("https://"):
-        schema["servers"] = [{"url": base}]
-    else:
-        # fallback placeholder (verrà rifiutato dalle Actions se usato)
-        schema["servers"] = [{"url": "https://replace-me.example.com"}]
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await webhook_pipeline.stop()
+    await analytics.stop_refresher()
+    await idempotency.stop_sweeper()
+    await maintenance.stop()
+    await drain_completions()   # conferme /complete in background (modalità async)
+    await writes.committer.stop()
+    await stripe_client.close()
 
-    # ✅ 2) Aggiungi security scheme per API Key su header X-API-Key
-    components = schema.setdefault("components", {})
-    security_schemes = components.setdefault("securitySchemes", {})
-    security_schemes["ApiKeyAuth"] = {
-        "type": "apiKey",
-        "in": "header",
-        "name": "X-API-Key",
-        "description": "Provide your API key in the X-API-Key header."
-    }
-    # Applica la security **globale** (puoi toglierla se la definisci endpoint-by-endpoint)
-    schema["security"] = [{"ApiKeyAuth": []}]
+@app.on_event("shutdown")
+def shutdown():
+    close_db()
 
-    app.openapi_schema = schema
+def custom_openapi():
+    if app.openapi_schema:
+        return app.openapi_schema
+    app.openapi_schema = openapi.build_schema(app)
     return app.openapi_schema
 
 # monta lo schema OpenAPI dinamico
 app.openapi = custom_openapi
+openapi_document = openapi.OpenAPIDocument(app)
+
+@app.get("/openapi.json", include_in_schema=False)
+async def openapi_json(request: Request):
+    return openapi_document.response(request)
+
+@app.get("/docs", include_in_schema=False)
+async def swagger_ui():
+    return get_swagger_ui_html(openapi_url="/openapi.json", title=f"{app.title} - Swagger UI")
+
+@app.get("/redoc", include_in_schema=False)
+async def redoc():
+    return get_redoc_html(openapi_url="/openapi.json", title=f"{app.title} - ReDoc")
 
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 # Routers
 app.include_router(products_router, prefix="")
 app.include_router(checkout_router, prefix="")
 app.include_router(webhooks_router, prefix="")
+app.include_router(analytics_router, prefix="")
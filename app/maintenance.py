@@ -0,0 +1,178 @@
+"""
+Manutenzione periodica delle tabelle calde (task in background, come lo sweeper idempotency):
+
+1. scadenza: sessioni ancora aperte e ferme da SESSION_TTL_SECONDS -> status 'expired';
+2. archivio: sessioni terminali (con le loro session_items) e outbound_events più vecchi
+   di ARCHIVE_AFTER_SECONDS copiati in Parquet partizionato per giorno di creazione
+   (COPY ... PARTITION_BY) sotto ARCHIVE_DIR e cancellati, nella stessa transazione;
+3. viste <tabella>_all: righe calde UNION ALL archivio, per interrogare lo storico.
+
+Ogni scrittura incrementa revision: una sessione in cache altrove fallisce il guard
+(app.sessions) e viene riletta. La tabella idempotency ha già il suo sweeper (TTL).
+
+    python -m app.maintenance     # una passata, a server fermo (come app.ingest)
+"""
+import asyncio, glob, json, logging, os, time, uuid
+from typing import Optional
+
+from . import db, sessions
+
+logger = logging.getLogger("acp.maintenance")
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+ARCHIVE_AFTER_SECONDS = int(os.getenv("ARCHIVE_AFTER_SECONDS", str(30 * 86400)))
+ARCHIVE_DIR = os.path.abspath(os.getenv("ARCHIVE_DIR", "archive"))
+MAINTENANCE_SECONDS = float(os.getenv("MAINTENANCE_SECONDS", "3600"))
+
+OPEN_STATUSES = ("requires_confirmation", "requires_action")
+TERMINAL_STATUSES = ("succeeded", "failed", "expired")
+
+# Sessioni archiviabili: terminali, ferme da prima del cutoff ($1) e già contate
+# dalle rollup analytics (created_at entro l'high-water mark, $2)
+_ARCHIVABLE_SESSIONS = f"""
+    SELECT id FROM checkout_sessions
+    WHERE status IN ({', '.join(f"'{s}'" for s in TERMINAL_STATUSES)})
+      AND updated_at < $1 AND created_at <= $2
+"""
+
+# tabella -> righe da archiviare; session_items prima delle sessioni a cui appartiene
+ARCHIVE_WHERE = {
+    "session_items": f"session_id IN ({_ARCHIVABLE_SESSIONS})",
+    "checkout_sessions": f"id IN ({_ARCHIVABLE_SESSIONS})",
+    "outbound_events": "created_at < $1",
+}
+
+
+def expire_sessions(cur, ttl_seconds: int) -> list[str]:
+    rows = cur.execute(f"""
+        UPDATE checkout_sessions SET status = 'expired', revision = revision + 1, updated_at = now()
+        WHERE status IN ({', '.join('?' for _ in OPEN_STATUSES)})
+          AND updated_at < CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND
+        RETURNING id
+    """, [*OPEN_STATUSES, ttl_seconds]).fetchall()
+    return [r[0] for r in rows]
+
+
+def _archive_files(directory: str, table: str, run_id: Optional[str] = None) -> list[str]:
+    return glob.glob(os.path.join(directory, table, "*", f"{run_id or ''}*.parquet"))
+
+
+def archive(cur, directory: str, older_than_seconds: int) -> tuple[dict[str, int], list[str]]:
+    """
+    Nel pool DB: COPY in Parquet + DELETE per tabella in un'unica transazione.
+    Se qualcosa fallisce i file di questa passata (prefisso run_id) vengono rimossi.
+    Restituisce (righe archiviate per tabella, id delle sessioni archiviate).
+    """
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    cur.execute("BEGIN TRANSACTION")
+    try:
+        cutoff = cur.execute("SELECT CAST(now() AS TIMESTAMP) - ? * INTERVAL 1 SECOND", [older_than_seconds]).fetchone()[0]
+        mark = cur.execute("SELECT high_water FROM rollup_state WHERE source = 'checkout_sessions'").fetchone()
+        params = [cutoff, (mark and mark[0]) or "1970-01-01 00:00:00"]
+        session_ids = [r[0] for r in cur.execute(_ARCHIVABLE_SESSIONS, params).fetchall()]
+        counts = {}
+        for table, where in ARCHIVE_WHERE.items():
+            table_params = params if "$2" in where else params[:1]
+            n = cur.execute(f"SELECT count(*) FROM {table} WHERE {where}", table_params).fetchone()[0]
+            if n:
+                os.makedirs(os.path.join(directory, table), exist_ok=True)
+                target = os.path.join(directory, table).replace("'", "''")
+                cur.execute(f"""
+                    COPY (SELECT *, CAST(created_at AS DATE) AS day FROM {table} WHERE {where})
+                    TO '{target}' (FORMAT parquet, PARTITION_BY (day), FILENAME_PATTERN '{run_id}_{{i}}', OVERWRITE_OR_IGNORE true)
+                """, table_params)
+                cur.execute(f"DELETE FROM {table} WHERE {where}", table_params)
+            counts[table] = n
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        for table in ARCHIVE_WHERE:
+            for path in _archive_files(directory, table, run_id):
+                os.remove(path)
+        raise
+    return counts, session_ids
+
+
+def refresh_views(cur, directory: str) -> list[str]:
+    """<tabella>_all per ogni tabella con file in archivio (read_parquet fallisce senza file)."""
+    views = []
+    for table in ARCHIVE_WHERE:
+        if not _archive_files(directory, table):
+            continue
+        pattern = os.path.join(directory, table, "*", "*.parquet").replace("'", "''")
+        cur.execute(f"""
+            CREATE OR REPLACE VIEW {table}_all AS
+            SELECT * FROM {table}
+            UNION ALL BY NAME
+            SELECT * EXCLUDE (day) FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true)
+        """)
+        views.append(f"{table}_all")
+    return views
+
+
+def run_maintenance(cur, session_ttl: int = SESSION_TTL_SECONDS, archive_after: int = ARCHIVE_AFTER_SECONDS,
+                    directory: str = ARCHIVE_DIR) -> dict:
+    t0 = time.perf_counter()
+    expired = expire_sessions(cur, session_ttl)
+    archived, archived_sessions = archive(cur, directory, archive_after)
+    views = refresh_views(cur, directory)
+    return {
+        "expired_sessions": len(expired),
+        "archived": archived,
+        "views": views,
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "session_ids": expired + archived_sessions,
+    }
+
+
+async def run() -> dict:
+    """Una passata; le sessioni toccate escono dalla cache di questo processo."""
+    report = await db.run(run_maintenance, name="maintenance")
+    for session_id in report.pop("session_ids"):
+        sessions.store.invalidate(session_id)
+    reclaimed = sum(report["archived"].values())
+    if report["expired_sessions"] or reclaimed:
+        logger.info("maintenance expired_sessions=%d archived=%s reclaimed=%d in %.1f ms",
+                    report["expired_sessions"], report["archived"], reclaimed, report["duration_ms"])
+    return report
+
+
+_task: Optional[asyncio.Task] = None
+
+
+async def _maintenance_loop():
+    # prima attesa, poi la passata: niente lavoro extra durante il cold start (le viste sono persistenti)
+    while True:
+        await asyncio.sleep(MAINTENANCE_SECONDS)
+        try:
+            await run()
+        except Exception:
+            logger.exception("maintenance run failed")
+
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.get_running_loop().create_task(_maintenance_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    db.init_db()
+    try:
+        report = run_maintenance(db.cursor())
+    finally:
+        db.close()
+    report.pop("session_ids")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Metriche in formato testo Prometheus (/metrics) senza dipendenze esterne:
+istogrammi di latenza per route, query DB con nome e chiamate Stripe, più un
+profiler a campionamento opzionale per le richieste lente.
+"""
+import bisect, collections, logging, os, pathlib, re, sys, threading, time
+from functools import lru_cache
+from typing import Optional
+
+logger = logging.getLogger("acp.metrics")
+
+# Soglia oltre cui una richiesta viene profilata (0 = profiler spento)
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "5"))
+PROFILE_DUMP_DIR = os.getenv("PROFILE_DUMP_DIR")   # se impostata, salva anche gli stack in formato folded
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """Istogramma a bucket fissi per combinazione di label; observe() è thread-safe (pool DB)."""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(v[0]), v[1], v[2]) for k, v in sorted(self._series.items())]
+        for labels, counts, total, n in series:
+            acc = 0
+            for le, c in zip((*self.buckets, "+Inf"), counts):
+                acc += c
+                bucket = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, bucket)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total:.6f}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {n}")
+        return out
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: dict[tuple, float] = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in values]
+        return out
+
+
+class _Timer:
+    def __init__(self, hist: Histogram, labels: tuple):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+REGISTRY: list = []
+
+HTTP_REQUESTS = Histogram("acp_http_request_duration_seconds", "HTTP request latency by route template and status.",
+                          ("method", "route", "status"))
+DB_QUERIES = Histogram("acp_db_query_duration_seconds", "DuckDB execution time by named query (inside the pool worker).",
+                       ("query",))
+DB_POOL_WAIT = Histogram("acp_db_pool_wait_seconds", "Time a DB call waited for a free pool worker.")
+STRIPE_CALLS = Histogram("acp_stripe_call_duration_seconds", "Payment backend call latency, retries included.",
+                         ("operation", "outcome"), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+STRIPE_RETRIES = Counter("acp_stripe_retries_total", "Stripe HTTP attempts that were retried.", ("operation",))
+SLOW_REQUESTS = Counter("acp_slow_requests_total", "Requests above PROFILE_SLOW_MS (profiled).", ("route",))
+ADMISSION_REJECTED = Counter("acp_admission_rejected_total", "Requests rejected before routing (429 rate_limited, 503 overloaded).",
+                             ("budget", "reason"))
+ADMISSION_WAIT = Histogram("acp_admission_queue_wait_seconds", "Time an admitted request waited for a concurrency slot.",
+                           ("budget",))
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+_SQL_TARGET = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+([A-Za-z_][\w.]*)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def query_name(sql: str) -> str:
+    """Nome di default per le query senza nome esplicito: verbo + prima tabella ("select products")."""
+    words = sql.split(None, 1)
+    verb = words[0].lower() if words else "sql"
+    m = _SQL_TARGET.search(sql)
+    return f"{verb} {m.group(1).lower()}" if m else verb
+
+
+# ---------- middleware ----------
+
+class MetricsMiddleware:
+    """Middleware ASGI: latenza per (metodo, template della route, status) e hook del profiler."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        start_wall = time.time()
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            # template della route FastAPI; le route Starlette (docs, openapi) non hanno parametri
+            route = scope.get("route")
+            label = getattr(route, "path", None) or (scope["path"] if "endpoint" in scope else None) \
+                or scope.get("acp.route_label", "unmatched")   # es. "admission:products" per i 429/503
+            HTTP_REQUESTS.observe(elapsed, scope["method"], label, str(status))
+            if profiler is not None and elapsed * 1000 >= PROFILE_SLOW_MS:
+                SLOW_REQUESTS.inc(label)
+                profiler.report(f"{scope['method']} {label}", start_wall, start_wall + elapsed)
+
+
+# ---------- profiler a campionamento ----------
+
+_IDLE_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+
+class SamplingProfiler:
+    """
+    Un thread daemon campiona gli stack di tutti i thread ogni PROFILE_SAMPLE_MS
+    e tiene gli ultimi secondi in memoria. Per una richiesta lenta si aggregano i
+    campioni della sua finestra temporale: con l'event loop condiviso includono
+    anche le richieste concorrenti, ma i percorsi caldi emergono comunque.
+    """
+
+    def __init__(self, interval_ms: float = PROFILE_SAMPLE_MS, window_s: float = 60.0, top: int = 15):
+        self.interval = interval_ms / 1000.0
+        self.top = top
+        self._samples: collections.deque = collections.deque(maxlen=int(window_s / self.interval))
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="acp-profiler", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        me = threading.get_ident()
+        names = {}
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = self._collapse(frame)
+                if stack is None:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stacks.append(f"{names.get(ident, ident)};{stack}")
+            if stacks:
+                self._samples.append((now, stacks))
+
+    @staticmethod
+    def _collapse(frame) -> Optional[str]:
+        if frame.f_code.co_filename.endswith(_IDLE_FILES):
+            return None   # thread in attesa (loop in select, worker del pool fermo)
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({pathlib.Path(code.co_filename).name}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def report(self, label: str, start: float, end: float):
+        counts = collections.Counter(s for t, stacks in list(self._samples) if start <= t <= end for s in stacks)
+        if not counts:
+            return
+        total = sum(counts.values())
+        lines = [f"slow request {label}: {(end - start) * 1000:.0f} ms, {total} samples"]
+        for stack, n in counts.most_common(self.top):
+            lines.append(f"  {n / total:6.1%}  {' <- '.join(reversed(stack.split(';')[-4:]))}")
+        logger.warning("\n".join(lines))
+        if PROFILE_DUMP_DIR:
+            path = pathlib.Path(PROFILE_DUMP_DIR)
+            path.mkdir(parents=True, exist_ok=True)
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_")
+            with open(path / f"{int(start * 1000)}-{slug}.folded", "w") as f:
+                for stack, n in counts.most_common():
+                    f.write(f"{stack} {n}\n")
+
+
+profiler: Optional[SamplingProfiler] = SamplingProfiler() if PROFILE_SLOW_MS > 0 else None
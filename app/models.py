@@ -1,4 +1,5 @@
 
+from datetime import date
 from pydantic import BaseModel, Field, EmailStr, HttpUrl
 from typing import Optional, Literal, List
 
@@ -48,13 +49,29 @@ class UpdateSessionRequest(BaseModel):
 
 class Session(BaseModel):
     id: str
-    status: Literal["requires_confirmation", "requires_action", "succeeded", "failed"]
+    status: Literal["requires_confirmation", "requires_action", "succeeded", "failed", "expired"]
     cart: Cart
     payment_intent_id: Optional[str] = None
 
 class CompleteResponse(Session):
     pass
 
+class QuoteRequest(BaseModel):
+    items: List[LineItem]
+    currency: ISO_CURRENCY = "EUR"
+    promo_code: Optional[str] = None
+    country: Optional[str] = Field(default=None, min_length=2, max_length=2)   # come buyer.address.country
+
+class BatchQuoteRequest(BaseModel):
+    quotes: List[QuoteRequest] = Field(..., max_length=1000)
+
+class Quote(BaseModel):
+    totals: Optional[CartTotals] = None
+    error: Optional[str] = None            # es. prodotto sconosciuto: solo questa variante fallisce
+
+class BatchQuoteResponse(BaseModel):
+    quotes: List[Quote]                    # stesso ordine della richiesta
+
 
 class Product(BaseModel):
     id: str = Field(..., max_length=100)
@@ -72,3 +89,53 @@ class Product(BaseModel):
     return_policy: Optional[str] = None    # testo in inglese
     # campo comodo lato client (non in tabella)
     available: bool = True
+
+
+class ProductPage(BaseModel):
+    """Risposta di GET /products in modalità cursore (parametro `cursor`)."""
+    items: List[Product]
+    next_cursor: Optional[str] = None   # None = ultima pagina
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+class PriceBucket(BaseModel):
+    min: float
+    max: Optional[float] = None   # None = ultimo scaglione, senza limite superiore
+    count: int
+
+class ProductFacets(BaseModel):
+    """Risposta di GET /products/facets: conteggi per valore sugli stessi filtri di /products."""
+    total: int
+    category: List[FacetCount]
+    color: List[FacetCount]
+    size: List[FacetCount]
+    price: List[PriceBucket]
+
+
+class TopProduct(BaseModel):
+    product_id: str
+    currency: str
+    orders: int
+    units: int
+    revenue_minor: int    # prezzo unitario × quantità, lordo di sconti/tasse/spedizione
+
+class DailyRevenue(BaseModel):
+    day: date
+    currency: str
+    orders: int
+    revenue_minor: int    # totale incassato (grand total degli ordini)
+
+class ConversionDay(BaseModel):
+    day: date
+    sessions: int
+    orders: int
+    conversion_rate: Optional[float] = None   # None se nessuna sessione
+
+class ConversionReport(BaseModel):
+    sessions: int
+    orders: int
+    conversion_rate: Optional[float] = None
+    days: List[ConversionDay]
@@ -0,0 +1,101 @@
+"""
+/openapi.json servito come byte già pronti: JSON compatto e la sua versione gzip.
+
+Su Render lo schema si genera al build (`python -m app.openapi build/openapi.json`,
+vedi render.yaml) e il server legge solo i due file indicati da OPENAPI_PREBUILT:
+la prima chiamata delle GPT Actions dopo un cold start non paga get_openapi.
+Senza file precompilato lo schema si genera alla prima richiesta, una volta sola.
+"""
+import gzip, hashlib, json, os, sys
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import Response
+
+OPENAPI_PREBUILT = os.getenv("OPENAPI_PREBUILT", "")
+
+
+def build_schema(app: FastAPI) -> dict:
+    schema = get_openapi(
+        title=app.title,
+        version=app.version,
+        description=app.description,
+        routes=app.routes,
+    )
+
+    # ✅ 1) Inserisci il server dinamico da ENV (deve essere https)
+    base = os.getenv("PUBLIC_BASE_URL", "").strip()
+    if base and base.startswith("https://"):
+        schema["servers"] = [{"url": base}]
+    else:
+        # fallback placeholder (verrà rifiutato dalle Actions se usato)
+        schema["servers"] = [{"url": "https://replace-me.example.com"}]
+
+    # ✅ 2) Aggiungi security scheme per API Key su header X-API-Key
+    components = schema.setdefault("components", {})
+    security_schemes = components.setdefault("securitySchemes", {})
+    security_schemes["ApiKeyAuth"] = {
+        "type": "apiKey",
+        "in": "header",
+        "name": "X-API-Key",
+        "description": "Provide your API key in the X-API-Key header."
+    }
+    # Applica la security **globale** (puoi toglierla se la definisci endpoint-by-endpoint)
+    schema["security"] = [{"ApiKeyAuth": []}]
+    return schema
+
+
+def encode(schema: dict) -> tuple[bytes, bytes]:
+    body = json.dumps(schema, separators=(",", ":"), ensure_ascii=False).encode()
+    return body, gzip.compress(body, 9, mtime=0)   # mtime=0: stesso input, stessi byte
+
+
+class OpenAPIDocument:
+    def __init__(self, app: FastAPI, prebuilt: str = OPENAPI_PREBUILT):
+        self.app = app
+        self.prebuilt = prebuilt
+        self._encoded: Optional[tuple[bytes, bytes, str]] = None
+
+    def encoded(self) -> tuple[bytes, bytes, str]:
+        """(json, json gzip, etag)."""
+        if self._encoded is None:
+            if self.prebuilt and os.path.exists(self.prebuilt):
+                with open(self.prebuilt, "rb") as f:
+                    body = f.read()
+                with open(self.prebuilt + ".gz", "rb") as f:
+                    gz = f.read()
+            else:
+                body, gz = encode(self.app.openapi())
+            self._encoded = (body, gz, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+        return self._encoded
+
+    def response(self, request: Request) -> Response:
+        body, gz, etag = self.encoded()
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "public, max-age=300"}
+        if etag in [t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            return Response(gz, media_type="application/json", headers={**headers, "Content-Encoding": "gzip"})
+        return Response(body, media_type="application/json", headers=headers)
+
+
+def write(app: FastAPI, path: str):
+    body, gz = encode(app.openapi())
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    for target, data in ((path, body), (path + ".gz", gz)):
+        with open(target + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(target + ".tmp", target)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    path = argv[0] if argv else (OPENAPI_PREBUILT or "build/openapi.json")
+    from .main import app
+    write(app, path)
+    print(f"wrote {path} and {path}.gz")
+
+
+if __name__ == "__main__":
+    main()
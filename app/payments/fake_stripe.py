@@ -0,0 +1,132 @@
+"""
+Stand-in locale per i PaymentIntent di Stripe (test, demo offline, benchmark).
+
+In-process:   PAYMENT_BACKEND=fake
+Come server:  uvicorn app.payments.fake_stripe:app --port 12111
+              STRIPE_API_BASE=http://127.0.0.1:12111 (latenza simulata: FAKE_STRIPE_LATENCY_MS)
+"""
+import asyncio, os, time, uuid
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from .stripe_client import PaymentError
+
+FAKE_STRIPE_LATENCY_MS = float(os.getenv("FAKE_STRIPE_LATENCY_MS", "0"))
+
+# PaymentMethod di test che in Stripe richiedono 3DS
+REQUIRES_ACTION_PMS = {"pm_card_authenticationRequired"}
+
+
+class FakeStripeBackend:
+    """Stato dei PaymentIntent in memoria, con la stessa interfaccia di StripeHTTPBackend."""
+
+    def __init__(self, latency_ms: float = FAKE_STRIPE_LATENCY_MS):
+        self.latency = latency_ms / 1000.0
+        self.intents: dict[str, dict] = {}
+        self._idempotent: dict[str, dict] = {}
+        self.calls = {"create": 0, "retrieve": 0, "confirm": 0}
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def create(self, params: dict, idempotency_key: str) -> dict:
+        await self._delay()
+        self.calls["create"] += 1
+        key = f"create:{idempotency_key}"
+        if key in self._idempotent:
+            return dict(self._idempotent[key])
+        pm = params.get("payment_method")
+        pi = {
+            "id": f"pi_fake_{uuid.uuid4().hex[:24]}",
+            "object": "payment_intent",
+            "amount": int(params["amount"]),
+            "currency": params["currency"],
+            "receipt_email": params.get("receipt_email"),
+            "metadata": params.get("metadata") or {},
+            "payment_method": pm,
+            "status": "requires_confirmation" if pm else "requires_payment_method",
+            "created": int(time.time()),
+        }
+        self.intents[pi["id"]] = pi
+        self._idempotent[key] = pi
+        return dict(pi)
+
+    async def retrieve(self, payment_intent_id: str) -> dict:
+        await self._delay()
+        self.calls["retrieve"] += 1
+        return dict(self._get(payment_intent_id))
+
+    async def confirm(self, payment_intent_id: str, params: dict, idempotency_key: str) -> dict:
+        await self._delay()
+        self.calls["confirm"] += 1
+        key = f"confirm:{idempotency_key}"
+        if key in self._idempotent:
+            return dict(self._idempotent[key])
+        pi = self._get(payment_intent_id)
+        if params.get("payment_method"):
+            pi["payment_method"] = params["payment_method"]
+        if not pi["payment_method"]:
+            raise PaymentError(400, "You cannot confirm this PaymentIntent because it's missing a payment method.",
+                               "payment_intent_unexpected_state")
+        pi["status"] = "requires_action" if pi["payment_method"] in REQUIRES_ACTION_PMS else "succeeded"
+        self._idempotent[key] = dict(pi)
+        return dict(pi)
+
+    def _get(self, payment_intent_id: str) -> dict:
+        pi = self.intents.get(payment_intent_id)
+        if pi is None:
+            raise PaymentError(404, f"No such payment_intent: '{payment_intent_id}'", "resource_missing")
+        return pi
+
+    async def aclose(self):
+        pass
+
+
+def form_decode(body: bytes) -> dict:
+    """Inverso di form_encode per i campi usati dai PaymentIntent (a[b]=v, a[0]=v)."""
+    out: dict = {}
+    for name, value in parse_qsl(body.decode(), keep_blank_values=True):
+        parts = name.replace("]", "").split("[")
+        node = out
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    for key, value in list(out.items()):
+        if isinstance(value, dict) and value and all(k.isdigit() for k in value):
+            out[key] = [value[k] for k in sorted(value, key=int)]
+    return out
+
+
+backend = FakeStripeBackend()
+app = FastAPI(title="Fake Stripe (PaymentIntents)")
+
+
+def _error(e: PaymentError) -> JSONResponse:
+    return JSONResponse(status_code=e.status, content={"error": {"message": str(e), "code": e.code}})
+
+
+@app.post("/v1/payment_intents")
+async def create_intent(request: Request):
+    try:
+        return await backend.create(form_decode(await request.body()), request.headers.get("idempotency-key") or str(uuid.uuid4()))
+    except PaymentError as e:
+        return _error(e)
+
+
+@app.get("/v1/payment_intents/{pi_id}")
+async def retrieve_intent(pi_id: str):
+    try:
+        return await backend.retrieve(pi_id)
+    except PaymentError as e:
+        return _error(e)
+
+
+@app.post("/v1/payment_intents/{pi_id}/confirm")
+async def confirm_intent(pi_id: str, request: Request):
+    try:
+        return await backend.confirm(pi_id, form_decode(await request.body()), request.headers.get("idempotency-key") or str(uuid.uuid4()))
+    except PaymentError as e:
+        return _error(e)
@@ -1,7 +1,18 @@
-import os
-import stripe
+import asyncio, logging, os, random, time, uuid
+from typing import Any, Protocol
+from urllib.parse import urlencode
 
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "")
+from .. import metrics
+
+logger = logging.getLogger("acp.payments")
+
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "https://api.stripe.com")
+STRIPE_API_VERSION = os.getenv("STRIPE_API_VERSION", "2024-06-20")   # versione fissata dall'SDK stripe 10.x
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "2"))
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", "20"))
+# "stripe" = API HTTP (o STRIPE_API_BASE, es. il fake locale), "fake" = in-process
+PAYMENT_BACKEND = os.getenv("PAYMENT_BACKEND", "stripe").lower()
 
 # Demo map: SPT -> Stripe PaymentMethod id
 DEMO_SPT_TO_PM = {
@@ -9,25 +20,177 @@ DEMO_SPT_TO_PM = {
     "test_spt_3ds2": "pm_card_authenticationRequired",
 }
 
+
+class PaymentError(Exception):
+    def __init__(self, status: int, message: str, code: str | None = None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+class PaymentBackend(Protocol):
+    async def create(self, params: dict, idempotency_key: str) -> dict: ...
+    async def retrieve(self, payment_intent_id: str) -> dict: ...
+    async def confirm(self, payment_intent_id: str, params: dict, idempotency_key: str) -> dict: ...
+    async def aclose(self) -> None: ...
+
+
+def form_encode(params: dict, prefix: str | None = None) -> list[tuple[str, str]]:
+    """Codifica form-urlencoded in stile Stripe: metadata[k]=v, payment_method_types[0]=card."""
+    out: list[tuple[str, str]] = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            out += form_encode(value, name)
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                out += form_encode({str(i): v}, name)
+        elif isinstance(value, bool):
+            out.append((name, "true" if value else "false"))
+        else:
+            out.append((name, str(value)))
+    return out
+
+
+class StripeHTTPBackend:
+    """
+    Client async sull'API REST di Stripe: un solo httpx.AsyncClient con pool
+    keep-alive, timeout per chiamata e retry con jitter. I POST vengono
+    ritentati solo perché portano sempre un Idempotency-Key.
+    """
+
+    def __init__(self, api_key: str | None = None, base_url: str = STRIPE_API_BASE,
+                 timeout: float = STRIPE_TIMEOUT_SECONDS, max_retries: int = STRIPE_MAX_RETRIES):
+        self.api_key = api_key if api_key is not None else os.getenv("STRIPE_SECRET_KEY", "")
+        self.max_retries = max_retries
+        import httpx   # ~0.25s di import: solo al primo pagamento, non all'avvio
+        self._retry_errors = (httpx.TimeoutException, httpx.NetworkError)
+        self._http_error = httpx.HTTPError
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=STRIPE_POOL_SIZE, max_keepalive_connections=STRIPE_POOL_SIZE),
+            headers={"Stripe-Version": STRIPE_API_VERSION},
+        )
+
+    async def _request(self, operation: str, method: str, path: str, params: dict | None = None,
+                       idempotency_key: str | None = None) -> dict:
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        body = None
+        if params is not None:
+            body = urlencode(form_encode(params))
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(self.max_retries + 1):
+            retry = attempt < self.max_retries
+            try:
+                resp = await self._client.request(method, path, content=body, headers=headers)
+            except self._retry_errors as e:
+                if not retry:
+                    raise PaymentError(503, f"Stripe unreachable: {e}") from e
+                logger.warning("stripe %s %s network error (attempt %d): %s", method, path, attempt + 1, e)
+                metrics.STRIPE_RETRIES.inc(operation)
+            except self._http_error as e:
+                # errori non di rete (es. header non valido): inutile ritentare, 502 come gli altri errori Stripe
+                raise PaymentError(502, f"Stripe request failed: {e}") from e
+            else:
+                if resp.status_code < 400:
+                    return resp.json()
+                should_retry = resp.headers.get("stripe-should-retry")
+                retryable = should_retry == "true" or (should_retry is None and (resp.status_code in (409, 429) or resp.status_code >= 500))
+                if not (retry and retryable):
+                    err = (resp.json().get("error") or {}) if resp.headers.get("content-type", "").startswith("application/json") else {}
+                    raise PaymentError(resp.status_code, err.get("message") or resp.text, err.get("code"))
+                logger.warning("stripe %s %s -> %d (attempt %d), retrying", method, path, resp.status_code, attempt + 1)
+                metrics.STRIPE_RETRIES.inc(operation)
+            # backoff esponenziale con full jitter, max 2s
+            await asyncio.sleep(random.uniform(0, min(2.0, 0.25 * 2 ** attempt)))
+        raise AssertionError("unreachable")
+
+    async def create(self, params: dict, idempotency_key: str) -> dict:
+        return await self._request("create", "POST", "/v1/payment_intents", params, idempotency_key)
+
+    async def retrieve(self, payment_intent_id: str) -> dict:
+        return await self._request("retrieve", "GET", f"/v1/payment_intents/{payment_intent_id}")
+
+    async def confirm(self, payment_intent_id: str, params: dict, idempotency_key: str) -> dict:
+        return await self._request("confirm", "POST", f"/v1/payment_intents/{payment_intent_id}/confirm", params, idempotency_key)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_backend: PaymentBackend | None = None
+
+
+def get_backend() -> PaymentBackend:
+    global _backend
+    if _backend is None:
+        if PAYMENT_BACKEND == "fake":
+            from .fake_stripe import FakeStripeBackend
+            _backend = FakeStripeBackend()
+        else:
+            _backend = StripeHTTPBackend()
+    return _backend
+
+
+def check_config():
+    """All'avvio: con il backend HTTP senza STRIPE_SECRET_KEY ogni pagamento fallirebbe."""
+    if _backend is None and PAYMENT_BACKEND != "fake" and not os.getenv("STRIPE_SECRET_KEY"):
+        raise RuntimeError("STRIPE_SECRET_KEY not configured (PAYMENT_BACKEND=stripe); set it or use PAYMENT_BACKEND=fake")
+
+
+def set_backend(backend: PaymentBackend | None):
+    """Sostituisce il backend (test, benchmark, fake locale)."""
+    global _backend
+    _backend = backend
+
+
+async def close():
+    global _backend
+    if _backend is not None:
+        await _backend.aclose()
+        _backend = None
+
+
+async def _timed(operation: str, call):
+    """Latenza della chiamata al backend (retry inclusi) in metrics.STRIPE_CALLS."""
+    outcome = "error"
+    t0 = time.perf_counter()
+    try:
+        result = await call
+        outcome = "ok"
+        return result
+    except PaymentError as e:
+        outcome = "declined" if e.status == 402 else "error"
+        raise
+    finally:
+        metrics.STRIPE_CALLS.observe(time.perf_counter() - t0, operation, outcome)
+
+
 def resolve_payment_method_from_spt(shared_payment_token: str | None) -> str | None:
     if not shared_payment_token:
         return None
     return DEMO_SPT_TO_PM.get(shared_payment_token)
 
-def create_payment_intent(
+async def create_payment_intent(
     amount_minor: int,
     currency: str,
     buyer_email: str,
     shared_payment_token: str | None,
     metadata: dict | None = None,
-):
+    idempotency_key: str | None = None,
+) -> dict[str, Any]:
     """
     Crea un PaymentIntent limitato a 'card' per evitare metodi redirect (niente return_url richiesto).
     Se è presente uno SPT demo, lo mappa a un PaymentMethod test di Stripe.
     """
     pm = resolve_payment_method_from_spt(shared_payment_token)
 
-    kwargs = dict(
+    params = dict(
         amount=amount_minor,
         currency=currency,
         receipt_email=buyer_email,
@@ -38,20 +201,24 @@ def create_payment_intent(
         payment_method_types=["card"],
     )
     if pm:
-        kwargs["payment_method"] = pm
+        params["payment_method"] = pm
+
+    return await _timed("create", get_backend().create(params, idempotency_key or str(uuid.uuid4())))
 
-    pi = stripe.PaymentIntent.create(**kwargs)
-    return pi
+async def retrieve_payment_intent(payment_intent_id: str) -> dict[str, Any]:
+    return await _timed("retrieve", get_backend().retrieve(payment_intent_id))
 
-def confirm_payment_intent(payment_intent_id: str):
+async def confirm_payment_intent(
+    payment_intent_id: str,
+    payment_method: str | None = None,
+    idempotency_key: str | None = None,
+) -> dict[str, Any]:
     """
-    Conferma il PI. Se manca un payment_method (nessuno SPT passato in create),
-    usa come fallback la carta test 'pm_card_visa' per la demo.
+    Conferma il PI con una sola chiamata. payment_method è quello già agganciato in create
+    (registrato nella sessione): se manca, usa come fallback la carta test 'pm_card_visa' per la demo.
     """
-    pi_obj = stripe.PaymentIntent.retrieve(payment_intent_id)
-    if not pi_obj.get("payment_method"):
+    params = {}
+    if not payment_method:
         # Fallback demo per flusso 'happy path'
-        pi = stripe.PaymentIntent.confirm(payment_intent_id, payment_method="pm_card_visa")
-    else:
-        pi = stripe.PaymentIntent.confirm(payment_intent_id)
-    return pi
+        params["payment_method"] = "pm_card_visa"
+    return await _timed("confirm", get_backend().confirm(payment_intent_id, params, idempotency_key or str(uuid.uuid4())))
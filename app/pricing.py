@@ -0,0 +1,113 @@
+"""
+Motore prezzi guidato da tabelle: promo (pricing_promos), IVA per paese
+(pricing_tax_rates, '*' = default) e spedizione a scaglioni per valuta
+(pricing_shipping). Le regole sono compilate una volta in PricingRules e
+ricaricate quando cambia la versione del catalogo (db.bump_catalog_version).
+
+PricingRules.totals è l'unico punto di calcolo: lo usano sia compute_totals
+(sessioni, un carrello) sia quote_batch (POST /checkout/quotes:batch).
+"""
+import asyncio, bisect
+from typing import NamedTuple, Optional
+
+from . import catalog, db
+
+
+class PricingRules:
+    def __init__(self, promos: dict[str, tuple[float, int]], tax_rates: dict[str, float], default_tax_rate: float,
+                 shipping: dict[str, list[tuple[int, int]]]):
+        self.promos = promos                    # CODE -> (percent_off, min_subtotal_minor)
+        self.tax_rates = tax_rates              # paese ISO -> aliquota
+        self.default_tax_rate = default_tax_rate
+        self.shipping = shipping                # VALUTA -> [(sotto_minor, costo_minor)] per soglia crescente
+        self._thresholds = {cur: [below for below, _ in tiers] for cur, tiers in shipping.items()}
+
+    def discount(self, subtotal: int, promo_code: Optional[str]) -> int:
+        promo = self.promos.get(promo_code.upper()) if promo_code else None
+        if promo is None or subtotal < promo[1]:
+            return 0
+        return int(subtotal * promo[0])
+
+    def tax_rate(self, country: Optional[str]) -> float:
+        return self.tax_rates.get(country.upper(), self.default_tax_rate) if country else self.default_tax_rate
+
+    def shipping_fee(self, subtotal: int, currency: str) -> int:
+        cur = currency.upper()
+        thresholds = self._thresholds.get(cur)
+        if not thresholds:
+            return 0
+        i = bisect.bisect_right(thresholds, subtotal)   # primo scaglione con soglia > subtotal
+        return self.shipping[cur][i][1] if i < len(thresholds) else 0
+
+    def totals(self, subtotal: int, currency: str, promo_code: Optional[str], country: Optional[str]) -> tuple[int, ...]:
+        """(subtotal, discount, tax, shipping, grand_total) in centesimi."""
+        discount = self.discount(subtotal, promo_code)
+        taxable_base = max(0, subtotal - discount)
+        tax = int(round(taxable_base * self.tax_rate(country)))
+        shipping = self.shipping_fee(subtotal, currency)
+        return subtotal, discount, tax, shipping, max(0, taxable_base + tax + shipping)
+
+
+def load_rules(cur) -> PricingRules:
+    promos = {code.upper(): (float(pct), int(min_sub or 0)) for code, pct, min_sub in cur.execute(
+        "SELECT code, percent_off, min_subtotal_minor FROM pricing_promos WHERE active").fetchall()}
+    rates = {country.upper(): float(rate) for country, rate in cur.execute(
+        "SELECT country, rate FROM pricing_tax_rates").fetchall()}
+    shipping: dict[str, list[tuple[int, int]]] = {}
+    for currency, below, fee in cur.execute(
+            "SELECT upper(currency), below_minor, fee_minor FROM pricing_shipping ORDER BY 1, 2").fetchall():
+        shipping.setdefault(currency, []).append((int(below), int(fee)))
+    return PricingRules(promos, {c: r for c, r in rates.items() if c != "*"}, rates.get("*", 0.0), shipping)
+
+
+class Cart(NamedTuple):
+    items: list[tuple[str, int]]     # (product_id, quantity)
+    currency: str
+    promo_code: Optional[str]
+    country: Optional[str]
+
+
+class PricingEngine:
+    """Regole compilate, caricate alla prima richiesta e dopo ogni cambio di versione del catalogo."""
+
+    def __init__(self):
+        self.rules: Optional[PricingRules] = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.rules = None
+
+    async def get(self) -> PricingRules:
+        rules = self.rules
+        if rules is None:
+            async with self._lock:
+                rules = self.rules
+                if rules is None:
+                    rules = self.rules = await db.run(load_rules, name="pricing.rules")
+        return rules
+
+    async def quote_batch(self, carts: list[Cart]) -> list[tuple]:
+        """
+        Molti carrelli in un passaggio: un solo lookup prezzi (snapshot del catalogo,
+        miss in un'unica query) per l'unione dei prodotti, poi le regole compilate.
+        Per carrello: (prodotto sconosciuto | None, subtotal, discount, tax, shipping, grand).
+        """
+        rules = await self.get()
+        prices = await catalog.snapshot.prices_cents({pid for cart in carts for pid, _ in cart.items})
+        totals = rules.totals
+        out: list[tuple] = []
+        for cart in carts:
+            subtotal = 0
+            for pid, qty in cart.items:
+                cents = prices.get(pid)
+                if cents is None:
+                    out.append((pid,))
+                    break
+                subtotal += cents * qty
+            else:
+                out.append((None, *totals(subtotal, cart.currency, cart.promo_code, cart.country)))
+        return out
+
+
+engine = PricingEngine()
+db.CATALOG_LISTENERS.append(engine.invalidate)
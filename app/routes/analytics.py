@@ -0,0 +1,61 @@
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Query
+from ..models import TopProduct, DailyRevenue, ConversionDay, ConversionReport
+from .. import db
+from ..security import verify_api_key
+
+# Letture solo dalle tabelle di rollup (app.analytics): costo proporzionale ai giorni, non agli ordini
+router = APIRouter(prefix="/analytics", tags=["analytics"], dependencies=[Depends(verify_api_key)])
+
+WINDOW = "day > current_date - CAST(? AS INTEGER)"
+
+@router.get("/top-products", response_model=List[TopProduct], summary="Top products by revenue")
+async def top_products(
+    days: int = Query(30, ge=1, le=3660),
+    limit: int = Query(10, ge=1, le=100),
+    currency: Optional[str] = Query(None, min_length=3, max_length=3),
+):
+    sql = f"""
+        SELECT product_id, currency, sum(orders), sum(units), sum(revenue_minor) AS revenue
+        FROM sales_product_daily
+        WHERE {WINDOW} {"AND currency = upper(?)" if currency else ""}
+        GROUP BY product_id, currency
+        ORDER BY revenue DESC, product_id
+        LIMIT ?
+    """
+    params = [days] + ([currency] if currency else []) + [limit]
+    rows = await db.fetchall(sql, params, name="analytics.top_products")
+    return [TopProduct(product_id=r[0], currency=r[1], orders=r[2], units=r[3], revenue_minor=r[4]) for r in rows]
+
+@router.get("/revenue-by-day", response_model=List[DailyRevenue], summary="Revenue per day and currency")
+async def revenue_by_day(
+    days: int = Query(30, ge=1, le=3660),
+    currency: Optional[str] = Query(None, min_length=3, max_length=3),
+):
+    sql = f"""
+        SELECT day, currency, orders, revenue_minor
+        FROM sales_daily
+        WHERE {WINDOW} {"AND currency = upper(?)" if currency else ""}
+        ORDER BY day, currency
+    """
+    rows = await db.fetchall(sql, [days] + ([currency] if currency else []), name="analytics.revenue_by_day")
+    return [DailyRevenue(day=r[0], currency=r[1], orders=r[2], revenue_minor=r[3]) for r in rows]
+
+@router.get("/conversion", response_model=ConversionReport, summary="Checkout sessions to orders conversion")
+async def conversion(days: int = Query(30, ge=1, le=3660)):
+    rows = await db.fetchall(f"""
+        WITH s AS (SELECT day, sessions FROM sessions_daily WHERE {WINDOW}),
+             o AS (SELECT day, sum(orders) AS orders FROM sales_daily WHERE {WINDOW} GROUP BY day)
+        SELECT day, coalesce(s.sessions, 0), coalesce(o.orders, 0)
+        FROM s FULL OUTER JOIN o USING (day)
+        ORDER BY day
+    """, [days, days], name="analytics.conversion")
+    per_day = [ConversionDay(day=d, sessions=s, orders=o, conversion_rate=round(o / s, 4) if s else None) for d, s, o in rows]
+    sessions = sum(d.sessions for d in per_day)
+    orders = sum(d.orders for d in per_day)
+    return ConversionReport(
+        sessions=sessions,
+        orders=orders,
+        conversion_rate=round(orders / sessions, 4) if sessions else None,
+        days=per_day,
+    )
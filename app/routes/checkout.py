@@ -1,141 +1,340 @@
-import uuid, json
-from fastapi import APIRouter, HTTPException, Header, Depends, Query
-from ..models import CreateSessionRequest, UpdateSessionRequest, Session, CompleteResponse, Cart, CartTotals, LineItem
-from ..payments.stripe_client import create_payment_intent, confirm_payment_intent
-from ..db import get_conn, get_idempotent_response, save_idempotent_response
+import asyncio, logging, os, uuid, json
+from fastapi import APIRouter, HTTPException, Header, Depends, Query, Response
+from ..models import (CreateSessionRequest, UpdateSessionRequest, Session, CompleteResponse, Cart, CartTotals, LineItem,
+                      BatchQuoteRequest, BatchQuoteResponse, Quote)
+from ..payments.stripe_client import create_payment_intent, confirm_payment_intent, retrieve_payment_intent, PaymentError
+from .. import db, catalog, idempotency, pricing, sessions, writes
+from ..maintenance import TERMINAL_STATUSES
+from ..sessions import SessionState
 from ..security import verify_api_key
 
-router = APIRouter(tags=["checkout"], dependencies=[Depends(verify_api_key)])
+logger = logging.getLogger("acp.checkout")
 
-def price_cents_for_product(conn, product_id: str) -> int:
-    row = conn.execute("SELECT price FROM products WHERE id = ?", [product_id]).fetchone()
-    if not row:
-        raise HTTPException(status_code=400, detail=f"Unknown product_id: {product_id}")
-    return int(round(float(row[0]) * 100))
+# "sync": /complete risponde con l'esito della conferma; "async": risponde subito
+# requires_action e conferma in background (il client fa polling di GET /checkout/sessions/{id}).
+# Per singola richiesta: header "Prefer: respond-async"
+CHECKOUT_COMPLETE_MODE = os.getenv("CHECKOUT_COMPLETE_MODE", "sync").lower()
+
+# pi_status della sessione mentre /complete async conferma in background: valore che Stripe
+# non usa mai (a differenza di 'processing'), così un webhook non può simulare il claim
+CONFIRMING = "confirming"
+
+# Esito della conferma -> status della sessione (requires_action: 3DS da completare, chiude il webhook)
+PI_SESSION_STATUS = {"succeeded": "succeeded", "requires_action": "requires_action"}
+
+router = APIRouter(tags=["checkout"], dependencies=[Depends(verify_api_key)])
 
-def compute_totals(conn, items: list[LineItem], currency: str, promo_code: str | None) -> CartTotals:
+async def compute_totals(items: list[LineItem], currency: str, promo_code: str | None, country: str | None = None) -> CartTotals:
+    # Un solo passaggio sullo snapshot del catalogo (miss -> una query IN (...))
+    prices = await catalog.snapshot.prices_cents(it.product_id for it in items)
     subtotal = 0
     for it in items:
-        subtotal += price_cents_for_product(conn, it.product_id) * it.quantity
-
-    discount = 0
-    if promo_code and promo_code.upper() == "WELCOME10":
-        discount = int(subtotal * 0.10)
-
-    taxable_base = max(0, subtotal - discount)
-    tax = int(round(taxable_base * 0.22))  # demo IVA 22%
-    shipping = 500 if currency.upper() == "EUR" and (subtotal/100.0) < 50.0 else 0
-    grand = max(0, taxable_base + tax + shipping)
-
-    return CartTotals(
-        subtotal_minor=subtotal,
-        discount_minor=discount,
-        tax_minor=tax,
-        shipping_minor=shipping,
-        grand_total_minor=grand,
-        currency=currency.upper()
-    )
+        cents = prices.get(it.product_id)
+        if cents is None:
+            raise HTTPException(status_code=400, detail=f"Unknown product_id: {it.product_id}")
+        subtotal += cents * it.quantity
+
+    # promo, IVA per paese e spedizione dalle tabelle pricing_* (app.pricing)
+    rules = await pricing.engine.get()
+    return _totals_model(rules.totals(subtotal, currency, promo_code, country), currency)
+
+def _totals_model(values: tuple[int, ...], currency: str) -> CartTotals:
+    return CartTotals(**dict(zip(db.TOTALS_COLUMNS, values)), currency=currency.upper())
+
+def _buyer_country(buyer) -> str | None:
+    return buyer.address.country.upper() if buyer and buyer.address and buyer.address.country else None
+
+def _totals_params(totals: CartTotals) -> list[int]:
+    return [getattr(totals, col) for col in db.TOTALS_COLUMNS]
 
 def serialize_session(id: str, status: str, cart: Cart, payment_intent_id: str | None):
     return Session(id=id, status=status, cart=cart, payment_intent_id=payment_intent_id)
 
+TOTALS_SQL = ", ".join(f"s.{col}" for col in db.TOTALS_COLUMNS)
+
+# Sessione + righe del carrello in una sola query (righe aggregate in lista ordinata)
+SESSION_SQL = f"""
+    SELECT s.status, s.payment_intent_id, s.buyer_email, s.currency, s.promo_code, s.revision, s.buyer_country,
+           s.payment_method_id, s.pi_status, {TOTALS_SQL},
+           (SELECT list(struct_pack(product_id := si.product_id, quantity := si.quantity) ORDER BY si.position)
+            FROM session_items si WHERE si.session_id = s.id)
+    FROM checkout_sessions s WHERE s.id = ?
+"""
+
+async def load_session(session_id: str) -> SessionState:
+    state = sessions.store.get(session_id)
+    if state is not None:
+        if db.DB_ROLE != "worker":
+            return state   # processo singolo: ogni scrittura passa da qui e aggiorna/invalida la cache
+        row = await db.fetchone(sessions.REVISION_SQL, [session_id], name="session.revision")
+        if row and row[0] == state.revision:
+            return state
+        sessions.store.invalidate(session_id)   # cambiata da un altro worker (o cancellata)
+    row = await db.fetchone(SESSION_SQL, [session_id], name="session.load")
+    if not row:
+        raise HTTPException(status_code=404, detail="Session not found")
+    status, pi_id, buyer_email, currency, promo_code, revision, country, payment_method, pi_status = row[:9]
+    n = len(db.TOTALS_COLUMNS)
+    totals = _totals_model(row[9:9 + n], currency)
+    items = [LineItem(**i) for i in row[9 + n] or []]
+    state = SessionState(status, pi_id, buyer_email, currency, promo_code, Cart(items=items, totals=totals), revision, country,
+                         payment_method, pi_status)
+    sessions.store.put(session_id, state)
+    return state
+
+def ensure_open(state: SessionState):
+    # scaduta da app.maintenance (SESSION_TTL_SECONDS): il carrello va ricreato
+    if state.status == "expired":
+        raise HTTPException(status_code=409, detail="Session expired")
+
+async def write_session(session_id: str, state: SessionState, build) -> SessionState:
+    """
+    Scrive le modifiche di build(state) -> (statements, nuovo stato) con il guard di
+    revisione e aggiorna la cache. Se la sessione è cambiata altrove (altro worker,
+    webhook) ricarica dal DB e riprova una volta.
+    """
+    for attempt in range(2):
+        statements, new_state = await build(state)
+        try:
+            await writes.write(sessions.guard(session_id, state.revision), *statements)
+        except Exception as e:
+            sessions.store.invalidate(session_id)
+            if not sessions.is_stale(e):
+                raise
+            if attempt:
+                raise HTTPException(status_code=409, detail="Session was modified concurrently, retry")
+            state = await load_session(session_id)
+            continue
+        sessions.store.put(session_id, new_state)
+        return new_state
+
+async def session_items_statements(session_id: str, items: list[LineItem]) -> list[tuple[str, list]]:
+    if not items:
+        return []
+    # prezzo unitario al momento del carrello (hit sullo snapshot già caricato da compute_totals)
+    prices = await catalog.snapshot.prices_cents(it.product_id for it in items)
+    params: list = []
+    for pos, it in enumerate(items):
+        params += [session_id, pos, it.product_id, it.quantity, prices.get(it.product_id)]
+    values = ", ".join("(?, ?, ?, ?, ?)" for _ in items)
+    return [(f"INSERT INTO session_items (session_id, position, product_id, quantity, unit_price_minor) VALUES {values}", params)]
+
 @router.post("/checkout/sessions", response_model=Session, summary="Create checkout session")
 async def create_session(
     req: CreateSessionRequest,
     x_idempotency_key: str | None = Header(default=None),  # header ACP
 ):
-    conn = get_conn()
-
     # alias compatibile con GPT Actions (body) + header ACP
     idem = (req.idempotency_key or x_idempotency_key)
-    cached = get_idempotent_response(idem, "create") if idem else None
-    if cached:
-        return Session.model_validate_json(cached)
+    if idem:
+        return await idempotency.store.run(idem, "create", Session, lambda: _create_session(req, idem))
+    return await _create_session(req, None)
 
-    totals = compute_totals(conn, [LineItem(**i.model_dump()) for i in req.items], req.currency, None)
+async def _create_session(req: CreateSessionRequest, idem: str | None) -> Session:
+    country = _buyer_country(req.buyer)
+    totals = await compute_totals([LineItem(**i.model_dump()) for i in req.items], req.currency, None, country)
     cart = Cart(items=req.items, totals=totals)
 
-    pi = create_payment_intent(
-        amount_minor=totals.grand_total_minor,
-        currency=req.currency.lower(),
-        buyer_email=req.buyer.email,
-        shared_payment_token=req.shared_payment_token,
-        metadata={"purpose":"acp_demo","items":json.dumps([i.model_dump() for i in req.items])},
-    )
+    try:
+        pi = await create_payment_intent(
+            amount_minor=totals.grand_total_minor,
+            currency=req.currency.lower(),
+            buyer_email=req.buyer.email,
+            shared_payment_token=req.shared_payment_token,
+            metadata={"purpose":"acp_demo","items":json.dumps([i.model_dump() for i in req.items])},
+            idempotency_key=f"acp-create-{idem}" if idem else None,
+        )
+    except PaymentError as e:
+        raise HTTPException(status_code=502, detail=f"Payment provider error: {e}")
 
     sid = str(uuid.uuid4())
-    conn.execute(
-        "INSERT INTO checkout_sessions (id, status, payment_intent_id, buyer_email, currency, items_json, promo_code, totals_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        [sid, "requires_confirmation", pi["id"], req.buyer.email, req.currency, json.dumps([i.model_dump() for i in req.items]), None, cart.totals.model_dump_json()]
+    # PaymentMethod risolto dallo SPT e stato del PI: /complete conferma senza rileggere il PI
+    payment_method, pi_status = pi.get("payment_method"), pi.get("status")
+    await writes.write(
+        (f"INSERT INTO checkout_sessions (id, status, payment_intent_id, buyer_email, buyer_country, currency, promo_code, "
+         f"payment_method_id, pi_status, {', '.join(db.TOTALS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+         [sid, "requires_confirmation", pi["id"], req.buyer.email, country, req.currency, None, payment_method, pi_status,
+          *_totals_params(totals)]),
+        *await session_items_statements(sid, cart.items),
     )
+    sessions.store.put(sid, SessionState("requires_confirmation", pi["id"], req.buyer.email, req.currency, None, cart, 0, country,
+                                         payment_method, pi_status))
 
-    session_obj = serialize_session(sid, "requires_confirmation", cart, pi["id"])
-    if idem:
-        save_idempotent_response(idem, "create", session_obj.model_dump_json())
+    return serialize_session(sid, "requires_confirmation", cart, pi["id"])
 
-    return session_obj
+@router.post("/checkout/quotes:batch", response_model=BatchQuoteResponse, summary="Quote many cart variants at once")
+async def quote_batch(req: BatchQuoteRequest):
+    """Totali (stesse regole delle sessioni) per più carrelli, senza creare sessioni né PaymentIntent."""
+    rows = await pricing.engine.quote_batch([
+        pricing.Cart([(it.product_id, it.quantity) for it in q.items], q.currency, q.promo_code, q.country) for q in req.quotes
+    ])
+    quotes = []
+    for q, (unknown, *values) in zip(req.quotes, rows):
+        if unknown is not None:
+            quotes.append(Quote(error=f"Unknown product_id: {unknown}"))
+        else:
+            quotes.append(Quote(totals=_totals_model(values, q.currency)))
+    return BatchQuoteResponse(quotes=quotes)
 
 @router.post("/checkout/sessions/{session_id}", response_model=Session, summary="Update checkout session")
 async def update_session(session_id: str, req: UpdateSessionRequest):
-    conn = get_conn()
-    row = conn.execute("SELECT payment_intent_id, currency, items_json, promo_code FROM checkout_sessions WHERE id = ?", [session_id]).fetchone()
-    if not row:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    pi_id, currency, items_json, promo_code = row
-    items = [LineItem(**i) for i in json.loads(items_json)]
+    async def build(state: SessionState):
+        ensure_open(state)
+        items = req.items if req.items is not None else state.cart.items
+        currency = req.currency if req.currency is not None else state.currency
+        promo_code = req.promo_code if req.promo_code is not None else state.promo_code
+        country = _buyer_country(req.buyer) or state.country
 
-    if req.items is not None:
-        items = req.items
-    if req.currency is not None:
-        currency = req.currency
-    if req.promo_code is not None:
-        promo_code = req.promo_code
+        totals = await compute_totals([LineItem(**i.model_dump()) for i in items], currency, promo_code, country)
+        cart = Cart(items=items, totals=totals)
 
-    totals = compute_totals(conn, [LineItem(**i.model_dump()) for i in items], currency, promo_code)
-    cart = Cart(items=items, totals=totals)
+        statements = [(
+            f"UPDATE checkout_sessions SET currency = ?, promo_code = ?, buyer_country = ?, "
+            f"{', '.join(f'{c} = ?' for c in db.TOTALS_COLUMNS)}, revision = revision + 1, updated_at = now() WHERE id = ?",
+            [currency, promo_code, country, *_totals_params(totals), session_id]
+        )]
+        if req.items is not None:
+            statements.append(("DELETE FROM session_items WHERE session_id = ?", [session_id]))
+            statements += await session_items_statements(session_id, items)
+        return statements, state._replace(currency=currency, promo_code=promo_code, country=country, cart=cart,
+                                          revision=state.revision + 1)
 
-    conn.execute(
-        "UPDATE checkout_sessions SET currency = ?, items_json = ?, promo_code = ?, totals_json = ?, updated_at = now() WHERE id = ?",
-        [currency, json.dumps([i.model_dump() for i in items]), promo_code, cart.totals.model_dump_json(), session_id]
-    )
+    state = await write_session(session_id, await load_session(session_id), build)
+    return serialize_session(session_id, "requires_confirmation", state.cart, state.payment_intent_id)
 
-    return serialize_session(session_id, "requires_confirmation", cart, pi_id)
+@router.get("/checkout/sessions/{session_id}", response_model=Session, summary="Get checkout session (poll status)")
+async def get_session(session_id: str):
+    cached = sessions.store.get(session_id)
+    if cached is not None and cached.status not in TERMINAL_STATUSES:
+        # aperta o in conferma (background, 3DS, webhook): il polling vede lo stato del DB, non la cache
+        sessions.store.invalidate(session_id)
+    state = await load_session(session_id)
+    return serialize_session(session_id, state.status, state.cart, state.payment_intent_id)
 
 @router.post("/checkout/sessions/{session_id}/complete", response_model=CompleteResponse, summary="Complete checkout session (confirm payment)")
 async def complete_session(
     session_id: str,
+    response: Response,
     idempotency_key: str | None = Query(default=None),             # alias compat GPT Actions (query)
     x_idempotency_key: str | None = Header(default=None),          # header ACP
+    prefer: str | None = Header(default=None),                     # "respond-async": conferma in background
 ):
-    conn = get_conn()
     idem = idempotency_key or x_idempotency_key
-    cached = get_idempotent_response(idem, "complete") if idem else None
-    if cached:
-        return CompleteResponse.model_validate_json(cached)
+    background = CHECKOUT_COMPLETE_MODE == "async" or "respond-async" in (prefer or "")
+    complete = _complete_session_async if background else _complete_session
+    if idem:
+        result = await idempotency.store.run(idem, "complete", CompleteResponse, lambda: complete(session_id, idem))
+    else:
+        result = await complete(session_id, None)
+    if background and result.status == "requires_action":
+        response.status_code = 202   # conferma in corso: esito con GET /checkout/sessions/{id}
+    return result
 
-    row = conn.execute("SELECT status, payment_intent_id, buyer_email, currency, items_json, totals_json FROM checkout_sessions WHERE id = ?", [session_id]).fetchone()
-    if not row:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def _confirm(state: SessionState, idem: str | None) -> dict:
+    """Una sola chiamata a Stripe: PaymentMethod e stato del PI sono già nella sessione."""
+    payment_method = state.payment_method
+    if state.pi_status is None:
+        # sessione creata prima delle colonne payment_method_id/pi_status
+        payment_method = (await retrieve_payment_intent(state.payment_intent_id)).get("payment_method")
+    try:
+        return await confirm_payment_intent(state.payment_intent_id, payment_method,
+                                            idempotency_key=f"acp-complete-{idem}" if idem else None)
+    except PaymentError as e:
+        if e.status != 402:
+            raise
+        return {"status": "failed"}   # carta rifiutata: la sessione fallisce
 
-    status, pi_id, buyer_email, currency, items_json, totals_json = row
-    items = [LineItem(**i) for i in json.loads(items_json)]
-    totals = CartTotals.model_validate_json(totals_json)
-    cart = Cart(items=items, totals=totals)
+async def _finish(session_id: str, state: SessionState, res: dict) -> SessionState:
+    """
+    Esito della conferma già avvenuta su Stripe: senza guard di revisione, perché un 409 qui
+    lascerebbe un pagamento riuscito senza ordine. Le condizioni stanno nell'SQL: l'ordine solo
+    se manca (anche il webhook payment_intent.succeeded lo crea), succeeded non si sovrascrive.
+    """
+    pi_id = state.payment_intent_id
+    new_status = PI_SESSION_STATUS.get(res.get("status"), "failed")
+    statements = []
+    if new_status == "succeeded":
+        statements += [(
+            "INSERT INTO orders (id, payment_intent_id, buyer_email, amount_minor, currency) "
+            "SELECT ?, s.payment_intent_id, s.buyer_email, s.grand_total_minor, s.currency FROM checkout_sessions s "
+            "WHERE s.id = ? AND NOT EXISTS (SELECT 1 FROM orders WHERE payment_intent_id = ?)",
+            [str(uuid.uuid4()), session_id, pi_id]
+        ), (db.ORDER_ITEMS_FROM_SESSION_SQL, [pi_id])]
+    statements.append((
+        "UPDATE checkout_sessions SET status = ?, pi_status = ?, payment_method_id = coalesce(?, payment_method_id), "
+        "revision = revision + 1, updated_at = now() WHERE id = ? AND status <> 'succeeded'",
+        [new_status, res.get("status"), res.get("payment_method"), session_id]))
 
-    res = confirm_payment_intent(pi_id)
-    new_status = "succeeded" if res.get("status") == "succeeded" else "failed"
+    # ordine e stato della sessione nello stesso commit; poi lo stato effettivo dal DB
+    await writes.write(*statements)
+    sessions.store.invalidate(session_id)
+    return await load_session(session_id)
 
-    if new_status == "succeeded":
-        conn.execute(
-            "INSERT INTO orders (id, payment_intent_id, buyer_email, amount_minor, currency, items_json) VALUES (?, ?, ?, ?, ?, ?)",
-            [str(uuid.uuid4()), pi_id, buyer_email, totals.grand_total_minor, currency, json.dumps([i.model_dump() for i in items])]
-        )
+async def _complete_session(session_id: str, idem: str | None) -> CompleteResponse:
+    state = await load_session(session_id)
+    ensure_open(state)
+    if state.pi_status == CONFIRMING:
+        # conferma già in corso in background (modalità async): nessuna seconda chiamata a Stripe
+        return CompleteResponse(id=session_id, status=state.status, cart=state.cart, payment_intent_id=state.payment_intent_id)
+    try:
+        res = await _confirm(state, idem)
+    except PaymentError as e:
+        raise HTTPException(status_code=502, detail=f"Payment provider error: {e}")
+    state = await _finish(session_id, state, res)
+    return CompleteResponse(id=session_id, status=state.status, cart=state.cart, payment_intent_id=state.payment_intent_id)
 
-    conn.execute("UPDATE checkout_sessions SET status = ?, updated_at = now() WHERE id = ?", [new_status, session_id])
+# Conferme in background della modalità async (attese allo shutdown da drain_completions)
+_completions: set[asyncio.Task] = set()
 
-    resp = CompleteResponse(id=session_id, status=new_status, cart=cart, payment_intent_id=pi_id)
-    if idem:
-        save_idempotent_response(idem, "complete", resp.model_dump_json())
+async def _complete_session_async(session_id: str, idem: str | None) -> CompleteResponse:
+    """
+    Segna la sessione requires_action (pi_status CONFIRMING) e risponde subito; la conferma
+    e l'ordine seguono in background. Un secondo /complete su una sessione già in conferma
+    non ripete la chiamata a Stripe.
+    """
+    claimed = False
+
+    async def build(state: SessionState):
+        nonlocal claimed
+        ensure_open(state)
+        if state.status == "succeeded" or state.pi_status == CONFIRMING:
+            return [], state
+        claimed = True
+        return [("UPDATE checkout_sessions SET status = 'requires_action', pi_status = ?, "
+                 "revision = revision + 1, updated_at = now() WHERE id = ?", [CONFIRMING, session_id])], \
+            state._replace(status="requires_action", pi_status=CONFIRMING, revision=state.revision + 1)
+
+    previous = await load_session(session_id)
+    state = await write_session(session_id, previous, build)
+    if claimed:
+        task = asyncio.get_running_loop().create_task(_complete_in_background(session_id, previous, state, idem))
+        _completions.add(task)
+        task.add_done_callback(_completions.discard)
+    return CompleteResponse(id=session_id, status=state.status, cart=state.cart, payment_intent_id=state.payment_intent_id)
+
+async def _complete_in_background(session_id: str, previous: SessionState, state: SessionState, idem: str | None):
+    try:
+        try:
+            res = await _confirm(previous, idem)
+        except PaymentError as e:
+            logger.warning("background confirm failed for session %s: %s", session_id, e)
+            await _release(session_id, previous.pi_status)
+        else:
+            await _finish(session_id, state, res)
+    except Exception:
+        logger.exception("background completion failed for session %s", session_id)
+
+async def _release(session_id: str, pi_status: str | None):
+    """
+    Errore del provider: la sessione torna confermabile e il client può ripetere /complete.
+    Senza guard di revisione (un 409 qui la lascerebbe bloccata in CONFIRMING): solo se
+    nessun webhook ha già sostituito il marker.
+    """
+    await writes.write(("UPDATE checkout_sessions SET status = 'requires_confirmation', pi_status = ?, "
+                        "revision = revision + 1, updated_at = now() WHERE id = ? AND pi_status = ?",
+                        [pi_status, session_id, CONFIRMING]))
+    sessions.store.invalidate(session_id)
 
-    return resp
+async def drain_completions(timeout: float = 10.0):
+    if _completions:
+        await asyncio.wait(list(_completions), timeout=timeout)
@@ -1,72 +1,115 @@
-from typing import List
+from typing import List, Union
+from collections import OrderedDict
+from functools import lru_cache
+import base64, hashlib, json, math, re, zlib
+from contextlib import aclosing
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import timezone
 from fastapi import APIRouter, HTTPException, Query
-from ..db import get_conn
-from ..models import Product
-from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from .. import db, search, catalog
+from ..models import FacetCount, PriceBucket, Product, ProductFacets, ProductPage
+from fastapi.responses import Response, StreamingResponse
 from fastapi import Request
-from fastapi.encoders import jsonable_encoder
 import logging
 import os
 
 logger = logging.getLogger("acp.products")
 router = APIRouter(tags=["products"])
 
-def table_has(conn, table: str, col: str) -> bool:
-    rows = conn.execute(f"PRAGMA table_info('{table}')").fetchall()
-    return any(r[1] == col for r in rows)
+REQUIRED_COLUMNS = ("id", "title", "description", "price", "currency")
 
-@router.get("/products", summary="List products (public)", response_model=List[Product])
-async def list_products(
-    request: Request,
-    limit: int = Query(100, ge=1, le=500, description="Limit the number of products returned."),
-    offset: int = Query(0, ge=0, description="Offset for pagination."),
-    category: str = Query(None, description="Product category, e.g. 'shoes'."),
-    q: str = Query(None, description="Search query for title, brand, category, or description."),
-    max_price: float = Query(None, description="Maximum price filter."),
-    color: str = Query(None, description="Filter by color, e.g. 'red'."),
-    size: str = Query(None, description="Filter by size, e.g. '44', '44.5'.")
-):
-    logger.info("QUERY_PARAMS %s", dict(request.query_params))   # <— log esplicito
-    """
-    Restituisce prodotti in formato ACP esteso con campi:
-    id, title, description, link, brand, category, price, currency, image_url, size, color, return_policy, available.
-    """
-    conn = get_conn()
+# Predicato SQL per ciascun filtro (ordine fisso = chiave di cache stabile)
+FILTER_SQL = {
+    "category": "LOWER(category) = LOWER(?)",
+    "q": "(title ILIKE ? OR brand ILIKE ? OR category ILIKE ? OR description ILIKE ?)",
+    "max_price": "price <= ?",
+    "color": "LOWER(color) = LOWER(?)",
+    "size": "replace(size, ',', '.') = replace(?, ',', '.')",
+    "after_id": "id > ?",
+    # risultati dell'indice di ricerca come unica stringa (ID_SEPARATOR): una lista Python è lenta da legare
+    "ids": "id IN (SELECT unnest(string_split(?, chr(31))))",
+}
+ID_SEPARATOR = chr(31)
 
-    # Verifica schema base
-    required = ["id", "title", "description", "price", "currency"]
-    for c in required:
-        if not table_has(conn, "products", c):
-            raise HTTPException(status_code=500, detail=f"products table missing required column '{c}'")
+# Scaglioni di prezzo di /products/facets: [0, 25), [25, 50), ... [500, +inf)
+FACET_PRICE_EDGES = (25, 50, 100, 250, 500)
+FACETS_CACHE_SIZE = 256
 
-    base = os.getenv("PUBLIC_BASE_URL", "https://acp-merchant.onrender.com")
+# URL che HttpUrl accetterebbe senza riscriverli: host minuscolo con TLD, niente
+# porta/query/escape, path presente e senza segmenti "." o ".."
+_PLAIN_URL = re.compile(r"^https?://[a-z0-9-]+(\.[a-z0-9-]+)*\.[a-z]{2,}(?!.*/\.)/[A-Za-z0-9._~!$&'()*+,;=:@/-]*$")
+_PLAIN_ID = re.compile(r"^[A-Za-z0-9._~-]{1,100}$")
+
+# Primo valore del parametro cursor: avvia la paginazione keyset
+CURSOR_START = "start"
+
+def encode_cursor(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    if cursor == CURSOR_START:
+        return {}
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return data
 
-    where, params = [], []
+def catalog_filters(category: str | None, q: str | None, max_price: float | None, color: str | None,
+                    size: str | None) -> tuple[list[str], list, bool]:
+    """
+    Filtri SQL (chiavi di FILTER_SQL) e parametri comuni a /products e /products/facets.
+    ranked=True: q non è un filtro SQL ma va risolta con l'indice di ricerca (search.index).
+    """
+    filters, params = [], []
     if category:
-        where.append("LOWER(category) = LOWER(?)")
+        filters.append("category")
         params.append(category)
-    if q:
+    ranked = bool(q) and search.SEARCH_BACKEND == "index"
+    if q and not ranked:
         like = f"%{q}%"
-        where.append("(title ILIKE ? OR brand ILIKE ? OR category ILIKE ? OR description ILIKE ?)")
+        filters.append("q")
         params += [like, like, like, like]
     if max_price is not None:
-        where.append("price <= ?")
+        filters.append("max_price")
         params.append(max_price)
     if color:
-        where.append("LOWER(color) = LOWER(?)")
+        filters.append("color")
         params.append(color)
     if size:
-        where.append("replace(size, ',', '.') = replace(?, ',', '.')")
+        filters.append("size")
         params.append(size)
+    return filters, params, ranked
+
+def where_clause(filters: tuple[str, ...]) -> str:
+    return (" WHERE " + " AND ".join(FILTER_SQL[f] for f in filters)) if filters else ""
 
-    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+@lru_cache(maxsize=512)
+def compile_select(columns: frozenset, base: str, filters: tuple[str, ...], n_ids: int = 0) -> str:
+    """
+    SELECT della pagina prodotti per una combinazione di filtri, costruita una
+    volta per schema/base URL. n_ids > 0: pagina per id (ricerca ranked).
+    """
+    if n_ids:
+        tail = " WHERE id IN (" + ", ".join("?" for _ in range(n_ids)) + ")\n        LIMIT ? OFFSET ?"
+    else:
+        tail = where_clause(filters) + "\n        ORDER BY id\n        LIMIT ? OFFSET ?"
+    return select_sql(columns, base) + tail
 
-    query = f"""
+def select_sql(columns: frozenset, base: str) -> str:
+    """SELECT ... FROM products con le colonne lette da row_fields (pagine e feed)."""
+    source = catalog.product_source(columns)
+    base_sql = base.replace("'", "''")
+    return f"""
         SELECT
             id,
             substr(title, 1, 150) AS title_safe,
             substr(description, 1, 5000) AS desc_safe,
-            ('{base}' || '/product/' || id) AS link,
+            ('{base_sql}' || '/product/' || id) AS link,
             brand,
             category,
             price,
@@ -80,37 +123,294 @@ async def list_products(
             color,
             return_policy,
             available
-        FROM products
-        {where_sql}
-        LIMIT ? OFFSET ?
+        FROM {source}"""
+
+@lru_cache(maxsize=128)
+def compile_filter_ids(columns: frozenset, filters: tuple[str, ...]) -> str:
+    return f"SELECT id FROM {catalog.product_source(columns)}{where_clause(filters)}"
+
+@lru_cache(maxsize=128)
+def compile_facets(columns: frozenset, filters: tuple[str, ...]) -> str:
+    """
+    Tutti i facet in una scansione: GROUPING SETS su categoria, colore, taglia e
+    scaglione di prezzo, più () per il totale. Chiavi normalizzate come i filtri
+    (lower, taglia con la virgola), valore mostrato = uno dei valori originali.
+    """
+    bucket = "CASE " + " ".join(f"WHEN price < {edge} THEN {i}" for i, edge in enumerate(FACET_PRICE_EDGES))
+    bucket += f" ELSE {len(FACET_PRICE_EDGES)} END"
+    return f"""
+        SELECT grouping(category_key, color_key, size_key, price_bucket) AS g,
+               any_value(category), any_value(color), any_value(size), price_bucket, count(*)
+        FROM (
+            SELECT category, color, size,
+                   lower(category) AS category_key,
+                   lower(color) AS color_key,
+                   replace(size, ',', '.') AS size_key,
+                   CASE WHEN price IS NULL THEN NULL ELSE {bucket} END AS price_bucket
+            FROM {catalog.product_source(columns)}{where_clause(filters)}
+        )
+        GROUP BY GROUPING SETS ((category_key), (color_key), (size_key), (price_bucket), ())
     """
-    params += [int(limit), int(offset)]
-    rows = conn.execute(query, params).fetchall()
 
-    items: List[Product] = []
-    skipped = 0
+# grouping(): bit a 1 per le colonne non raggruppate (category_key è il bit più alto)
+_FACET_SETS = {0b0111: "category", 0b1011: "color", 0b1101: "size", 0b1110: "price"}
 
+def facets_payload(rows) -> dict:
+    values: dict[str, list] = {"category": [], "color": [], "size": [], "price": []}
+    total = 0
+    for g, category, color, size, bucket, count in rows:
+        facet = _FACET_SETS.get(g)
+        if facet is None:
+            total = count
+        elif facet == "price":
+            if bucket is not None:
+                low = FACET_PRICE_EDGES[bucket - 1] if bucket else 0
+                high = FACET_PRICE_EDGES[bucket] if bucket < len(FACET_PRICE_EDGES) else None
+                values["price"].append(PriceBucket(min=low, max=high, count=count))
+        else:
+            value = {"category": category, "color": color, "size": size}[facet]
+            if value not in (None, ""):
+                values[facet].append(FacetCount(value=str(value), count=count))
+    for facet in ("category", "color", "size"):
+        values[facet].sort(key=lambda f: (-f.count, f.value))
+    values["price"].sort(key=lambda b: b.min)
+    return ProductFacets(total=total, **values).model_dump(mode="json")
+
+def row_fields(r) -> dict:
+    """Riga DuckDB (colonne di compile_select) -> campi di Product normalizzati."""
+    return {
+        "id": str(r[0]),
+        "title": str(r[1]) if r[1] is not None else "",
+        "description": str(r[2]) if r[2] is not None else "",
+        "link": str(r[3]),
+        "brand": r[4] or None,
+        "category": r[5] or None,
+        "price": float(r[6]) if r[6] is not None else 0.0,
+        "currency": str(r[7]) if r[7] else "EUR",
+        "image_url": r[8] or None,
+        "size": (str(r[9]) if r[9] not in (None, '') else None),
+        "color": (r[10] or None),
+        "return_policy": (r[11] or None),
+        "available": bool(r[12]) if r[12] is not None else True,
+    }
+
+def is_plain(fields: dict) -> bool:
+    """True se la riga è serializzabile così com'è (Product non la modificherebbe)."""
+    image_url, price = fields["image_url"], fields["price"]
+    return (
+        _PLAIN_ID.match(fields["id"]) is not None
+        and _PLAIN_URL.match(fields["link"]) is not None
+        and (image_url is None or _PLAIN_URL.match(image_url) is not None)
+        and math.isfinite(price)
+    )
+
+def encode_items(rows) -> tuple[list[dict], int]:
+    """Serializzazione in blocco senza Pydantic; Product decide solo per le righe non banali."""
+    items, skipped = [], 0
     for r in rows:
-        try:
-            items.append(Product(
-                id=str(r[0]),
-                title=str(r[1]) if r[1] is not None else "",
-                description=str(r[2]) if r[2] is not None else "",
-                link=str(r[3]),
-                brand=r[4] or None,
-                category=r[5] or None,
-                price=float(r[6]) if r[6] is not None else 0.0,
-                currency=str(r[7]) if r[7] else "EUR",
-                image_url=r[8] or None,
-                size=(str(r[9]) if r[9] not in (None, '') else None),
-                color=(r[10] or None),
-                return_policy=(r[11] or None),
-                available=bool(r[12]) if r[12] is not None else True,
-            ))
-        except ValidationError as e:
-            skipped += 1
-            logger.warning("Product validation skipped id=%s error=%s", r[0], e)
-
-    payload = jsonable_encoder(items)
-    resp = JSONResponse(content=payload, headers={"X-Items-Skipped": str(skipped)})
-    return resp
+        fields = row_fields(r)
+        if not is_plain(fields):
+            try:
+                fields = Product(**fields).model_dump(mode="json")
+            except ValidationError as e:
+                skipped += 1
+                logger.warning("Product validation skipped id=%s error=%s", r[0], e)
+                continue
+        items.append(fields)
+    return items, skipped
+
+def products_etag(version, base: str, query_params) -> str:
+    key = json.dumps([version, base, sorted(query_params.multi_items())], default=str)
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+@router.get("/products", summary="List products (public)", response_model=Union[List[Product], ProductPage])
+async def list_products(
+    request: Request,
+    limit: int = Query(100, ge=1, le=500, description="Limit the number of products returned."),
+    offset: int = Query(0, ge=0, description="Offset for pagination."),
+    cursor: str = Query(None, description="Cursor pagination: pass 'start' for the first page, then the returned next_cursor. Returns {items, next_cursor}."),
+    category: str = Query(None, description="Product category, e.g. 'shoes'."),
+    q: str = Query(None, description="Search query for title, brand, category, or description."),
+    max_price: float = Query(None, description="Maximum price filter."),
+    color: str = Query(None, description="Filter by color, e.g. 'red'."),
+    size: str = Query(None, description="Filter by size, e.g. '44', '44.5'.")
+):
+    logger.info("QUERY_PARAMS %s", dict(request.query_params))   # <— log esplicito
+    """
+    Restituisce prodotti in formato ACP esteso con campi:
+    id, title, description, link, brand, category, price, currency, image_url, size, color, return_policy, available.
+    """
+    # Verifica schema base (snapshot caricato all'avvio, niente PRAGMA per richiesta)
+    columns = await catalog.schema.get()
+    for c in REQUIRED_COLUMNS:
+        if c not in columns:
+            raise HTTPException(status_code=500, detail=f"products table missing required column '{c}'")
+
+    base = os.getenv("PUBLIC_BASE_URL", "https://acp-merchant.onrender.com")
+
+    # ETag da versione catalogo + parametri: i poll ripetuti tornano 304 senza query
+    await catalog.snapshot.refresh()
+    etag = products_etag(catalog.snapshot.version, base, request.query_params)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    filters, params, ranked = catalog_filters(category, q, max_price, color, size)
+    ranked_ids = None
+    keyset = decode_cursor(cursor) if cursor is not None else None
+    next_cursor = None
+    if ranked:
+        # Ricerca full-text: id ordinati per BM25 dall'indice in memoria
+        await search.index.refresh()
+        # In modalità cursore il cursore è la posizione nella lista ordinata per rank
+        if keyset is not None:
+            pos = keyset.get("pos", 0)
+            # bool è un int in Python: true/false non sono posizioni valide
+            if set(keyset) - {"pos"} or not isinstance(pos, int) or isinstance(pos, bool) or pos < 0:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            offset = pos
+        top = None if filters else int(offset) + int(limit) + 1
+        ranked_ids = [doc_id for doc_id, _ in search.index.search(q, top=top)]
+
+    if keyset is not None and ranked_ids is None:
+        # Seek sull'id (chiave primaria): costo costante anche a pagine profonde
+        if set(keyset) - {"id"} or ("id" in keyset and not isinstance(keyset["id"], str)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if "id" in keyset:
+            filters.append("after_id")
+            params.append(keyset["id"])
+        offset = 0
+
+    if ranked_ids is not None:
+        # Gli altri filtri restano in SQL; la pagina si taglia sull'ordine di rank
+        if filters:
+            allowed = {r[0] for r in await db.fetchall(compile_filter_ids(columns, tuple(filters)), params, name="products.filter_ids", catalog=True)}
+            ranked_ids = [i for i in ranked_ids if i in allowed]
+        page_ids = ranked_ids[int(offset):int(offset) + int(limit)] or [None]
+        if keyset is not None and int(offset) + int(limit) < len(ranked_ids):
+            next_cursor = encode_cursor({"pos": int(offset) + int(limit)})
+        query = compile_select(columns, base, (), len(page_ids))
+        params, offset = list(page_ids), 0
+    else:
+        query = compile_select(columns, base, tuple(filters))
+
+    params += [int(limit), int(offset)]
+    rows = await db.fetchall(query, params, name="products.page", catalog=True)
+    if ranked_ids is not None:
+        rank = {pid: i for i, pid in enumerate(page_ids)}
+        rows.sort(key=lambda r: rank[r[0]])
+    elif keyset is not None and len(rows) == int(limit):
+        next_cursor = encode_cursor({"id": rows[-1][0]})
+
+    payload, skipped = encode_items(rows)
+    headers = {"X-Items-Skipped": str(skipped), "ETag": etag}
+    if keyset is not None:
+        payload = {"items": payload, "next_cursor": next_cursor}
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+    body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Righe per blocco del feed: memoria del processo costante qualunque sia la dimensione del catalogo
+FEED_BATCH_ROWS = int(os.getenv("FEED_BATCH_ROWS", "2000"))
+
+def not_modified_since(if_modified_since: str | None, updated_at) -> bool:
+    if not if_modified_since or updated_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # Last-Modified ha la risoluzione del secondo
+    return updated_at.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+async def feed_chunks(columns: frozenset, base: str, gzip: bool):
+    """NDJSON del catalogo a blocchi di FEED_BATCH_ROWS righe, compresso in streaming se gzip."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None   # wbits 31 = formato gzip
+    rows_out = skipped = 0
+    async with aclosing(db.stream(select_sql(columns, base), batch_rows=FEED_BATCH_ROWS, name="products.feed", catalog=True)) as batches:
+        async for rows in batches:
+            items, n_skipped = encode_items(rows)
+            rows_out += len(items)
+            skipped += n_skipped
+            chunk = "".join(json.dumps(item, ensure_ascii=False, allow_nan=False, separators=(",", ":")) + "\n"
+                            for item in items).encode("utf-8")
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+    logger.info("products feed streamed rows=%d skipped=%d gzip=%s", rows_out, skipped, gzip)
+
+@router.get("/products/feed", summary="Full catalog feed as NDJSON (public)", response_class=StreamingResponse,
+            responses={200: {"content": {"application/x-ndjson": {}}, "description": "One Product JSON object per line"}})
+async def product_feed(request: Request):
+    """
+    Tutto il catalogo, un Product per riga, in streaming (gzip con Accept-Encoding: gzip).
+    Last-Modified/ETag dalla versione del catalogo: If-Modified-Since o If-None-Match
+    su un feed invariato -> 304 senza leggere i prodotti.
+    """
+    columns = await catalog.schema.get()
+    await catalog.snapshot.refresh()
+    base = os.getenv("PUBLIC_BASE_URL", "https://acp-merchant.onrender.com")
+    gzip = "gzip" in request.headers.get("accept-encoding", "")
+    etag = products_etag(catalog.snapshot.version, f"feed:{'gzip' if gzip else 'identity'}:{base}", request.query_params)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    updated_at = catalog.snapshot.updated_at
+    if updated_at is not None:
+        headers["Last-Modified"] = format_datetime(updated_at.replace(tzinfo=timezone.utc), usegmt=True)
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, etag) or (
+            if_none_match is None and not_modified_since(request.headers.get("if-modified-since"), updated_at)):
+        return Response(status_code=304, headers=headers)
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(feed_chunks(columns, base, gzip), media_type="application/x-ndjson", headers=headers)
+
+# Risposte di /products/facets già codificate, per versione catalogo + filtri
+_facets_cache: OrderedDict[tuple, bytes] = OrderedDict()
+
+@router.get("/products/facets", summary="Facet counts for a product filter set (public)", response_model=ProductFacets)
+async def product_facets(
+    request: Request,
+    category: str = Query(None, description="Product category, e.g. 'shoes'."),
+    q: str = Query(None, description="Search query for title, brand, category, or description."),
+    max_price: float = Query(None, description="Maximum price filter."),
+    color: str = Query(None, description="Filter by color, e.g. 'red'."),
+    size: str = Query(None, description="Filter by size, e.g. '44', '44.5'.")
+):
+    """
+    Conteggi per categoria, colore, taglia e scaglione di prezzo dei prodotti che
+    GET /products restituirebbe con gli stessi filtri: una chiamata al posto di
+    molte pagine esplorative.
+    """
+    columns = await catalog.schema.get()
+    await catalog.snapshot.refresh()
+    etag = products_etag(catalog.snapshot.version, "facets", request.query_params)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    key = (catalog.snapshot.version, search.SEARCH_BACKEND, category, q, max_price, color, size)
+    body = _facets_cache.get(key)
+    if body is None:
+        filters, params, ranked = catalog_filters(category, q, max_price, color, size)
+        if ranked:
+            await search.index.refresh()
+            filters.append("ids")
+            params.append(ID_SEPARATOR.join(doc_id for doc_id, _ in search.index.search(q)))
+        rows = await db.fetchall(compile_facets(columns, tuple(filters)), params, name="products.facets", catalog=True)
+        body = json.dumps(facets_payload(rows), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        _facets_cache[key] = body
+        while len(_facets_cache) > FACETS_CACHE_SIZE:
+            _facets_cache.popitem(last=False)
+    else:
+        _facets_cache.move_to_end(key)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
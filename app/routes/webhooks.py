@@ -1,10 +1,10 @@
 
-import os
-import stripe
+import os, json
 from fastapi import APIRouter, Request, HTTPException
 
+from ..events import pipeline
+
 router = APIRouter(tags=["webhooks"])
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "")
 
 @router.post("/webhooks/stripe", summary="Stripe webhook (test/demo)")
 async def stripe_webhook(request: Request):
@@ -12,10 +12,14 @@ async def stripe_webhook(request: Request):
     sig_header = request.headers.get("stripe-signature")
     webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 
+    # SDK stripe importato al primo webhook: è metà del tempo di import dell'app a freddo
+    import stripe
     try:
-        event = stripe.Webhook.construct_event(payload=payload, sig_header=sig_header, secret=webhook_secret)
+        stripe.Webhook.construct_event(payload=payload, sig_header=sig_header, secret=webhook_secret)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Webhook error: {e}")
 
-    print(f"[WEBHOOK] {event.get('type')}")
+    # Ack immediato: l'applicazione dello stato avviene nel worker a blocchi
+    if not pipeline.enqueue(json.loads(payload)):
+        raise HTTPException(status_code=503, detail="Webhook queue full", headers={"Retry-After": "5"})
     return {"received": True}
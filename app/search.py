@@ -0,0 +1,196 @@
+import asyncio, bisect, heapq, logging, math, os, re, unicodedata
+from collections import Counter
+from functools import lru_cache
+from typing import Optional
+
+from . import db, catalog
+
+logger = logging.getLogger("acp.search")
+
+# "index" = indice invertito BM25 in memoria, "ilike" = vecchio percorso ILIKE
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "index").lower()
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# Stopword minime IT/EN: solo parole che non discriminano mai in un catalogo
+STOPWORDS = frozenset("""
+a ad al alla alle allo agli ai con da dal dalla dei del della delle di e ed gli i il in la le lo
+nel nella per su sul sulla tra fra un una uno
+an and at by for from in of on or the to with
+""".split())
+
+# Peso dei campi: i token del titolo contano doppio
+FIELD_WEIGHTS = (("title", 2), ("brand", 1), ("category", 1), ("description", 1))
+
+
+def fold(text: str) -> str:
+    """Minuscolo + rimozione accenti: 'Città' -> 'citta', 'CAFÉ' -> 'cafe'."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+@lru_cache(maxsize=65536)
+def _fold_token(tok: str) -> str:
+    return fold(tok)
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    if not text:
+        return []
+    if not text.isascii():
+        text = unicodedata.normalize("NFC", text)
+    out = []
+    for tok in _WORD.findall(text.casefold()):
+        if not tok.isascii():
+            tok = _fold_token(tok)
+        if tok not in STOPWORDS:
+            out.append(tok)
+    return out
+
+
+def document_terms(fields: dict) -> Counter:
+    terms = Counter()
+    for name, weight in FIELD_WEIGHTS:
+        for tok in tokenize(fields.get(name)):
+            terms[tok] += weight
+    return terms
+
+
+class SearchIndex:
+    """
+    Indice invertito BM25 costruito dalla tabella products.
+    Alla variazione della versione catalogo vengono ri-tokenizzati solo i
+    prodotti il cui contenuto è cambiato; quelli spariti vengono rimossi.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self.postings: dict[str, dict[str, int]] = {}
+        self.doc_len: dict[str, int] = {}
+        self.doc_terms: dict[str, Counter] = {}
+        self.doc_sig: dict[str, int] = {}
+        self._total_len = 0
+        self._vocab: Optional[list[str]] = None
+        self._weights: dict[str, dict[str, float]] = {}
+        self._lock = asyncio.Lock()
+
+    def remove(self, doc_id: str):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self.postings[term]
+        self._total_len -= self.doc_len.pop(doc_id, 0)
+        self.doc_sig.pop(doc_id, None)
+        self._vocab = None
+        self._weights.clear()
+
+    def upsert(self, doc_id: str, terms: Counter, sig: int):
+        self.remove(doc_id)
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        length = sum(terms.values())
+        self.doc_terms[doc_id] = terms
+        self.doc_len[doc_id] = length
+        self.doc_sig[doc_id] = sig
+        self._total_len += length
+        self._vocab = None
+        # nuovo documento: cambiano idf e lunghezza media di tutti i termini (remove() esce
+        # subito per gli id sconosciuti e non svuoterebbe la cache)
+        self._weights.clear()
+
+    def _expand(self, term: str) -> list[str]:
+        if term in self.postings:
+            return [term]
+        if len(term) < 3:
+            return []
+        # Nessun token esatto: prova come prefisso ("scarp" -> "scarpe")
+        if self._vocab is None:
+            self._vocab = sorted(self.postings)
+        i = bisect.bisect_left(self._vocab, term)
+        out = []
+        while i < len(self._vocab) and self._vocab[i].startswith(term):
+            out.append(self._vocab[i])
+            i += 1
+        return out
+
+    def _term_weights(self, term: str) -> dict[str, float]:
+        """Contributo BM25 del termine per documento; in cache fino alla prossima modifica."""
+        weights = self._weights.get(term)
+        if weights is None:
+            n_docs = len(self.doc_len)
+            avg_len = self._total_len / n_docs
+            docs = self.postings[term]
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            k1, b, doc_len = self.k1, self.b, self.doc_len
+            weights = {
+                doc_id: idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len[doc_id] / avg_len))
+                for doc_id, tf in docs.items()
+            }
+            self._weights[term] = weights
+        return weights
+
+    def search(self, q: str, top: Optional[int] = None) -> list[tuple[str, float]]:
+        """
+        Risultati (id, score) ordinati per BM25 decrescente, a parità per id.
+        Con top=N restituisce solo i primi N (selezione parziale, niente sort completo).
+        """
+        if not self.doc_len:
+            return []
+        terms = [t for qterm in set(tokenize(q)) for t in self._expand(qterm)]
+        if not terms:
+            return []
+        if len(terms) == 1:
+            scores = self._term_weights(terms[0])
+        else:
+            scores = {}
+            for term in set(terms):
+                for doc_id, w in self._term_weights(term).items():
+                    scores[doc_id] = scores.get(doc_id, 0.0) + w
+        order = lambda kv: (-kv[1], kv[0])
+        if top is not None:
+            return heapq.nsmallest(top, scores.items(), key=order)
+        return sorted(scores.items(), key=order)
+
+    def _diff(self, cur, known: dict[str, int]):
+        """Nel pool DB: legge il catalogo e tokenizza solo i prodotti cambiati."""
+        source = catalog.product_source(catalog.schema.columns or frozenset())
+        rows = cur.execute(f"SELECT id, title, brand, category, description FROM {source}").fetchall()
+        changed, seen = [], set()
+        for pid, title, brand, category, description in rows:
+            pid = str(pid)
+            seen.add(pid)
+            sig = hash((title, brand, category, description))
+            if known.get(pid) != sig:
+                fields = {"title": title, "brand": brand, "category": category, "description": description}
+                changed.append((pid, document_terms(fields), sig))
+        removed = [pid for pid in known if pid not in seen]
+        return changed, removed
+
+    async def refresh(self):
+        await catalog.snapshot.refresh()
+        if self.version == catalog.snapshot.version:
+            return
+        async with self._lock:
+            version = catalog.snapshot.version
+            if self.version == version:
+                return
+            await catalog.schema.get()
+            changed, removed = await db.run(self._diff, dict(self.doc_sig), catalog=True)
+            for pid in removed:
+                self.remove(pid)
+            for pid, terms, sig in changed:
+                self.upsert(pid, terms, sig)
+            self.version = version
+            logger.info("search index version=%s docs=%d changed=%d removed=%d",
+                        version, len(self.doc_len), len(changed), len(removed))
+
+
+index = SearchIndex()
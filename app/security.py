@@ -5,11 +5,16 @@ from fastapi.security.api_key import APIKeyHeader
 
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
+def api_keys() -> frozenset[str]:
+    """API_KEY più API_KEYS (separate da virgola): una chiave per agente/cliente, con il proprio budget (app.admission)."""
+    keys = [os.getenv("API_KEY") or "", *(os.getenv("API_KEYS") or "").split(",")]
+    return frozenset(k.strip() for k in keys if k.strip())
+
 def verify_api_key(api_key: str = Depends(api_key_header)):
-    expected = os.getenv("API_KEY")
-    if not expected:
+    keys = api_keys()
+    if not keys:
         # If not set, allow only for local/dev
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="API_KEY not configured")
-    if api_key != expected:
+    if api_key not in keys:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or missing API key")
     return True
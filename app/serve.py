@@ -0,0 +1,91 @@
+"""
+Avvio multi-worker con un solo comando: python -m app.serve --workers N
+
+DuckDB ammette un solo processo che apre il file in scrittura, quindi:
+- un processo writer possiede il database (init_db, migrazioni, sweeper
+  idempotency, rollup analytics, app.maintenance) e serve le query dei worker
+  su un socket Unix;
+- N worker uvicorn servono HTTP: il catalogo da uno snapshot in memoria
+  (db.sync_catalog), tutto il resto inoltrato al writer (db.run -> app.ipc).
+"""
+import argparse, asyncio, logging, os, shutil, signal, tempfile, threading
+
+from . import ipc
+
+logger = logging.getLogger("acp.serve")
+
+WRITER_START_TIMEOUT = float(os.getenv("WRITER_START_TIMEOUT", "60"))
+
+
+def _writer_main(path: str, ready):
+    import multiprocessing
+    os.environ["DB_ROLE"] = "writer"
+    from . import analytics, db, idempotency, maintenance
+
+    logging.basicConfig(level=logging.INFO)
+    db.init_db()
+    server = ipc.WriterServer(path, lambda fn, args: fn(db.cursor(), *args))
+    threading.Thread(target=server.serve_forever, name="acp-writer-ipc", daemon=True).start()
+    logger.info("writer ready on %s", path)
+    ready.send(path)
+    ready.close()
+
+    async def jobs():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        # uvicorn rilancia il segnale ricevuto dopo lo shutdown: il launcher può
+        # morire senza passare dal finally, quindi il writer si ferma da solo
+        loop.add_reader(multiprocessing.parent_process().sentinel, stop.set)
+        idempotency.start_sweeper()
+        analytics.start_refresher()
+        maintenance.start()
+        await stop.wait()
+        await maintenance.stop()
+        await analytics.stop_refresher()
+        await idempotency.stop_sweeper()
+
+    try:
+        asyncio.run(jobs())
+    finally:
+        server.shutdown()
+        server.server_close()
+        db.close()
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def main(argv=None):
+    import multiprocessing
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="ACP merchant API: writer DuckDB + N worker HTTP")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "2")))
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    args = ap.parse_args(argv)
+
+    # directory privata (0700): socket del writer e snapshot Parquet del catalogo
+    rundir = tempfile.mkdtemp(prefix="acp-")
+    path = os.path.join(rundir, "writer.sock")
+    ctx = multiprocessing.get_context("spawn")
+    ready, ready_w = ctx.Pipe(duplex=False)
+    writer = ctx.Process(target=_writer_main, args=(path, ready_w), name="acp-writer")
+    writer.start()
+    ready_w.close()
+    try:
+        waited = 0.0
+        while not ready.poll(0.1):
+            waited += 0.1
+            if not writer.is_alive() or waited > WRITER_START_TIMEOUT:
+                raise SystemExit("writer process failed to start")
+        os.environ.update(DB_ROLE="worker", DB_WRITER_SOCKET=path)
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        writer.terminate()
+        writer.join(10)
+        shutil.rmtree(rundir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os, time
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+import duckdb
+
+from .models import Cart
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "900"))
+
+STALE_MARKER = "stale checkout session"
+
+# Primo statement di ogni scrittura su una sessione letta dalla cache: se nel frattempo
+# un altro worker o un webhook l'ha modificata (revision diversa) la transazione fallisce
+GUARD_SQL = f"""
+    SELECT error('{STALE_MARKER} ' || ?)
+    WHERE NOT EXISTS (SELECT 1 FROM checkout_sessions WHERE id = ? AND revision = ?)
+"""
+
+# Con più worker una sessione in cache può essere stata cambiata da un altro processo:
+# a ogni hit basta confrontare la revision (lettura per chiave primaria) invece di rileggere tutto
+REVISION_SQL = "SELECT revision FROM checkout_sessions WHERE id = ?"
+
+
+class SessionState(NamedTuple):
+    status: str
+    payment_intent_id: Optional[str]
+    buyer_email: Optional[str]
+    currency: str
+    promo_code: Optional[str]
+    cart: Cart
+    revision: int
+    country: Optional[str] = None
+    payment_method: Optional[str] = None   # agganciato al PI in create
+    pi_status: Optional[str] = None        # ultimo stato noto del PaymentIntent
+
+
+def guard(session_id: str, revision: int) -> tuple[str, list]:
+    return GUARD_SQL, [session_id, session_id, revision]
+
+
+def is_stale(exc: BaseException) -> bool:
+    return isinstance(exc, duckdb.Error) and STALE_MARKER in str(exc)
+
+
+class SessionStore:
+    """
+    Stato delle sessioni già decodificato (carrello e totali come modelli), LRU+TTL.
+    Write-through: le route aggiornano la cache dopo il COMMIT; i webhook la invalidano
+    per PaymentIntent; le modifiche da altri worker le intercetta guard() in scrittura
+    e, in lettura, il confronto con REVISION_SQL (load_session in modalità worker).
+    """
+
+    def __init__(self, size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._cache: OrderedDict[str, tuple[float, SessionState]] = OrderedDict()
+        self._by_pi: dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[SessionState]:
+        hit = self._cache.get(session_id)
+        if hit is None or hit[0] < time.monotonic():
+            if hit is not None:
+                self.invalidate(session_id)
+            self.misses += 1
+            return None
+        self._cache.move_to_end(session_id)
+        self.hits += 1
+        return hit[1]
+
+    def put(self, session_id: str, state: SessionState):
+        if self.size <= 0:
+            return
+        self._cache[session_id] = (time.monotonic() + self.ttl, state)
+        self._cache.move_to_end(session_id)
+        if state.payment_intent_id:
+            self._by_pi[state.payment_intent_id] = session_id
+        while len(self._cache) > self.size:
+            _, (_, old) = self._cache.popitem(last=False)
+            self._by_pi.pop(old.payment_intent_id, None)
+
+    def invalidate(self, session_id: str):
+        hit = self._cache.pop(session_id, None)
+        if hit is not None:
+            self._by_pi.pop(hit[1].payment_intent_id, None)
+
+    def invalidate_payment_intents(self, payment_intent_ids: Iterable[str]):
+        for pi_id in payment_intent_ids:
+            session_id = self._by_pi.pop(pi_id, None)
+            if session_id is not None:
+                self._cache.pop(session_id, None)
+
+
+store = SessionStore()
@@ -0,0 +1,118 @@
+import asyncio, logging, os
+from typing import Any, Optional, Sequence
+
+from . import db
+
+logger = logging.getLogger("acp.writes")
+
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_DELAY_MS = float(os.getenv("WRITE_BATCH_DELAY_MS", "2"))
+
+Statement = tuple[str, Sequence[Any]]
+
+
+def apply_groups(cur, groups: list[list[Statement]]) -> list[Optional[BaseException]]:
+    """
+    Nel pool DB: tutte le scritture del blocco in una sola transazione. Se il
+    blocco fallisce si ripiega su una transazione per gruppo, così un errore
+    resta confinato al chiamante che l'ha causato.
+    """
+    try:
+        cur.execute("BEGIN TRANSACTION")
+        for group in groups:
+            for sql, params in group:
+                cur.execute(sql, params)
+        cur.execute("COMMIT")
+        return [None] * len(groups)
+    except Exception:
+        cur.execute("ROLLBACK")
+        if len(groups) == 1:
+            raise
+
+    results: list[Optional[BaseException]] = []
+    for group in groups:
+        try:
+            cur.execute("BEGIN TRANSACTION")
+            for sql, params in group:
+                cur.execute(sql, params)
+            cur.execute("COMMIT")
+            results.append(None)
+        except Exception as e:
+            cur.execute("ROLLBACK")
+            results.append(e)
+    return results
+
+
+class GroupCommitter:
+    """
+    Group commit per le scritture di sessioni e ordini: i gruppi di statement che
+    arrivano entro max_delay (o fino a max_batch) finiscono in un'unica
+    transazione. submit() ritorna solo dopo il COMMIT che li contiene.
+    """
+
+    def __init__(self, max_batch: int = WRITE_BATCH_MAX, max_delay_ms: float = WRITE_BATCH_DELAY_MS):
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000.0
+        self._pending: list[tuple[list[Statement], asyncio.Future]] = []
+        self._has_work = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.groups = 0
+
+    async def submit(self, *statements: Statement) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((list(statements), fut))
+        self._has_work.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        await fut
+
+    async def _run(self):
+        while True:
+            await self._has_work.wait()
+            if len(self._pending) < self.max_batch and self.max_delay > 0:
+                self._batch_full.clear()
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if not self._pending:
+                self._has_work.clear()
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[tuple[list[Statement], asyncio.Future]]):
+        try:
+            results = await db.run(apply_groups, [group for group, _ in batch], name="writes.group_commit")
+        except Exception as e:
+            results = [e] * len(batch)
+        self.batches += 1
+        self.groups += len(batch)
+        for (_, fut), err in zip(batch, results):
+            if fut.done():
+                continue
+            if err is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(err)
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        if self._pending:
+            batch, self._pending = self._pending, []
+            await self._flush(batch)
+        self._worker.cancel()
+        self._worker = None
+
+
+committer = GroupCommitter()
+
+
+async def write(*statements: Statement) -> None:
+    """Scrittura durevole (committata) tramite il group commit."""
+    await committer.submit(*statements)
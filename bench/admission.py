@@ -0,0 +1,132 @@
+"""
+Benchmark sovraccarico: traffico a ritmo fisso (open loop, come agenti che non rallentano)
+contro uvicorn app.main:app, con e senza app.admission.
+
+Due chiavi API: "noisy" oltre la capacità del server (ricerche /products e create
+/checkout/sessions con Stripe fake a FAKE_STRIPE_LATENCY_MS), "quiet" a pochi req/s.
+Senza controllo di ammissione le code crescono nel server e la latenza esplode per
+tutti; con i budget per chiave e i limiti di concorrenza l'eccesso riceve subito
+429/503 e la latenza di coda delle richieste ammesse resta limitata (timeout di coda
+500 ms nello scenario). Il generatore usa richieste HTTP pre-codificate su socket
+asyncio: con httpx non terrebbe il ritmo sulla stessa CPU del server.
+
+    python -m bench.admission --seconds 10 --noisy-rps 150 --quiet-rps 5
+"""
+import argparse, asyncio, json, os, random, shutil, statistics, tempfile, time
+from urllib.parse import urlencode
+
+import httpx
+
+from bench.loadtest import build_catalog, catalog_profile, free_port, start_server
+
+KEYS = {"noisy": "bench-noisy", "quiet": "bench-quiet"}
+CHECKOUT_SHARE = 0.3
+
+SCENARIOS = {
+    "no admission control": {"PRODUCTS_CONCURRENCY": "0", "CHECKOUT_CONCURRENCY": "0"},
+    "admission control": {"PRODUCTS_RATE_PER_KEY": "20", "CHECKOUT_RATE_PER_KEY": "10", "ADMISSION_QUEUE_TIMEOUT_MS": "500"},
+}
+
+
+def request_bytes(key: str, profile: dict, rng: random.Random) -> tuple[str, bytes]:
+    """Richiesta HTTP/1.1 già codificata: il generatore condivide la CPU col server e deve costare poco."""
+    head = f"Host: bench\r\nX-API-Key: {KEYS[key]}\r\nConnection: close\r\n"
+    if rng.random() < CHECKOUT_SHARE:
+        body = json.dumps({"items": [{"product_id": pid, "quantity": 1} for pid in rng.sample(profile["ids"], 2)],
+                           "currency": "EUR", "buyer": {"email": "agent@example.com"},
+                           "shared_payment_token": "test_spt_visa"}).encode()
+        return "checkout", (f"POST /checkout/sessions HTTP/1.1\r\n{head}Content-Type: application/json\r\n"
+                            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+    query = urlencode({"q": rng.choice(profile["words"]), "limit": 20})
+    return "products", f"GET /products?{query} HTTP/1.1\r\n{head}\r\n".encode()
+
+
+async def one(port: int, key: str, budget: str, payload: bytes, out: list):
+    t0 = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(payload)
+        status = int((await reader.readline()).split()[1])
+        await reader.read()   # Connection: close -> fino a EOF
+        writer.close()
+    except (OSError, IndexError, ValueError):
+        budget, status = "error", 0
+    out.append((key, budget, status, time.perf_counter() - t0))
+
+
+async def open_loop(port: int, key: str, rps: float, seconds: float, profile: dict, out: list):
+    rng = random.Random(key)
+    requests = [request_bytes(key, profile, rng) for _ in range(int(rps * seconds) + 1)]
+    loop = asyncio.get_running_loop()
+    tasks, start = [], loop.time()
+    for i, (budget, payload) in enumerate(requests):
+        delay = start + i / rps - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(loop.create_task(one(port, key, budget, payload, out)))
+    await asyncio.gather(*tasks)
+
+
+async def drive(port: int, args, profile: dict) -> list:
+    out: list = []
+    await asyncio.gather(open_loop(port, "noisy", args.noisy_rps, args.seconds, profile, out),
+                         open_loop(port, "quiet", args.quiet_rps, args.seconds, profile, out))
+    return out
+
+
+def pct(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--noisy-rps", type=float, default=150)
+    ap.add_argument("--quiet-rps", type=float, default=5)
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--stripe-latency-ms", type=float, default=50)
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        conn = build_catalog(os.path.join(workdir, "local.duckdb"), args.rows)
+        profile = catalog_profile(conn)
+        conn.close()
+        print(f"open loop {args.seconds:.0f}s: noisy {args.noisy_rps:.0f} req/s, quiet {args.quiet_rps:.0f} req/s, "
+              f"{CHECKOUT_SHARE:.0%} checkout creates (Stripe fake {args.stripe_latency_ms:.0f} ms)")
+        print(f"{'scenario':<22} {'key':<6} {'budget':<9} {'sent':>6} {'2xx':>6} {'p50 ok':>9} {'p99 ok':>9} "
+              f"{'429':>6} {'503':>6} {'p99 rejected':>13}")
+        for scenario, limits in SCENARIOS.items():
+            port = free_port()
+            env = {"API_KEYS": ",".join(KEYS.values()), "FAKE_STRIPE_LATENCY_MS": str(args.stripe_latency_ms), **limits}
+            server = start_server(workdir, port, env=env)
+            try:
+                # indice di ricerca e snapshot prezzi costruiti fuori dalle misure
+                httpx.get(f"http://127.0.0.1:{port}/products", params={"q": "warmup"}, timeout=300)
+                out = asyncio.run(drive(port, args, profile))
+            finally:
+                server.terminate()
+                server.wait(10)
+            for key in KEYS:
+                for budget in ("products", "checkout"):
+                    rows = [r for r in out if r[0] == key and r[1] == budget]
+                    ok = sorted(r[3] for r in rows if 200 <= r[2] < 300)
+                    rejected = sorted(r[3] for r in rows if r[2] in (429, 503))
+                    n429 = sum(1 for r in rows if r[2] == 429)
+                    n503 = sum(1 for r in rows if r[2] == 503)
+                    print(f"{scenario:<22} {key:<6} {budget:<9} {len(rows):>6} {len(ok):>6} "
+                          f"{pct(ok, 50) * 1000:>6.0f} ms {pct(ok, 99) * 1000:>6.0f} ms {n429:>6} {n503:>6} "
+                          f"{pct(rejected, 99) * 1000:>10.1f} ms")
+            errors = sum(1 for r in out if r[1] == "error" or not (200 <= r[2] < 300 or r[2] in (429, 503)))
+            if errors:
+                print(f"{scenario:<22} transport/other errors: {errors}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark: report vendite su storico ordini grande.
+
+Confronta la query ad-hoc sulle tabelle ordini (scan completo) con la lettura
+dalle rollup di app.analytics, e misura il costo di una passata incrementale
+dopo un nuovo blocco di ordini. Verifica anche che le rollup coincidano con il
+ricalcolo completo.
+
+    python -m bench.analytics --orders 2000000 --new 10000
+"""
+import argparse, os, tempfile, time
+
+import duckdb
+
+from app import analytics, db
+
+ADHOC_TOP = """
+    SELECT oi.product_id, sum(oi.quantity * oi.unit_price_minor) AS revenue
+    FROM orders o JOIN order_items oi ON oi.order_id = o.id
+    WHERE CAST(o.created_at AS DATE) > current_date - 30
+    GROUP BY oi.product_id ORDER BY revenue DESC, oi.product_id LIMIT 10
+"""
+ROLLUP_TOP = """
+    SELECT product_id, sum(revenue_minor) AS revenue
+    FROM sales_product_daily
+    WHERE day > current_date - 30
+    GROUP BY product_id ORDER BY revenue DESC, product_id LIMIT 10
+"""
+
+
+def seed_orders(conn, start: int, n: int, age_days: int):
+    """n ordini (1-3 righe ciascuno) distribuiti sugli ultimi age_days giorni (0 = adesso)."""
+    conn.execute("""
+        INSERT INTO orders (id, payment_intent_id, buyer_email, amount_minor, currency, created_at)
+        SELECT 'o' || i, 'pi' || i, 'b@example.com', 1000 + i % 9000, CASE WHEN i % 5 = 0 THEN 'USD' ELSE 'EUR' END,
+               CAST(now() AS TIMESTAMP) - (i % (? * 1440 + 1)) * INTERVAL 1 MINUTE
+        FROM range(?, ?) t(i)
+    """, [age_days, start, start + n])
+    conn.execute("""
+        INSERT INTO order_items (order_id, position, product_id, quantity, unit_price_minor, created_at)
+        SELECT o.id, p, 'sku_' || ((i * 7 + p) % 500), 1 + (i + p) % 3, 500 + ((i * 7 + p) % 500) * 10, o.created_at
+        FROM range(?, ?) t(i) JOIN orders o ON o.id = 'o' || i, range(0, 3) q(p)
+        WHERE p <= i % 3
+    """, [start, start + n])
+
+
+def timed(fn) -> tuple[float, object]:
+    t0 = time.perf_counter()
+    out = fn()
+    return (time.perf_counter() - t0) * 1000, out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--orders", type=int, default=2_000_000)
+    ap.add_argument("--new", type=int, default=10_000)
+    ap.add_argument("--days", type=int, default=365)
+    args = ap.parse_args()
+
+    conn = duckdb.connect(os.path.join(tempfile.mkdtemp(), "bench.duckdb"))
+    db.DB_CONN = conn
+    db.init_db()
+    seed_orders(conn, 0, args.orders, args.days)
+
+    t_first, _ = timed(lambda: analytics.refresh_rollups(conn.cursor(), lag_seconds=0))
+    seed_orders(conn, args.orders, args.new, 0)
+    t_incr, stats = timed(lambda: analytics.refresh_rollups(conn.cursor(), lag_seconds=0))
+
+    t_adhoc, adhoc = timed(lambda: conn.execute(ADHOC_TOP).fetchall())
+    t_rollup, rollup = timed(lambda: conn.execute(ROLLUP_TOP).fetchall())
+    db.close()
+
+    print(f"orders={args.orders + args.new} days={args.days}")
+    print(f"initial rollup build : {t_first:8.1f} ms")
+    print(f"incremental refresh  : {t_incr:8.1f} ms  ({stats['orders']} new orders)")
+    print(f"top products ad-hoc  : {t_adhoc:8.1f} ms")
+    print(f"top products rollup  : {t_rollup:8.1f} ms  match={adhoc == rollup}")
+
+
+if __name__ == "__main__":
+    main()
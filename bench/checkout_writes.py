@@ -0,0 +1,97 @@
+"""
+Benchmark: scritture di checkout sotto carico sostenuto (create -> update -> complete).
+
+Confronta un autocommit per statement (db.execute, vecchio percorso) con il
+group commit di app.writes, che raccoglie le scritture concorrenti in un'unica
+transazione. Ogni chiamata ritorna solo dopo il proprio COMMIT in entrambi i casi.
+
+    python -m bench.checkout_writes --clients 64 --seconds 5
+"""
+import argparse, asyncio, os, statistics, tempfile, time, uuid
+
+import duckdb
+
+from app import db, writes
+
+
+def flow_statements(sid: str, pi_id: str) -> list[list[tuple[str, list]]]:
+    """Le tre scritture di un checkout, raggruppate come nelle route."""
+    return [
+        [("INSERT INTO checkout_sessions (id, status, payment_intent_id, buyer_email, currency, promo_code, "
+          "subtotal_minor, discount_minor, tax_minor, shipping_minor, grand_total_minor) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+          [sid, "requires_confirmation", pi_id, "bench@example.com", "EUR", None, 2000, 0, 440, 500, 2940]),
+         ("INSERT INTO session_items (session_id, position, product_id, quantity, unit_price_minor) VALUES (?, ?, ?, ?, ?)",
+          [sid, 0, "sku_1", 2, 1000])],
+        [("UPDATE checkout_sessions SET promo_code = ?, discount_minor = ?, grand_total_minor = ?, updated_at = now() WHERE id = ?",
+          ["WELCOME10", 200, 2696, sid])],
+        [("INSERT INTO orders (id, payment_intent_id, buyer_email, amount_minor, currency) "
+          "SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM orders WHERE payment_intent_id = ?)",
+          [str(uuid.uuid4()), pi_id, "bench@example.com", 2696, "EUR", pi_id]),
+         (db.ORDER_ITEMS_FROM_SESSION_SQL, [pi_id]),
+         ("UPDATE checkout_sessions SET status = ?, updated_at = now() WHERE id = ?", ["succeeded", sid])],
+    ]
+
+
+async def direct_write(group):
+    for sql, params in group:
+        await db.execute(sql, params)
+
+
+async def grouped_write(group):
+    await writes.write(*group)
+
+
+async def measure(write, clients: int, seconds: float) -> tuple[int, list[float]]:
+    deadline = time.perf_counter() + seconds
+    latencies: list[float] = []
+
+    async def client():
+        while time.perf_counter() < deadline:
+            uid = uuid.uuid4().hex
+            for group in flow_statements(f"cs_{uid}", f"pi_{uid}"):
+                t = time.perf_counter()
+                await write(group)
+                latencies.append(time.perf_counter() - t)
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return len(latencies), latencies
+
+
+def pct(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] * 1000 if len(values) > 1 else 0.0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=64)
+    ap.add_argument("--seconds", type=float, default=5)
+    ap.add_argument("--max-batch", type=int, default=writes.WRITE_BATCH_MAX)
+    ap.add_argument("--delay-ms", type=float, default=writes.WRITE_BATCH_DELAY_MS)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db.DB_CONN = duckdb.connect(os.path.join(tmp, "bench.duckdb"))
+    db.init_db()
+
+    n_old, lat_old = asyncio.run(measure(direct_write, args.clients, args.seconds))
+
+    async def run_grouped():
+        writes.committer = writes.GroupCommitter(args.max_batch, args.delay_ms)
+        try:
+            return await measure(grouped_write, args.clients, args.seconds)
+        finally:
+            await writes.committer.stop()
+
+    n_new, lat_new = asyncio.run(run_grouped())
+    committer = writes.committer
+    db.close()
+
+    print(f"clients={args.clients} seconds={args.seconds} max_batch={args.max_batch} delay={args.delay_ms}ms")
+    print(f"autocommit   : {n_old / args.seconds:8.1f} writes/s  p50 {pct(lat_old, 50):6.1f} ms  p99 {pct(lat_old, 99):6.1f} ms")
+    print(f"group commit : {n_new / args.seconds:8.1f} writes/s  p50 {pct(lat_new, 50):6.1f} ms  p99 {pct(lat_new, 99):6.1f} ms"
+          f"  (avg batch {committer.groups / max(1, committer.batches):.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark: 64 client concorrenti contro DuckDB locale.
+
+Confronta il vecchio schema (una connessione globale usata dentro l'event loop)
+con il layer async di app.db (pool di thread + cursori per worker). Oltre al
+throughput misura il ritardo massimo dell'event loop: con la connessione
+globale ogni query blocca anche le richieste che non toccano il DB.
+
+    python -m bench.db_concurrency --clients 64 --requests 20
+"""
+import argparse, asyncio, os, tempfile, time
+
+import duckdb
+
+from app import db
+
+QUERY = "SELECT count(*), avg(price) FROM products WHERE price <= ? AND title ILIKE ?"
+
+
+def seed(conn, rows: int):
+    conn.execute("CREATE TABLE products (id TEXT PRIMARY KEY, title TEXT, price DOUBLE)")
+    conn.execute(
+        "INSERT INTO products SELECT 'sku_' || i, 'Prodotto ' || i, (i % 1000) / 10.0 FROM range(?) t(i)",
+        [rows],
+    )
+
+
+async def blocking_client(conn, n: int):
+    for i in range(n):
+        conn.execute(QUERY, [float(i % 100), "%9%"]).fetchone()
+        await asyncio.sleep(0)
+
+
+async def pooled_client(n: int):
+    for i in range(n):
+        await db.fetchone(QUERY, [float(i % 100), "%9%"])
+
+
+async def heartbeat(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - t - 0.005)
+
+
+async def measure(make_clients) -> tuple[float, float]:
+    stop, lags = asyncio.Event(), [0.0]
+    hb = asyncio.create_task(heartbeat(stop, lags))
+    t0 = time.perf_counter()
+    await asyncio.gather(*make_clients())
+    dt = time.perf_counter() - t0
+    stop.set()
+    await hb
+    return dt, max(lags)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=64)
+    ap.add_argument("--requests", type=int, default=20)
+    ap.add_argument("--rows", type=int, default=500_000)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    conn = duckdb.connect(os.path.join(tmp, "bench.duckdb"))
+    seed(conn, args.rows)
+    db.DB_CONN = conn
+
+    total = args.clients * args.requests
+    dt_old, lag_old = asyncio.run(measure(lambda: [blocking_client(conn, args.requests) for _ in range(args.clients)]))
+    dt_new, lag_new = asyncio.run(measure(lambda: [pooled_client(args.requests) for _ in range(args.clients)]))
+    db.close()
+
+    print(f"clients={args.clients} queries={total} pool_size={db.DB_POOL_SIZE} cpus={os.cpu_count()}")
+    print(f"global connection : {total / dt_old:8.1f} q/s  max loop lag {lag_old * 1000:7.1f} ms")
+    print(f"async pool        : {total / dt_new:8.1f} q/s  max loop lag {lag_new * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
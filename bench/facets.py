@@ -0,0 +1,63 @@
+"""
+Benchmark: scoprire i valori disponibili (categorie, colori, taglie, fasce di prezzo)
+per un set di filtri. Un agente senza facet scorre /products a pagine (cursore, 500
+per pagina) e conta da sé; GET /products/facets risponde con una query GROUPING SETS,
+poi dalla cache per versione catalogo.
+
+    python -m bench.facets --rows 200000
+"""
+import argparse, os, tempfile, time
+from collections import Counter
+
+import duckdb
+from fastapi.testclient import TestClient
+
+from app import db
+from app.main import app
+from bench.search import seed
+
+FILTER_SETS = [{}, {"category": "shoes"}, {"color": "red", "max_price": 80}, {"q": "giacca impermeabile"}]
+
+
+def explore_by_listing(client, params: dict) -> tuple[int, dict]:
+    calls, counts, cursor = 0, {"category": Counter(), "color": Counter(), "size": Counter()}, "start"
+    while cursor:
+        page = client.get("/products", params={**params, "limit": 500, "cursor": cursor}).json()
+        calls += 1
+        for item in page["items"]:
+            for facet, counter in counts.items():
+                counter[item[facet]] += 1
+        cursor = page["next_cursor"]
+    return calls, counts
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=200_000)
+    args = ap.parse_args()
+
+    conn = duckdb.connect(os.path.join(tempfile.mkdtemp(), "bench.duckdb"))
+    seed(conn, args.rows)
+    db.DB_CONN = conn
+    with TestClient(app) as client:
+        client.get("/products", params={"q": "warmup"})   # costruzione dell'indice di ricerca fuori dalle misure
+        print(f"{'filters':<45} {'listing':>18} {'facets cold':>12} {'facets warm':>12}")
+        for params in FILTER_SETS:
+            t0 = time.perf_counter()
+            calls, counts = explore_by_listing(client, params)
+            t_list = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            facets = client.get("/products/facets", params=params).json()
+            t_cold = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            client.get("/products/facets", params=params)
+            t_warm = time.perf_counter() - t0
+            for facet, counter in counts.items():
+                got = {f["value"]: f["count"] for f in facets[facet]}
+                assert got == {k: v for k, v in counter.items() if k}, f"{facet} counts differ for {params}"
+            listing = f"{t_list * 1000:.0f} ms /{calls:>4} calls"
+            print(f"{str(params):<45} {listing:>18} {t_cold * 1000:>9.1f} ms {t_warm * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
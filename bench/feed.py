@@ -0,0 +1,77 @@
+"""
+Benchmark GET /products/feed: export completo in streaming contro uvicorn app.main:app.
+
+Per ogni dimensione del catalogo (--rows): tempo e byte del feed NDJSON e gzip,
+picco di memoria del server (VmHWM da /proc) rispetto a prima del feed, e costo di
+un poll con If-Modified-Since su un catalogo invariato (304). La memoria deve restare
+piatta al crescere del catalogo: le righe passano a blocchi di FEED_BATCH_ROWS.
+
+    python -m bench.feed --rows 50000 400000
+"""
+import argparse, os, shutil, tempfile, time, zlib
+
+import httpx
+
+from bench.loadtest import build_catalog, free_port, start_server
+
+
+def proc_memory_mb(pid: int) -> dict[str, float]:
+    out = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                out[key] = int(value.split()[0]) / 1024
+    return out
+
+
+def pull(client: httpx.Client, gzip: bool) -> tuple[float, int, int, str]:
+    """(secondi, byte ricevuti, righe, Last-Modified) leggendo il corpo a pezzi."""
+    headers = {"Accept-Encoding": "gzip" if gzip else "identity"}
+    t0 = time.perf_counter()
+    received = lines = 0
+    inflate = zlib.decompressobj(31)
+    with client.stream("GET", "/products/feed", headers=headers) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_raw():
+            received += len(chunk)
+            lines += (inflate.decompress(chunk) if gzip else chunk).count(b"\n")
+        last_modified = resp.headers.get("last-modified", "")
+    return time.perf_counter() - t0, received, lines, last_modified
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[50_000, 400_000])
+    args = ap.parse_args()
+
+    print(f"{'rows':>8} {'ndjson':>18} {'gzip':>18} {'server RSS start -> peak':>26} {'304 poll':>10}")
+    for rows in args.rows:
+        workdir = tempfile.mkdtemp()
+        build_catalog(os.path.join(workdir, "local.duckdb"), rows).close()
+        port = free_port()
+        server = start_server(workdir, port)
+        try:
+            with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=600) as client:
+                # lo snapshot prezzi cresce col catalogo, non col feed: caricato prima della misura
+                client.get("/products", params={"limit": 1})
+                start = proc_memory_mb(server.pid)["VmRSS"]
+                t_plain, size_plain, n_plain, last_modified = pull(client, gzip=False)
+                t_gzip, size_gzip, n_gzip, _ = pull(client, gzip=True)
+                assert n_plain == n_gzip == rows, (n_plain, n_gzip, rows)
+                peak = proc_memory_mb(server.pid)["VmHWM"]
+                t0 = time.perf_counter()
+                status = client.get("/products/feed", headers={"If-Modified-Since": last_modified}).status_code
+                t_poll = time.perf_counter() - t0
+                assert status == 304, status
+        finally:
+            server.terminate()
+            server.wait(10)
+            shutil.rmtree(workdir, ignore_errors=True)
+        plain = f"{t_plain:.2f}s {size_plain / 2**20:6.1f}MB"
+        gz = f"{t_gzip:.2f}s {size_gzip / 2**20:6.1f}MB"
+        print(f"{rows:>8} {plain:>18} {gz:>18} {f'{start:.0f} -> {peak:.0f} MB':>26} {t_poll * 1000:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Verifica single-flight delle chiavi di idempotenza: N POST /checkout/sessions identici e
+concorrenti (stessa X-Idempotency-Key) devono creare un solo PaymentIntent e restituire
+tutti la stessa sessione. Per confronto, le stesse richieste senza chiave creano N PI.
+
+App in-process via httpx.ASGITransport, fake Stripe con latenza (le richieste si
+sovrappongono davvero mentre la prima è in volo); esce con codice 1 se la verifica fallisce.
+
+    python -m bench.idempotency --requests 30 --latency-ms 50
+"""
+import argparse, asyncio, os, tempfile, time, uuid
+
+import duckdb
+import httpx
+
+os.environ.setdefault("API_KEY", "bench")
+os.environ["PAYMENT_BACKEND"] = "fake"
+
+from app import db
+from app.main import app
+from app.payments import stripe_client
+from app.payments.fake_stripe import FakeStripeBackend
+
+
+async def burst(client: httpx.AsyncClient, product_id: str, n: int, key: str | None) -> tuple[float, list]:
+    headers = {"X-API-Key": os.environ["API_KEY"]}
+    if key:
+        headers["X-Idempotency-Key"] = key
+    body = {"items": [{"product_id": product_id, "quantity": 1}], "currency": "EUR",
+            "buyer": {"email": "agent@example.com"}, "shared_payment_token": "test_spt_visa"}
+    t0 = time.perf_counter()
+    responses = await asyncio.gather(*(client.post("/checkout/sessions", json=body, headers=headers) for _ in range(n)))
+    return time.perf_counter() - t0, responses
+
+
+async def run(n: int, latency_ms: float) -> bool:
+    backend = FakeStripeBackend(latency_ms=latency_ms)
+    stripe_client.set_backend(backend)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            product_id = (await client.get("/products", params={"limit": 1})).json()[0]["id"]
+
+            dt, responses = await burst(client, product_id, n, key=f"bench-{uuid.uuid4()}")
+            keyed_creates = backend.calls["create"]
+            statuses = {r.status_code for r in responses}
+            session_ids = {r.json().get("id") for r in responses if r.status_code == 200}
+            print(f"same key    : {n} requests in {dt * 1000:7.1f} ms -> {keyed_creates} PaymentIntent, "
+                  f"{len(session_ids)} session id, status {sorted(statuses)}")
+
+            dt, responses = await burst(client, product_id, n, key=None)
+            print(f"no key      : {n} requests in {dt * 1000:7.1f} ms -> {backend.calls['create'] - keyed_creates} PaymentIntents")
+    return keyed_creates == 1 and statuses == {200} and len(session_ids) == 1
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=30)
+    ap.add_argument("--latency-ms", type=float, default=50)
+    args = ap.parse_args()
+
+    db.DB_CONN = duckdb.connect(os.path.join(tempfile.mkdtemp(), "bench.duckdb"))
+    ok = asyncio.run(run(args.requests, args.latency_ms))
+    print("OK: exactly one PaymentIntent per idempotency key" if ok else "FAIL: duplicate PaymentIntents or responses")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
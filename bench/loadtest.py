@@ -0,0 +1,353 @@
+"""
+Load test end-to-end: traffico di agenti registrato (browse -> create -> update -> complete)
+rigiocato contro app.main:app su DuckDB locale con il fake payment backend.
+
+    python -m bench.loadtest record --sessions 200            # genera bench/data/agent_traffic.jsonl
+    python -m bench.loadtest run --concurrency 16             # avvia uvicorn, rigioca, confronta col baseline
+    python -m bench.loadtest run --save-baseline              # aggiorna il baseline salvato
+    python -m bench.loadtest run --url http://127.0.0.1:8000  # contro un server già avviato (stesso catalogo)
+    python -m bench.loadtest run --workers 4                  # contro python -m app.serve (writer + 4 worker)
+
+Il risultato (throughput, p50/p95/p99 per endpoint) va in --results come JSON;
+con un baseline presente le regressioni oltre --tolerance fanno uscire con codice 1.
+"""
+import argparse, asyncio, json, os, pathlib, platform, random, re, socket, statistics, subprocess, sys, tempfile, time, uuid
+
+import duckdb
+import httpx
+
+from app import db
+from bench.search import seed
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+DATA = ROOT / "bench" / "data"
+TRAFFIC = DATA / "agent_traffic.jsonl"
+BASELINE = DATA / "loadtest_baseline.json"
+RESULTS = ROOT / "bench" / "results" / "latest.json"
+
+API_KEY = "loadtest"
+SESSION_ID = "{session_id}"   # segnaposto risolto con la risposta di create
+RUN_ID = "{run}"              # segnaposto per chiavi di idempotenza uniche per run
+
+
+# ---------- catalogo e registrazione ----------
+
+def build_catalog(path: str, rows: int):
+    """Database locale con il catalogo di bench.search: stesso contenuto in record e run."""
+    conn = duckdb.connect(path)
+    seed(conn, rows)
+    db.DB_CONN = conn
+    db.init_db()
+    db.DB_CONN = None
+    return conn
+
+
+def catalog_profile(conn) -> dict:
+    ids = [r[0] for r in conn.execute("SELECT id FROM products WHERE available ORDER BY hash(id) LIMIT 2000").fetchall()]
+    categories = [r[0] for r in conn.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL ORDER BY 1").fetchall()]
+    words = sorted({w for (t,) in conn.execute("SELECT title FROM products ORDER BY hash(id) LIMIT 2000").fetchall()
+                    for w in re.findall(r"\w{4,}", t.lower())})
+    return {"ids": ids, "categories": categories, "words": words}
+
+
+def step(session: int, endpoint: str, method: str, path: str, **request) -> dict:
+    return {"session": session, "endpoint": endpoint, "method": method, "path": path, **request}
+
+
+def generate(sessions: int, profile: dict, rng: random.Random) -> list[dict]:
+    """Sequenze per agente: 1-3 browse, poi (80%) carrello, a volte update e (85%) complete."""
+    out: list[dict] = []
+    for s in range(sessions):
+        for _ in range(rng.randint(1, 3)):
+            r = rng.random()
+            if r < 0.4:
+                params = {"q": " ".join(rng.sample(profile["words"], rng.randint(1, 2))), "limit": 10}
+            elif r < 0.6 and profile["categories"]:
+                params = {"category": rng.choice(profile["categories"]), "limit": 20}
+            elif r < 0.8:
+                params = {"cursor": "start", "limit": 50}
+            else:
+                params = {"limit": 20, "offset": rng.randrange(0, 500)}
+            out.append(step(s, "GET /products", "GET", "/products", params=params))
+        if rng.random() < 0.2:
+            continue   # agente che abbandona dopo la ricerca
+
+        items = [{"product_id": pid, "quantity": rng.randint(1, 3)} for pid in rng.sample(profile["ids"], rng.randint(1, 3))]
+        out.append(step(s, "POST /checkout/sessions", "POST", "/checkout/sessions", json={
+            "items": items,
+            "currency": "EUR",
+            "buyer": {"email": f"agent{s}@example.com"},
+            "shared_payment_token": "test_spt_3ds2" if rng.random() < 0.1 else "test_spt_visa",
+        }, headers={"X-Idempotency-Key": f"{RUN_ID}-create-{s}"}))
+        if rng.random() < 0.6:
+            update = {"promo_code": "WELCOME10"} if rng.random() < 0.5 else {"items": items + [{"product_id": rng.choice(profile["ids"]), "quantity": 1}]}
+            out.append(step(s, "POST /checkout/sessions/{id}", "POST", f"/checkout/sessions/{SESSION_ID}", json=update))
+        if rng.random() < 0.85:
+            out.append(step(s, "POST /checkout/sessions/{id}/complete", "POST", f"/checkout/sessions/{SESSION_ID}/complete",
+                            headers={"X-Idempotency-Key": f"{RUN_ID}-complete-{s}"}))
+    return out
+
+
+def record(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_catalog(os.path.join(tmp, "local.duckdb"), args.products)
+        profile = catalog_profile(conn)
+        conn.close()
+    traffic = generate(args.sessions, profile, random.Random(args.seed))
+    path = pathlib.Path(args.traffic)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        f.write(json.dumps({"meta": {"products": args.products, "sessions": args.sessions, "seed": args.seed}}) + "\n")
+        for line in traffic:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    print(f"recorded {len(traffic)} requests / {args.sessions} agent sessions -> {path}")
+
+
+def load_traffic(path: str) -> tuple[dict, dict[int, list[dict]]]:
+    meta, sessions = {}, {}
+    with open(path) as f:
+        for line in f:
+            obj = json.loads(line)
+            if "meta" in obj:
+                meta = obj["meta"]
+            else:
+                sessions.setdefault(obj["session"], []).append(obj)
+    return meta, sessions
+
+
+# ---------- server ----------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir: str, port: int, workers: int = 0, stripe_base: str | None = None,
+                 env: dict | None = None) -> subprocess.Popen:
+    """
+    workers=0: uvicorn app.main:app (processo singolo); altrimenti python -m app.serve --workers N.
+    Con più worker il fake backend in-process non è condiviso: serve stripe_base (start_fake_stripe).
+    env: variabili aggiuntive per il server (es. limiti di app.admission).
+    """
+    extra = env or {}
+    env = {k: v for k, v in os.environ.items() if k != "MOTHERDUCK_TOKEN"}
+    env.update(PAYMENT_BACKEND="fake", API_KEY=API_KEY, PYTHONPATH=str(ROOT), **extra)
+    if stripe_base:
+        env.update(PAYMENT_BACKEND="stripe", STRIPE_API_BASE=stripe_base, STRIPE_SECRET_KEY="sk_test_loadtest")
+    if workers:
+        cmd = [sys.executable, "-m", "app.serve", "--workers", str(workers), "--port", str(port)]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    return wait_ready(subprocess.Popen(cmd, cwd=workdir, env=env), f"http://127.0.0.1:{port}/healthz")
+
+
+def start_fake_stripe(port: int) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "uvicorn", "app.payments.fake_stripe:app", "--port", str(port), "--log-level", "warning"]
+    return wait_ready(subprocess.Popen(cmd, cwd=ROOT), f"http://127.0.0.1:{port}/v1/payment_intents/pi_ready")
+
+
+def wait_ready(proc: subprocess.Popen, url: str) -> subprocess.Popen:
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+# ---------- replay ----------
+
+def render(value, session_id: str | None, run_id: str):
+    if isinstance(value, str):
+        return value.replace(RUN_ID, run_id).replace(SESSION_ID, session_id or "")
+    if isinstance(value, dict):
+        return {k: render(v, session_id, run_id) for k, v in value.items()}
+    if isinstance(value, list):
+        return [render(v, session_id, run_id) for v in value]
+    return value
+
+
+async def replay_session(client: httpx.AsyncClient, steps: list[dict], run_id: str, samples: dict, errors: dict):
+    session_id = None
+    for st in steps:
+        if SESSION_ID in st["path"] and session_id is None:
+            errors[st["endpoint"]] = errors.get(st["endpoint"], 0) + 1   # create fallita: passo saltato
+            continue
+        req = render({k: st.get(k) for k in ("path", "params", "json", "headers")}, session_id, run_id)
+        t0 = time.perf_counter()
+        try:
+            resp = await client.request(st["method"], req["path"], params=req["params"], json=req["json"],
+                                        headers={"X-API-Key": API_KEY, **(req["headers"] or {})})
+            ok = resp.status_code < 400
+        except httpx.HTTPError:
+            resp, ok = None, False
+        samples.setdefault(st["endpoint"], []).append(time.perf_counter() - t0)
+        if not ok:
+            errors[st["endpoint"]] = errors.get(st["endpoint"], 0) + 1
+        elif st["endpoint"] == "POST /checkout/sessions":
+            session_id = resp.json()["id"]
+
+
+async def replay(base_url: str, sessions: list[list[dict]], concurrency: int) -> tuple[float, dict, dict]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for steps in sessions:
+        queue.put_nowait(steps)
+    samples: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    run_id = uuid.uuid4().hex[:12]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def agent():
+            while not queue.empty():
+                await replay_session(client, queue.get_nowait(), run_id, samples, errors)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(agent() for _ in range(concurrency)))
+        return time.perf_counter() - t0, samples, errors
+
+
+def summarize(wall: float, samples: dict, errors: dict) -> dict:
+    def stats(values: list[float], n_errors: int) -> dict:
+        q = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else [values[0]] * 99
+        return {
+            "requests": len(values),
+            "errors": n_errors,
+            "throughput_rps": round(len(values) / wall, 2),
+            "p50_ms": round(q[49] * 1000, 2),
+            "p95_ms": round(q[94] * 1000, 2),
+            "p99_ms": round(q[98] * 1000, 2),
+        }
+
+    endpoints = {ep: stats(v, errors.get(ep, 0)) for ep, v in sorted(samples.items())}
+    every = [x for v in samples.values() for x in v]
+    return {"endpoints": endpoints, "total": {**stats(every, sum(errors.values())), "seconds": round(wall, 3)}}
+
+
+# ---------- baseline ----------
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 2.0) -> list[str]:
+    """Regressioni per endpoint: latenze p95/p99 e throughput oltre la tolleranza, errori nuovi."""
+    problems = []
+    for ep, base in baseline["endpoints"].items():
+        cur = results["endpoints"].get(ep)
+        if cur is None:
+            problems.append(f"{ep}: missing from this run")
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if cur[key] > base[key] * (1 + tolerance) and cur[key] - base[key] > min_delta_ms:
+                problems.append(f"{ep}: {key} {base[key]} -> {cur[key]}")
+        if cur["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            problems.append(f"{ep}: throughput_rps {base['throughput_rps']} -> {cur['throughput_rps']}")
+        if cur["errors"] / max(1, cur["requests"]) > base["errors"] / max(1, base["requests"]) + 0.01:
+            problems.append(f"{ep}: errors {base['errors']}/{base['requests']} -> {cur['errors']}/{cur['requests']}")
+    return problems
+
+
+def print_report(results: dict):
+    print(f"{'endpoint':40} {'req':>6} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for ep, s in [*results["endpoints"].items(), ("total", results["total"])]:
+        print(f"{ep:40} {s['requests']:6d} {s['errors']:5d} {s['throughput_rps']:8.1f} "
+              f"{s['p50_ms']:7.1f}ms {s['p95_ms']:7.1f}ms {s['p99_ms']:7.1f}ms")
+
+
+def run(args) -> int:
+    meta, by_session = load_traffic(args.traffic)
+    sessions = [by_session[k] for k in sorted(by_session)]
+    warmup, measured = sessions[:args.warmup], sessions[args.warmup:]
+
+    procs, tmp = [], None
+    base_url = args.url
+    try:
+        if base_url is None:
+            tmp = tempfile.TemporaryDirectory()
+            build_catalog(os.path.join(tmp.name, "local.duckdb"), meta.get("products", 10_000)).close()
+            stripe_base = None
+            if args.workers > 1:
+                stripe_port = free_port()
+                procs.append(start_fake_stripe(stripe_port))
+                stripe_base = f"http://127.0.0.1:{stripe_port}"
+            port = free_port()
+            procs.append(start_server(tmp.name, port, args.workers, stripe_base))
+            base_url = f"http://127.0.0.1:{port}"
+        if warmup:
+            asyncio.run(replay(base_url, warmup, args.concurrency))
+        wall, samples, errors = asyncio.run(replay(base_url, measured, args.concurrency))
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            proc.wait(timeout=30)
+        if tmp is not None:
+            tmp.cleanup()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "sessions": len(measured),
+            "traffic": os.path.relpath(args.traffic, ROOT),
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "cpus": os.cpu_count(),
+        },
+        **summarize(wall, samples, errors),
+    }
+    print_report(results)
+    out = pathlib.Path(args.results)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"results -> {out}")
+
+    if args.save_baseline:
+        pathlib.Path(args.baseline).write_text(json.dumps(results, indent=2) + "\n")
+        print(f"baseline updated -> {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against")
+        return 0
+    problems = compare(results, json.loads(pathlib.Path(args.baseline).read_text()), args.tolerance)
+    for p in problems:
+        print(f"REGRESSION {p}")
+    if not problems:
+        print(f"no regressions vs baseline (tolerance {args.tolerance:.0%})")
+    return 1 if problems else 0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="generate agent traffic")
+    rec.add_argument("--sessions", type=int, default=200)
+    rec.add_argument("--products", type=int, default=10_000)
+    rec.add_argument("--seed", type=int, default=1)
+    rec.add_argument("--traffic", default=str(TRAFFIC))
+
+    rp = sub.add_parser("run", help="replay traffic and compare with the baseline")
+    rp.add_argument("--traffic", default=str(TRAFFIC))
+    rp.add_argument("--concurrency", type=int, default=16)
+    rp.add_argument("--warmup", type=int, default=20, help="agent sessions replayed before measuring")
+    rp.add_argument("--url", default=None, help="target an already running server instead of starting one")
+    rp.add_argument("--workers", type=int, default=0, help="start python -m app.serve with N workers instead of uvicorn")
+    rp.add_argument("--results", default=str(RESULTS))
+    rp.add_argument("--baseline", default=str(BASELINE))
+    rp.add_argument("--tolerance", type=float, default=0.25)
+    rp.add_argument("--save-baseline", action="store_true")
+
+    args = ap.parse_args()
+    if args.command == "record":
+        record(args)
+    else:
+        sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark GET /products: LIMIT/OFFSET vs cursore keyset, pagina 1 vs pagina profonda.
+
+    python -m bench.pagination --rows 1000000 --page 10000
+"""
+import argparse, os, statistics, tempfile, time
+
+import duckdb
+from fastapi.testclient import TestClient
+
+from app import db
+from app.main import app
+from app.routes.products import encode_cursor
+from bench.search import seed
+
+
+def timed(client, params: dict, repeat: int) -> float:
+    t = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        r = client.get("/products", params=params)
+        t.append(time.perf_counter() - t0)
+        assert r.status_code == 200, r.text
+    return statistics.median(t) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--limit", type=int, default=100)
+    ap.add_argument("--page", type=int, default=10_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    db.DB_CONN = duckdb.connect(os.path.join(tempfile.mkdtemp(), "bench.duckdb"))
+    seed(db.DB_CONN, args.rows)
+    client = TestClient(app)
+
+    deep = (args.page - 1) * args.limit
+    if deep >= args.rows:
+        raise SystemExit(f"--page {args.page} is beyond {args.rows} rows")
+    # id dell'ultimo elemento della pagina precedente = cursore della pagina profonda
+    last_id = db.DB_CONN.execute("SELECT id FROM products ORDER BY id LIMIT 1 OFFSET ?", [deep - 1]).fetchone()[0]
+
+    print(f"rows={args.rows} limit={args.limit}")
+    for label, first, nth in (
+        ("offset", {"offset": 0}, {"offset": deep}),
+        ("cursor", {"cursor": "start"}, {"cursor": encode_cursor({"id": last_id})}),
+    ):
+        p1 = timed(client, {"limit": args.limit, **first}, args.repeat)
+        pn = timed(client, {"limit": args.limit, **nth}, args.repeat)
+        print(f"{label:6s} page 1 {p1:8.1f} ms   page {args.page} {pn:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
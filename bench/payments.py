@@ -0,0 +1,99 @@
+"""
+Benchmark PaymentIntent create/confirm contro il fake Stripe locale (latenza simulata).
+
+Confronta l'SDK stripe sincrono chiamato dentro handler async (vecchio percorso)
+con il client async su pool keep-alive di app.payments.stripe_client, prima con
+retrieve + confirm (due round trip in /complete) poi con la conferma in una sola
+chiamata (PaymentMethod registrato nella sessione in create).
+
+    python -m bench.payments --calls 100 --latency-ms 50
+"""
+import argparse, asyncio, socket, threading, time
+
+import stripe
+import uvicorn
+
+from app.payments import fake_stripe, stripe_client
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(fake_stripe.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def sdk_flow(i: int):
+    # come il vecchio stripe_client: chiamate sincrone nell'event loop
+    pi = stripe.PaymentIntent.create(amount=1000 + i, currency="eur", payment_method_types=["card"],
+                                     payment_method="pm_card_visa")
+    stripe.PaymentIntent.retrieve(pi["id"])
+    stripe.PaymentIntent.confirm(pi["id"])
+
+
+async def retrieve_flow(i: int):
+    pi = await stripe_client.create_payment_intent(1000 + i, "eur", "bench@example.com", "test_spt_visa")
+    attached = (await stripe_client.retrieve_payment_intent(pi["id"])).get("payment_method")
+    await stripe_client.confirm_payment_intent(pi["id"], attached)
+
+
+async def async_flow(i: int):
+    pi = await stripe_client.create_payment_intent(1000 + i, "eur", "bench@example.com", "test_spt_visa")
+    await stripe_client.confirm_payment_intent(pi["id"], pi["payment_method"])
+
+
+async def measure(flow, calls: int, concurrency: int) -> float:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await flow(i)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=20)
+    ap.add_argument("--latency-ms", type=float, default=50)
+    args = ap.parse_args()
+
+    fake_stripe.backend.latency = args.latency_ms / 1000.0
+    port = free_port()
+    server = start_server(port)
+    base = f"http://127.0.0.1:{port}"
+
+    stripe.api_key, stripe.api_base = "sk_test_bench", base
+
+    dt_sdk = asyncio.run(measure(sdk_flow, args.calls, args.concurrency))
+
+    async def run_async(flow):
+        try:
+            return await measure(flow, args.calls, args.concurrency)
+        finally:
+            await stripe_client.close()
+
+    stripe_client.set_backend(stripe_client.StripeHTTPBackend(api_key="sk_test_bench", base_url=base))
+    dt_retrieve = asyncio.run(run_async(retrieve_flow))
+    stripe_client.set_backend(stripe_client.StripeHTTPBackend(api_key="sk_test_bench", base_url=base))
+    dt_async = asyncio.run(run_async(async_flow))
+    server.should_exit = True
+
+    print(f"checkout payment flows={args.calls} concurrency={args.concurrency} latency={args.latency_ms}ms per call")
+    print(f"sync stripe SDK : {args.calls / dt_sdk:7.1f} flows/s  ({dt_sdk:.2f}s)")
+    print(f"async, retrieve : {args.calls / dt_retrieve:7.1f} flows/s  ({dt_retrieve:.2f}s)")
+    print(f"async, 1 confirm: {args.calls / dt_async:7.1f} flows/s  ({dt_async:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
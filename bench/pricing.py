@@ -0,0 +1,115 @@
+"""
+Benchmark: totali di molte varianti di carrello.
+
+Confronta compute_totals chiamato per carrello (percorso delle sessioni) con
+il passaggio unico di POST /checkout/quotes:batch (app.pricing.engine.quote_batch)
+e verifica che i risultati siano identici al centesimo:
+- con le regole di seed, contro la formula storica cablata (WELCOME10, IVA 22%, spedizione EUR < 50);
+- con regole aggiuntive (IVA per paese, promo con minimo, scaglioni), contro un'implementazione di riferimento.
+
+    python -m bench.pricing --carts 10000
+"""
+import argparse, asyncio, os, random, tempfile, time
+
+import duckdb
+
+from app import catalog, db, pricing
+from app.models import LineItem
+from app.routes.checkout import compute_totals
+from bench.search import seed
+
+
+def legacy_totals(subtotal: int, currency: str, promo_code: str | None) -> tuple[int, ...]:
+    """La compute_totals originale, con le regole nel codice."""
+    discount = int(subtotal * 0.10) if promo_code and promo_code.upper() == "WELCOME10" else 0
+    taxable_base = max(0, subtotal - discount)
+    tax = int(round(taxable_base * 0.22))
+    shipping = 500 if currency.upper() == "EUR" and (subtotal / 100.0) < 50.0 else 0
+    return subtotal, discount, tax, shipping, max(0, taxable_base + tax + shipping)
+
+
+def reference_totals(subtotal: int, currency: str, promo_code: str | None, country: str | None) -> tuple[int, ...]:
+    """Le regole estese di run() scritte per esteso, senza PricingRules."""
+    promos = {"WELCOME10": (0.10, 0), "SUMMER15": (0.15, 10000)}
+    pct, min_subtotal = promos.get((promo_code or "").upper(), (0.0, 0))
+    discount = int(subtotal * pct) if subtotal >= min_subtotal else 0
+    taxable_base = max(0, subtotal - discount)
+    rate = {"DE": 0.19, "FR": 0.20, "US": 0.0725}.get((country or "").upper(), 0.22)
+    tax = int(round(taxable_base * rate))
+    tiers = {"EUR": [(2000, 800), (5000, 500)], "USD": [(2500, 900), (7500, 400)]}.get(currency.upper(), [])
+    shipping = min(((below, fee) for below, fee in tiers if subtotal < below), default=(0, 0))[1]
+    return subtotal, discount, tax, shipping, max(0, taxable_base + tax + shipping)
+
+
+def random_carts(n: int, products: int, rng: random.Random) -> list[pricing.Cart]:
+    return [
+        pricing.Cart(
+            [(f"sku_{rng.randrange(products)}", rng.randint(1, 5)) for _ in range(rng.randint(0, 6))],
+            rng.choice(["EUR", "EUR", "USD", "GBP"]),
+            rng.choice([None, None, "WELCOME10", "welcome10", "SUMMER15", "BOGUS"]),
+            rng.choice([None, "IT", "DE", "fr", "US"]),
+        )
+        for _ in range(n)
+    ]
+
+
+def mismatches(got: list[tuple], want: list[tuple]) -> int:
+    return sum(tuple(g) != tuple(w) for g, w in zip(got, want)) + abs(len(got) - len(want))
+
+
+async def run(args):
+    carts = random_carts(args.carts, args.products, random.Random(args.seed))
+    subtotals = []
+    for cart in carts:
+        prices = await catalog.snapshot.prices_cents(pid for pid, _ in cart.items)
+        subtotals.append(sum(prices[pid] * qty for pid, qty in cart.items))
+
+    t0 = time.perf_counter()
+    per_cart = [await compute_totals([LineItem(product_id=p, quantity=q) for p, q in c.items], c.currency, c.promo_code, c.country)
+                for c in carts]
+    t_single = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    batch = await pricing.engine.quote_batch(carts)
+    t_batch = time.perf_counter() - t0
+
+    print(f"carts={len(carts)} lines={sum(len(c.items) for c in carts)}")
+    print(f"compute_totals per cart : {t_single * 1000:8.1f} ms")
+    print(f"quote batch (1 pass)    : {t_batch * 1000:8.1f} ms  (x{t_single / t_batch:.1f})")
+    legacy = [legacy_totals(s, c.currency, c.promo_code) for s, c in zip(subtotals, carts)]
+    print(f"seed rules  vs legacy formula : batch mismatches {mismatches([r[1:] for r in batch], legacy)}, "
+          f"per-cart mismatches {mismatches([tuple(t.model_dump(exclude={'currency'}).values()) for t in per_cart], legacy)}")
+
+    # regole estese (tabelle pricing_*) contro la stessa logica scritta a mano
+    conn = db.get_conn()
+    conn.execute("INSERT INTO pricing_tax_rates VALUES ('DE', 0.19), ('FR', 0.20), ('US', 0.0725)")
+    conn.execute("INSERT INTO pricing_promos VALUES ('SUMMER15', 0.15, 10000, true)")
+    conn.execute("INSERT INTO pricing_shipping VALUES ('USD', 2500, 900), ('USD', 7500, 400), ('EUR', 2000, 800)")
+    db.bump_catalog_version(conn)
+    await catalog.snapshot.refresh(force=True)
+    expected = [reference_totals(s, c.currency, c.promo_code, c.country) for s, c in zip(subtotals, carts)]
+    batch = await pricing.engine.quote_batch(carts)
+    print(f"extended rules vs reference : batch mismatches {mismatches([r[1:] for r in batch], expected)}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--carts", type=int, default=10_000)
+    ap.add_argument("--products", type=int, default=50_000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    conn = duckdb.connect(os.path.join(tmp, "bench.duckdb"))
+    seed(conn, args.products)
+    # prezzi con mezzo centesimo: stesso arrotondamento di price_to_cents in entrambi i percorsi
+    conn.execute("UPDATE products SET price = price + 0.005 WHERE hash(id) % 3 = 0")
+    db.DB_CONN = conn
+    db.init_db()
+    try:
+        asyncio.run(run(args))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
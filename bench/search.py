@@ -0,0 +1,78 @@
+"""
+Benchmark GET /products?q= : indice BM25 in memoria vs percorso ILIKE.
+
+    python -m bench.search --rows 200000
+"""
+import argparse, os, statistics, tempfile, time
+
+import duckdb
+from fastapi.testclient import TestClient
+
+from app import db, search
+from app.main import app
+
+QUERIES = ["scarpe running", "borraccia termica", "citta", "brand17", "m1234", "serie 42 modello 7"]
+
+
+def seed(conn, rows: int):
+    conn.execute("""
+        CREATE TABLE products (
+            id TEXT PRIMARY KEY, title TEXT, description TEXT, price DOUBLE, currency TEXT,
+            image TEXT, available BOOLEAN, brand TEXT, category TEXT, image_url TEXT,
+            size TEXT, color TEXT, return_policy TEXT
+        )
+    """)
+    # Vocabolario ampio: come in un catalogo reale ogni termine è selettivo
+    conn.execute("""
+        INSERT INTO products
+        SELECT
+            'sku_' || i,
+            ['Scarpe', 'Borraccia', 'Giacca', 'Calze', 'Zaino', 'Maglia', 'Pantaloni', 'Guanti'][i % 8 + 1]
+                || ' ' || ['running', 'trekking', 'termica', 'impermeabile', 'tecnica', 'leggera'][i % 6 + 1]
+                || ' ' || ['città', 'montagna', 'mare', 'pista', 'bosco'][i % 5 + 1]
+                || ' m' || (i % 4999),
+            'Modello ' || (i % 997) || ' serie ' || (i % 331) || ', articolo sportivo',
+            (i % 20000) / 100.0, 'eur', NULL, true,
+            'brand' || (i % 211),
+            ['shoes', 'bottles', 'jackets', 'socks', 'bags'][i % 5 + 1],
+            NULL, CAST(38 + i % 8 AS TEXT), ['black', 'red', 'blue'][i % 3 + 1], '30 days'
+        FROM range(?) t(i)
+    """, [rows])
+    conn.execute("CREATE TABLE catalog_meta (key TEXT PRIMARY KEY, version BIGINT, updated_at TIMESTAMP DEFAULT now())")
+    conn.execute("INSERT INTO catalog_meta (key, version) VALUES ('products', 1)")
+
+
+def run(client, backend: str, repeat: int) -> list[float]:
+    search.SEARCH_BACKEND = backend
+    timings = []
+    for _ in range(repeat):
+        for q in QUERIES:
+            t0 = time.perf_counter()
+            r = client.get("/products", params={"q": q, "limit": 50})
+            timings.append(time.perf_counter() - t0)
+            assert r.status_code == 200, r.text
+    return timings
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    db.DB_CONN = duckdb.connect(os.path.join(tempfile.mkdtemp(), "bench.duckdb"))
+    seed(db.DB_CONN, args.rows)
+    client = TestClient(app)
+
+    t0 = time.perf_counter()
+    run(client, "index", 1)  # build iniziale dell'indice
+    print(f"rows={args.rows} index build (first query) {time.perf_counter() - t0:.2f}s")
+
+    for backend in ("ilike", "index"):
+        t = sorted(run(client, backend, args.repeat))
+        p95 = t[int(len(t) * 0.95) - 1]
+        print(f"{backend:6s} p50 {statistics.median(t) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark serializzazione di una pagina /products (500 righe):
+Product + jsonable_encoder (vecchio percorso) vs encode_items.
+
+    python -m bench.serialization
+"""
+import argparse, json, time
+
+from fastapi.encoders import jsonable_encoder
+
+from app.models import Product
+from app.routes.products import encode_items, row_fields
+
+
+def sample_rows(n: int) -> list[tuple]:
+    return [
+        (f"sku_{i}", f"Scarpe running {i}", "Scarpe da corsa leggere, ideali per 5-10 km",
+         f"https://acp-merchant.onrender.com/product/sku_{i}", "Acme", "shoes", 29.99 + i, "EUR",
+         f"https://picsum.photos/seed/sku{i}/400/300", "44", "black", "30 days", True)
+        for i in range(n)
+    ]
+
+
+def pydantic_path(rows) -> bytes:
+    items = [Product(**row_fields(r)) for r in rows]
+    return json.dumps(jsonable_encoder(items), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def fast_path(rows) -> bytes:
+    items, _ = encode_items(rows)
+    return json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=500)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+
+    rows = sample_rows(args.rows)
+    assert pydantic_path(rows) == fast_path(rows)
+    for label, fn in (("pydantic", pydantic_path), ("fast", fast_path)):
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            fn(rows)
+        print(f"{label:8s} {(time.perf_counter() - t0) / args.repeat * 1000:7.2f} ms / page of {args.rows}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark: cold start, dal lancio del processo alla prima risposta di /openapi.json
+(la prima chiamata delle GPT Actions dopo lo spin-down di Render).
+
+Scenari, ciascuno --runs volte (mediana) con uvicorn app.main:app su un DuckDB locale:
+- first boot: database vuoto (DDL, migrazioni, seed del catalogo)
+- restart: schema già alla versione corrente (marker schema_meta, nessun DDL)
+- restart + prebuilt: come sopra, con OPENAPI_PREBUILT generato da `python -m app.openapi`
+Riporta anche i costi in isolamento: import di app.main con e senza stripe/httpx
+caricati all'avvio, init_db e generazione dello schema OpenAPI.
+
+    python -m bench.startup --runs 5
+"""
+import argparse, os, shutil, statistics, subprocess, sys, tempfile, time
+
+import httpx
+
+from bench.loadtest import API_KEY, ROOT, free_port
+
+
+def server_env(**extra) -> dict:
+    env = {k: v for k, v in os.environ.items() if k not in ("MOTHERDUCK_TOKEN", "OPENAPI_PREBUILT")}
+    env.update(PAYMENT_BACKEND="fake", API_KEY=API_KEY, PYTHONPATH=str(ROOT), **extra)
+    return env
+
+
+def time_to_openapi(workdir: str, env: dict) -> float:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/openapi.json"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=workdir, env=env)
+    try:
+        # un solo client: httpx.get ne crea uno (con contesto SSL) a ogni tentativo, rubando CPU al server
+        with httpx.Client(headers={"Accept-Encoding": "gzip"}, timeout=5) as client:
+            while time.perf_counter() - t0 < 60:
+                if proc.poll() is not None:
+                    raise RuntimeError("server exited during startup")
+                try:
+                    if client.get(url).status_code == 200:
+                        return time.perf_counter() - t0
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError("server did not start")
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def python_time(code: str, env: dict, cwd: str) -> float:
+    """Ultima riga stampata da code (secondi) in un interprete nuovo."""
+    out = subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def median(fn, runs: int) -> float:
+    return statistics.median(fn() for _ in range(runs))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    env = server_env()
+    try:
+        t_import = median(lambda: python_time(
+            "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)", env, tmp), args.runs)
+        t_import_eager = median(lambda: python_time(
+            "import time; t = time.perf_counter(); import stripe, httpx, app.main; print(time.perf_counter() - t)", env, tmp), args.runs)
+
+        def first_boot() -> float:
+            workdir = tempfile.mkdtemp(dir=tmp)
+            try:
+                return time_to_openapi(workdir, env)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        t_first = median(first_boot, args.runs)
+        warm = os.path.join(tmp, "warm")
+        os.mkdir(warm)
+        time_to_openapi(warm, env)   # crea lo schema e scrive il marker
+        t_restart = median(lambda: time_to_openapi(warm, env), args.runs)
+
+        prebuilt = os.path.join(tmp, "build", "openapi.json")
+        subprocess.run([sys.executable, "-m", "app.openapi", prebuilt], env=env, cwd=tmp, check=True, capture_output=True)
+        t_prebuilt = median(lambda: time_to_openapi(warm, server_env(OPENAPI_PREBUILT=prebuilt)), args.runs)
+
+        t_init_marked = median(lambda: python_time(
+            "import time, duckdb; from app import db; db.DB_CONN = duckdb.connect('warm/local.duckdb'); "
+            "t = time.perf_counter(); db.init_db(); print(time.perf_counter() - t)", env, tmp), args.runs)
+        t_init_ddl = median(lambda: python_time(
+            "import time, duckdb; from app import db; db.DB_CONN = duckdb.connect('warm/local.duckdb'); "
+            "t = time.perf_counter(); db._create_schema(db.DB_CONN); print(time.perf_counter() - t)", env, tmp), args.runs)
+        t_schema = median(lambda: python_time(
+            "import time; from app.main import app; from app import openapi; "
+            "t = time.perf_counter(); openapi.encode(app.openapi()); print(time.perf_counter() - t)", env, tmp), args.runs)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ms = lambda s: f"{s * 1000:8.1f} ms"
+    print(f"spawn -> first /openapi.json (median of {args.runs})")
+    print(f"  first boot (DDL + seed)      : {ms(t_first)}")
+    print(f"  restart (schema marker)      : {ms(t_restart)}")
+    print(f"  restart + prebuilt OpenAPI   : {ms(t_prebuilt)}")
+    print("in isolation")
+    print(f"  import app.main              : {ms(t_import)}  (stripe + httpx eager: {ms(t_import_eager).strip()})")
+    print(f"  init_db, DDL pass            : {ms(t_init_ddl)}")
+    print(f"  init_db, schema current      : {ms(t_init_marked)}")
+    print(f"  OpenAPI build + encode       : {ms(t_schema)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark: throughput di GET /products al crescere dei worker (python -m app.serve).
+
+Stesso catalogo e stesse query del load test (le richieste /products registrate in
+bench/data/agent_traffic.jsonl), rigiocate in loop per --seconds contro:
+uvicorn app.main:app (processo singolo, riferimento) e app.serve con 1, 2, 4... worker.
+Lo scaling è limitato dai core disponibili: generatore di carico e writer girano sulla stessa macchina.
+
+    python -m bench.workers --workers 1 2 4 --concurrency 32 --seconds 10
+"""
+import argparse, asyncio, itertools, os, statistics, tempfile, time
+
+import httpx
+
+from bench.loadtest import API_KEY, TRAFFIC, build_catalog, free_port, load_traffic, start_server
+
+
+async def hammer(base_url: str, requests: list[dict], concurrency: int, seconds: float) -> tuple[int, int, list[float]]:
+    cycle = itertools.cycle(requests)
+    latencies: list[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60, headers={"X-API-Key": API_KEY}) as client:
+        deadline = time.perf_counter() + seconds
+
+        async def agent():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                t = time.perf_counter()
+                resp = await client.get("/products", params=next(cycle)["params"])
+                latencies.append(time.perf_counter() - t)
+                errors += resp.status_code >= 400
+
+        await asyncio.gather(*(agent() for _ in range(concurrency)))
+    return len(latencies), errors, latencies
+
+
+def measure(workdir: str, workers: int, requests: list[dict], args) -> dict:
+    port = free_port()
+    proc = start_server(workdir, port, workers)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        asyncio.run(hammer(base_url, requests, args.concurrency, args.warmup))
+        n, errors, lat = asyncio.run(hammer(base_url, requests, args.concurrency, args.seconds))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    q = statistics.quantiles(lat, n=100)
+    return {"rps": n / args.seconds, "errors": errors, "p50_ms": q[49] * 1000, "p99_ms": q[98] * 1000}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--warmup", type=float, default=2)
+    ap.add_argument("--traffic", default=str(TRAFFIC))
+    args = ap.parse_args()
+
+    meta, by_session = load_traffic(args.traffic)
+    requests = [st for steps in by_session.values() for st in steps if st["endpoint"] == "GET /products"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build_catalog(os.path.join(tmp, "local.duckdb"), meta.get("products", 10_000)).close()
+        results = [("single (uvicorn)", measure(tmp, 0, requests, args))]
+        results += [(f"app.serve x{w}", measure(tmp, w, requests, args)) for w in args.workers]
+
+    base = results[0][1]["rps"]
+    print(f"GET /products  concurrency={args.concurrency} seconds={args.seconds} cpus={os.cpu_count()}")
+    for label, r in results:
+        print(f"{label:18} {r['rps']:8.1f} req/s  x{r['rps'] / base:4.2f}  p50 {r['p50_ms']:6.1f} ms"
+              f"  p99 {r['p99_ms']:6.1f} ms  errors {r['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Ambiente dei test: DuckDB temporaneo per test, fake Stripe in-process, chiave API fissa."""
+import os
+
+# letti all'import dei moduli app.*: impostati prima di qualunque import dell'app
+os.environ["PAYMENT_BACKEND"] = "fake"
+os.environ["API_KEY"] = "test-key"
+os.environ.pop("MOTHERDUCK_TOKEN", None)
+
+import duckdb
+import pytest
+
+API_HEADERS = {"X-API-Key": "test-key"}
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Connessione DuckDB nuova in tmp_path come connessione globale di app.db."""
+    from app import catalog, db, sessions, writes
+
+    db.DB_CONN = duckdb.connect(str(tmp_path / "test.duckdb"))
+    catalog.snapshot.invalidate()
+    sessions.store._cache.clear()
+    sessions.store._by_pi.clear()
+    # gli asyncio.Event del group commit restano legati all'event loop del test precedente
+    writes.committer = writes.GroupCommitter()
+    yield db.DB_CONN
+    db.close()
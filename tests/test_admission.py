@@ -0,0 +1,21 @@
+from app.admission import client_ip
+
+
+def scope(forwarded: list[str] = (), client=("10.0.0.1", 5000)) -> dict:
+    return {"headers": [(b"x-forwarded-for", v.encode()) for v in forwarded], "client": client}
+
+
+def test_forwarded_ip_added_by_trusted_proxy():
+    # il client prova a scegliersi l'IP: conta l'indirizzo aggiunto dal proxy fidato
+    assert client_ip(scope(["6.6.6.6, 203.0.113.7"]), proxy_hops=1) == "203.0.113.7"
+    assert client_ip(scope(["6.6.6.6", "203.0.113.7, 10.1.1.1"]), proxy_hops=2) == "203.0.113.7"
+
+
+def test_fewer_hops_than_proxies_falls_back_to_connection():
+    assert client_ip(scope(["203.0.113.7"]), proxy_hops=2) == "10.0.0.1"
+    assert client_ip(scope([]), proxy_hops=1) == "10.0.0.1"
+    assert client_ip(scope([], client=None), proxy_hops=1) == "unknown"
+
+
+def test_forwarded_header_ignored_without_proxies():
+    assert client_ip(scope(["203.0.113.7"]), proxy_hops=0) == "10.0.0.1"
@@ -0,0 +1,60 @@
+import asyncio
+
+import httpx
+
+from app import db
+from app.main import app
+from app.payments import stripe_client
+from app.payments.fake_stripe import FakeStripeBackend
+from app.routes.checkout import drain_completions
+from tests.conftest import API_HEADERS
+
+
+async def _with_client(scenario):
+    stripe_client.set_backend(FakeStripeBackend())
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                     headers=API_HEADERS) as client:
+            return await scenario(client)
+
+
+async def _create(client: httpx.AsyncClient, token: str = "test_spt_visa") -> dict:
+    product_id = (await client.get("/products", params={"limit": 1})).json()[0]["id"]
+    r = await client.post("/checkout/sessions", json={
+        "items": [{"product_id": product_id, "quantity": 1}], "currency": "EUR",
+        "buyer": {"email": "agent@example.com"}, "shared_payment_token": token})
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_sync_3ds_complete_returns_200(database):
+    async def scenario(client):
+        session = await _create(client, "test_spt_3ds2")
+        return await client.post(f"/checkout/sessions/{session['id']}/complete")
+
+    r = asyncio.run(_with_client(scenario))
+    assert (r.status_code, r.json()["status"]) == (200, "requires_action")
+
+
+def test_async_complete_returns_202_then_polls_succeeded(database):
+    async def scenario(client):
+        session = await _create(client)
+        accepted = await client.post(f"/checkout/sessions/{session['id']}/complete", headers={"Prefer": "respond-async"})
+        await drain_completions()
+        return accepted, await client.get(f"/checkout/sessions/{session['id']}")
+
+    accepted, polled = asyncio.run(_with_client(scenario))
+    assert (accepted.status_code, accepted.json()["status"]) == (202, "requires_action")
+    assert polled.json()["status"] == "succeeded"
+
+
+def test_get_open_session_reads_database(database):
+    async def scenario(client):
+        session = await _create(client)   # in cache come requires_confirmation
+        # cambiata fuori da questo processo (altro worker, webhook), senza invalidare la cache
+        await db.execute("UPDATE checkout_sessions SET status = 'requires_action', revision = revision + 1 WHERE id = ?",
+                         [session["id"]])
+        return await client.get(f"/checkout/sessions/{session['id']}")
+
+    r = asyncio.run(_with_client(scenario))
+    assert r.json()["status"] == "requires_action"
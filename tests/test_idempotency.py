@@ -0,0 +1,45 @@
+import asyncio, uuid
+
+import httpx
+
+from app import db, idempotency
+from app.main import app
+from app.payments import stripe_client
+from app.payments.fake_stripe import FakeStripeBackend
+from tests.conftest import API_HEADERS
+
+
+async def _concurrent_creates(n: int, key: str) -> tuple[FakeStripeBackend, list]:
+    backend = FakeStripeBackend(latency_ms=30)
+    stripe_client.set_backend(backend)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            product_id = (await client.get("/products", params={"limit": 1}, headers=API_HEADERS)).json()[0]["id"]
+            body = {"items": [{"product_id": product_id, "quantity": 1}], "currency": "EUR",
+                    "buyer": {"email": "agent@example.com"}, "shared_payment_token": "test_spt_visa"}
+            headers = {**API_HEADERS, "X-Idempotency-Key": key}
+            responses = await asyncio.gather(*(client.post("/checkout/sessions", json=body, headers=headers)
+                                               for _ in range(n)))
+    return backend, responses
+
+
+def test_concurrent_same_key_creates_one_payment_intent(database):
+    backend, responses = asyncio.run(_concurrent_creates(10, f"test-{uuid.uuid4()}"))
+    assert [r.status_code for r in responses] == [200] * 10
+    assert len({r.json()["id"] for r in responses}) == 1
+    assert backend.calls["create"] == 1
+
+
+def test_first_saved_response_wins(database):
+    async def scenario():
+        async with app.router.lifespan_context(app):
+            first = await db.save_idempotent_response("k1", "create", '{"id": "a"}', 3600)
+            second = await db.save_idempotent_response("k1", "create", '{"id": "b"}', 3600)
+            await db.execute("UPDATE idempotency SET created_at = created_at - INTERVAL 2 HOUR WHERE key = 'k1'")
+            expired = await db.save_idempotent_response("k1", "create", '{"id": "c"}', 3600)
+            fresh = await idempotency.store.get("k1", "create")
+        return first, second, expired, fresh
+
+    first, second, expired, fresh = asyncio.run(scenario())
+    assert (first, second) == ('{"id": "a"}', '{"id": "a"}')
+    assert expired == fresh == '{"id": "c"}'
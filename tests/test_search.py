@@ -0,0 +1,36 @@
+from collections import Counter
+
+from app.search import SearchIndex, document_terms
+
+
+def doc(title: str) -> Counter:
+    return document_terms({"title": title})
+
+
+def test_upsert_new_document_is_found_by_cached_term():
+    index = SearchIndex()
+    index.upsert("a", doc("running shoes"), 1)
+    assert [d for d, _ in index.search("shoes")] == ["a"]   # pesi di "shoes" in cache
+
+    index.upsert("b", doc("trail shoes"), 2)
+    assert sorted(d for d, _ in index.search("shoes")) == ["a", "b"]
+
+
+def test_upsert_changes_idf_of_other_terms():
+    index = SearchIndex()
+    index.upsert("a", doc("red jacket"), 1)
+    index.upsert("b", doc("blue jacket"), 2)
+    before = dict(index.search("red"))
+    index.upsert("c", doc("green hat"), 3)
+    assert dict(index.search("red"))["a"] != before["a"]   # n_docs e lunghezza media cambiati
+
+
+def test_replace_and_remove():
+    index = SearchIndex()
+    index.upsert("a", doc("wool scarf"), 1)
+    index.search("scarf")
+    index.upsert("a", doc("silk tie"), 2)
+    assert index.search("scarf") == []
+    assert [d for d, _ in index.search("tie")] == ["a"]
+    index.remove("a")
+    assert index.search("tie") == []
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from app.payments import stripe_client
+from app.payments.stripe_client import PaymentError, StripeHTTPBackend
+
+
+def test_invalid_request_maps_to_payment_error():
+    async def scenario():
+        # server che accetta la connessione: l'header viene validato all'invio della richiesta
+        server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        backend = StripeHTTPBackend(api_key="", base_url=f"http://127.0.0.1:{port}", max_retries=0)
+        try:
+            await backend.retrieve("pi_123")   # "Bearer " senza chiave: header non valido per httpx
+        finally:
+            await backend.aclose()
+            server.close()
+
+    with pytest.raises(PaymentError) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status == 502
+
+
+def test_check_config_requires_key_for_http_backend(monkeypatch):
+    monkeypatch.setattr(stripe_client, "_backend", None)
+    monkeypatch.setattr(stripe_client, "PAYMENT_BACKEND", "stripe")
+    monkeypatch.delenv("STRIPE_SECRET_KEY", raising=False)
+    with pytest.raises(RuntimeError, match="STRIPE_SECRET_KEY"):
+        stripe_client.check_config()
+
+    monkeypatch.setenv("STRIPE_SECRET_KEY", "sk_test_x")
+    stripe_client.check_config()
+    monkeypatch.setattr(stripe_client, "PAYMENT_BACKEND", "fake")
+    monkeypatch.delenv("STRIPE_SECRET_KEY")
+    stripe_client.check_config()
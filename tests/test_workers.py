@@ -0,0 +1,36 @@
+"""Due worker reali (python -m app.serve): ogni worker ha la propria cache delle sessioni."""
+import httpx
+import pytest
+
+from bench.loadtest import API_KEY, free_port, start_server
+
+
+@pytest.fixture
+def server(tmp_path):
+    port = free_port()
+    proc = start_server(str(tmp_path), port, workers=2)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def fresh_get(base: str, path: str, **kwargs) -> httpx.Response:
+    # connessione nuova a ogni richiesta: il kernel le distribuisce fra i due worker
+    return httpx.get(base + path, headers={"X-API-Key": API_KEY, "Connection": "close"}, **kwargs)
+
+
+def test_read_after_write_on_other_worker(server):
+    headers = {"X-API-Key": API_KEY, "Connection": "close"}
+    product_id = fresh_get(server, "/products", params={"limit": 1}).json()[0]["id"]
+    created = httpx.post(f"{server}/checkout/sessions", headers=headers, json={
+        "items": [{"product_id": product_id, "quantity": 1}], "currency": "EUR",
+        "buyer": {"email": "agent@example.com"}, "shared_payment_token": "test_spt_visa"}).json()
+    path = f"/checkout/sessions/{created['id']}"
+    for _ in range(20):   # sessione in cache in entrambi i worker
+        assert fresh_get(server, path).json()["cart"]["items"][0]["quantity"] == 1
+
+    httpx.post(server + path, headers=headers, json={"items": [{"product_id": product_id, "quantity": 3}]}).raise_for_status()
+    quantities = [fresh_get(server, path).json()["cart"]["items"][0]["quantity"] for _ in range(20)]
+    assert quantities == [3] * 20